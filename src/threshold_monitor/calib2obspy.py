@@ -5,8 +5,16 @@ Author: Glenn Thompson
 Date: 2024-06-14
 Description: This library contains 3 functions which, together, enable real-time data to be corrected using the calib value in the 
 AEC master_stations calibration table. Optionally, another Datascope database, or a wfdisc table can be used. 
+If Antelope is not installed, only the wfdisc table can be used, and it is read with wfdisc2obspy.
 """
-import antelope.datascope as ds # for calib
+antelope_imported = False
+try:
+    import antelope.datascope as ds # for calib
+    antelope_imported = True
+except ImportError:
+    print('antelope not imported: only wfdisc tables can be used for calibration')
+import wfdisc2obspy
+import re
 
 def get_stations(seed_ids, dbname=None, dbtablename='calibration', time=None):
     """
@@ -27,8 +35,20 @@ def get_stations(seed_ids, dbname=None, dbtablename='calibration', time=None):
             dbname = '/aec/db/stations/master_stations'
         elif dbtablename=='wfdisc':
             dbname = '/aec/db/waveforms/waveforms'
+    if not antelope_imported and dbtablename!='wfdisc':
+        raise ImportError(f'antelope is needed to read the {dbtablename} table. Only wfdisc tables can be read without it')
     for id in seed_ids:
         network, station, location, channel = id.split('.')
+        if not antelope_imported:
+            # read the wfdisc table directly, and use the most recent matching row
+            rows = [row for row in wfdisc2obspy.read_wfdisc(dbname) 
+                    if re.fullmatch(station, row['sta']) and re.fullmatch(channel, row['chan']) and (not time or row['time']<=time.timestamp)]
+            print(f'Found {len(rows)} matching wfdisc table records for {id}')
+            if len(rows)==0:
+                raise LookupError(f'No matching calibration records found for {id}')
+            row = sorted(rows, key=lambda row: row['time'])[-1]
+            response_dicts[id] = calib2response_dict(row['calib'], row['calper'], row['samprate'], row['segtype'])
+            continue
         with ds.closing(ds.dbopen(dbname, 'r')) as db:
             dbtable = db.lookup(table=dbtablename)
             response_dict = {}
@@ -44,22 +64,36 @@ def get_stations(seed_ids, dbname=None, dbtablename='calibration', time=None):
                     raise LookupError(f'No matching calibration records found for {sub_str}')
                 for rec in dbview.iter_record(N-1): # should just grab the most recent row. 
                     calib, calper, samprate, segtype = rec.getv('calib', 'calper', 'samprate', 'segtype')
-                    if calper==-1:
-                        calper=1.0
-                    units = '?'
-                    if segtype=='V':
-                        units = 'nm/s'
-                    elif segtype=='A':
-                        units = 'nm/s**2'
+                    units = None
                     if dbtablename=='calibration':
                         units = rec.getv('units')[0]
-                    if 'nm' in units:
-                        calib = calib / 1e9
-                        units = units.replace('nm', 'm')
-                response_dict = {'calib':calib, 'calper':calper, 'samprate':samprate, 'segtype':segtype, 'units':units}
+                    response_dict = calib2response_dict(calib, calper, samprate, segtype, units=units)
             response_dicts[id]=response_dict
     return response_dicts
 
+def calib2response_dict(calib, calper, samprate, segtype, units=None):
+    """
+    Builds a response dict from the calib, calper, samprate and segtype of a calibration or wfdisc table row
+
+    Parameters:
+        units (str, optional): units from a calibration table row. If None, units are derived from segtype.
+
+    Returns:
+        A response dict, with calib converted from nm to m if needed.
+    """
+    if calper==-1:
+        calper=1.0
+    if not units:
+        units = '?'
+        if segtype=='V':
+            units = 'nm/s'
+        elif segtype=='A':
+            units = 'nm/s**2'
+    if 'nm' in units:
+        calib = calib / 1e9
+        units = units.replace('nm', 'm')
+    return {'calib':calib, 'calper':calper, 'samprate':samprate, 'segtype':segtype, 'units':units}
+
 def attach_response(st, response_dicts, overwrite=False): 
     """
     Attaches a response dict containing calibration information to each Trace in a Stream
@@ -1,19 +1,50 @@
 #!/usr/bin/env python
+import time
+t_imports = time.perf_counter()
 import obspy
 tstart = obspy.UTCDateTime()
 import sys
 import numpy as np
 import yaml
 import argparse
-import time
+import importlib
 # for latency or timings
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
 import subprocess
 import fcntl
+import threading
+import queue
+import pickle
+import bisect
+from collections import deque, OrderedDict
 UNAME = os.environ.get('USER')
 HOSTNAME = os.uname().nodename
+PLOT_LOCK = threading.Lock() # matplotlib.pyplot is not thread-safe, and stations may run as threads within one process
+LATENCY_LOCK = threading.Lock() # latency lists are appended to by the packet loop, but also read and trimmed by the StallWatchdog thread
+IMPORT_TIMES = {'startup': time.perf_counter() - t_imports} # seconds spent importing modules, for the --benchmark report
+
+def lazy_import(modname):
+    ''' import a heavy module (pandas, matplotlib.pyplot, mysql.connector) the first time it is actually needed, e.g. at alarm time or 
+    shutdown, rather than at startup of every worker. matplotlib gets the non-interactive Agg backend, since we run headless. 
+    How long each import took is recorded in IMPORT_TIMES. '''
+    if modname in sys.modules:
+        return sys.modules[modname]
+    t0 = time.perf_counter()
+    if modname == 'matplotlib.pyplot':
+        import matplotlib
+        matplotlib.use('Agg')
+    module = importlib.import_module(modname)
+    IMPORT_TIMES[modname] = time.perf_counter() - t0
+    return module
+
+def now_ns():
+    ''' the time now, as integer nanoseconds since 1970, like UTCDateTime().ns but without making a UTCDateTime. On the per-packet paths,
+    time stamps are kept like this, and durations come from time.perf_counter_ns() or time.monotonic_ns(). See to_utc() '''
+    return time.time_ns()
+
+def to_utc(ns):
+    ''' a time in integer nanoseconds as a UTCDateTime, for output '''
+    return obspy.UTCDateTime(ns=int(ns))
 ################################################################################
 ###                            CLASSES                                       ###
 ################################################################################
@@ -25,25 +56,55 @@ class RealTimeDataClient(object):
         self.bufferSecs = 0.0
         self.filterdef = None
         self.remove_instrument_response = False # defaults to just using overall sensivity (same as calib)
+        self.readahead_packets = 60 # in archive mode, datascope2obspy reads this many packets at a time in a background thread (or with archive_chunk_seconds, the next chunk). 0 for no read-ahead
+        self.archive_chunk_seconds = 3600.0 # in archive mode with datascope2obspy, process data in chunks this long rather than packet by packet. 0 to disable
+        self.checkpoint_seconds = 10.0 # in realtime mode, save a checkpoint for this station this often, so a restart can resume from it. 0 to disable
+        self.checkpointdir = None # where to save checkpoints. defaults to outputdir
+        self.max_checkpoint_age = 3600.0 # do not resume from a checkpoint older than this many seconds
+        self.backfill_gaps = False # if there is a gap before a packet, fetch the missing data and process & analyze it first
+        self.backfill_api = None # what to fetch missing data with. None to use the client itself (slink2obspy), or datascope2obspy (e.g. with orb2obspy)
+        self.max_backfill_seconds = 600.0 # do not try to backfill gaps longer than this
+        self.redundant_datasource = None # a second server with the same data. if set, packets are read from both, and whichever copy arrives first is used
+        self.max_hold_seconds = 2.0 # in realtime mode, hold out-of-order packets for up to this many seconds, so they can be put back in time order. 0 to disable
+        self.catchup_latency = 30.0 # in realtime mode, if packets are this many seconds behind, catch up by processing them in batches. 0 to disable
+        self.catchup_batch_seconds = 30.0 # the most data to process in one batch when catching up
+        self.read_timeout = 60.0 # give up waiting for a packet after this many seconds, and reconnect. 0 to wait forever
+        self.max_reconnect_backoff = 60.0 # wait 1, 2, 4 ... seconds, up to this many, between attempts to reconnect to a server
+        self.stall_seconds = 120.0 # in realtime mode, if no packets arrive for this many seconds, send a latency alarm. 0 to disable
+        self.quiet_gate = False # skip the buffer detrend, filter and calibrate for packets that a STA/LTA on raw counts says are quiet. See QuietGate
+        self.sta_seconds = 1.0 # short-term average window of the quiet gate
+        self.lta_seconds = 30.0 # long-term average window of the quiet gate
+        self.trigger_ratio = 2.5 # a packet is not quiet if the STA/LTA reaches this anywhere in it
+        self.quiet_level = None # nor if its gain-corrected peak (m/s^2), times the most the filter can amplify it by, reaches this. The quiet gate stays off until it is set. threshold_monitor.py sets it from the thresholds
+        self.processing_cache_size = 64 # how many filter designs and inverse response spectra to keep. 0 to have ObsPy work them out for every packet
+        self.float32 = False # hold waveform data in single rather than double precision, from ingest to PGA. Filters still run in double precision
+        self.simulated_clock = False # take the time from packet timestamps rather than the wall clock, e.g. to replay realtime behaviour. See SimulatedClock
         for param in params:
             setattr(self, param, params[param])
+        self.dtype = np.float32 if self.float32 else np.float64
+        self.clock = SimulatedClock(self.starttime) if self.simulated_clock else Clock() # everything that needs the time now asks this
     
         self.network, self.station, self.location, self.channel = params['nslc'].split('.')
 
         if not 'datasource' in params:
             self.datasource = 'default'
 
-        if self.api=='datascope2obspy':
-            from datascope2obspy import DatascopeClient
-            self.client = DatascopeClient(self.datasource, secondsPerPacket=self.secondsPerPacket, starttime=self.starttime, mode=self.mode)
-
-        elif self.api=='orb2obspy':
-            from orb2obspy import OrbserverClient
-            self.client = OrbserverClient(self.datasource, starttime=self.starttime, nslc=params['nslc'])
-
-        elif self.api=='slink2obspy':
-            from slink2obspy import SlinkClient
-            self.client = SlinkClient(self.datasource)
+        # resume from where we got to last time, if there is a recent checkpoint for this station
+        self.checkpointfile = os.path.join(self.checkpointdir or self.outputdir, f'checkpoint_{self.station}.pkl')
+        self.last_checkpoint_ns = None
+        self.resumed_state = None
+        if self.mode == 'realtime' and self.checkpoint_seconds > 0:
+            self.resumed_state = self.load_checkpoint()
+            if self.resumed_state:
+                self.starttime = self.resumed_state['nextpacketstarttime']
+
+        if self.redundant_datasource and self.mode == 'realtime':
+            from hedged2obspy import HedgedClient
+            self.client = HedgedClient([self.create_client(self.datasource), self.create_client(self.redundant_datasource)], \
+                                       names=[self.datasource, self.redundant_datasource], read_timeout=self.read_timeout, \
+                                       max_reconnect_backoff=self.max_reconnect_backoff)
+        else:
+            self.client = self.create_client(self.datasource)
         self.client.select_stream(self.network, self.station, self.location, self.channel) 
 
         if self.benchmark:
@@ -55,12 +116,32 @@ class RealTimeDataClient(object):
                                       maximum_latency=self.maximum_latency, \
                                       email_list=self.email_list, \
                                       outputdir=self.outputdir, \
-                                      alarm_timeout=self.latency_alarm_timeout) # creates a latency object
+                                      alarm_timeout=self.latency_alarm_timeout, \
+                                      clock=self.clock) # creates a latency object
         self.duration = self.endtime - self.starttime
 
-        ### The following line relate to using a waveform packet - which is just a Stream object ###
+        ### The following line relate to using a waveform packet - a list of ChannelBlocks, one per SEED id ###
         self.currentPacket = None
         self.npackets = 0
+
+        ### gap detection, by sample time for each SEED id, and by SeedLink sequence number for each station ###
+        self.last_endtime = {} # seed_id -> endtime of last packet, in ns
+        self.last_seqnum = {} # net.sta -> last SeedLink sequence number
+        self.gaps = {} # seed_id -> {'gaps', 'missing_seconds', 'backfilled_seconds'}
+        self.missing_records = {} # net.sta -> number of SeedLink records missing from the sequence
+        self.gapsfile = os.path.join(self.outputdir, f'gaps_{self.station}.csv')
+        self.backfill_client = None
+        self.resequencer = None # archive data are read in time order
+        if self.mode == 'realtime' and self.max_hold_seconds > 0:
+            self.resequencer = Resequencer(max_hold_seconds=self.max_hold_seconds, clock=self.clock)
+        self.catchup_remainder = None # raw data left over from the last catch-up batch, which did not fill a secondsPerPacket window
+        self.watchdog = None # StallWatchdog, running only while run() is
+        if self.quiet_gate and self.remove_instrument_response: # the quiet path can bound the filter, but not the response correction
+            print(f'{self.station}: quiet gate off, because remove_instrument_response is on')
+            self.quiet_gate = False
+        self.quietGate = QuietGate(self.sta_seconds, self.lta_seconds, self.trigger_ratio, filterdef=self.filterdef) if self.quiet_gate else None
+        self.gains = {} # seed_id -> overall sensitivity from the inventory, for the quiet path
+        self.processingCache = ProcessingCache(self.processing_cache_size) if self.processing_cache_size > 0 else None
         
         ### end of packet stuff ### 
 
@@ -76,7 +157,7 @@ class RealTimeDataClient(object):
         # calibration information
         self.inventory = None
         self.response_update_interval = 600 # update every 600 seconds
-        self.response_last_update_time = None
+        self.response_last_update_ns = None
        
         # show all attributes?
         if self.verbose:
@@ -84,6 +165,27 @@ class RealTimeDataClient(object):
             for key, value in vars(self).items():
                 print(key, '\t', value)
     
+    def create_client(self, datasource):
+        ''' create a client for datasource, using the api requested '''
+        if self.api=='datascope2obspy':
+            from datascope2obspy import DatascopeClient
+            client = DatascopeClient(datasource, secondsPerPacket=self.secondsPerPacket, starttime=self.starttime, mode=self.mode, \
+                                     endtime=self.endtime, readahead_packets=self.readahead_packets, read_timeout=self.read_timeout)
+
+        elif self.api=='orb2obspy':
+            from orb2obspy import OrbserverClient
+            client = OrbserverClient(datasource, starttime=self.starttime, nslc=self.nslc, timeoutsecs=self.read_timeout, \
+                                     max_reconnect_backoff=self.max_reconnect_backoff)
+
+        elif self.api=='slink2obspy':
+            from slink2obspy import SlinkClient
+            if self.resumed_state: # SeedLink can resume from the sequence number of the last packet, or failing that, from a time
+                client = SlinkClient(datasource, starttime=self.starttime, seqnum=self.resumed_state['seqnum'], \
+                                     read_timeout=self.read_timeout, max_reconnect_backoff=self.max_reconnect_backoff)
+            else:
+                client = SlinkClient(datasource, read_timeout=self.read_timeout, max_reconnect_backoff=self.max_reconnect_backoff)
+        return client
+
     def process(self): # handle bad data in packet directly & bufferSecs
 
         packet_processed = False # return value used to know if we should analyze() packet once exiting this function
@@ -92,7 +194,7 @@ class RealTimeDataClient(object):
 
         # do we want to load/reload Inventory yet - or just use what we've cached. we cache to save time, but reload periodically in case stationXML file changes
         update_now = True # mechanism to update/reload responses every response_update_interval seconds
-        if not self.response_last_update_time or (obspy.UTCDateTime() < self.response_last_update_time + self.response_update_interval):
+        if self.response_last_update_ns is None or (self.clock.now_ns() < self.response_last_update_ns + int(self.response_update_interval * 1e9)):
             update_now = False
 
         ### This section only used if using a buffer to stabilize detrending/filtering ###
@@ -104,11 +206,8 @@ class RealTimeDataClient(object):
                 
             ### Initialize or update the buffer by appending the new calibrated packet
             if isinstance(self.currentBuffer, Buffer):
-                # clear procesing list of Buffer so it doesn't grow too large
-                for tr in self.currentBuffer.raw:
-                    tr.stats['processing']=[]
-                packet_endtime = max([tr.stats.endtime for tr in self.currentPacket])
-                buffer_starttime = min([tr.stats.starttime for tr in self.currentBuffer.raw])
+                packet_endtime = max([block.end_ns for block in self.currentPacket])
+                buffer_starttime = min([block.start_ns for block in self.currentBuffer.blocks.values()])
                 if (packet_endtime > buffer_starttime):
                     '''  
                     packet can be merged to buffer without gap at buffer start
@@ -119,25 +218,38 @@ class RealTimeDataClient(object):
                     '''
                     detached_packet = False
                     try:
-                        self.currentBuffer.raw = (self.currentBuffer.raw + self.currentPacket).merge(method=1, fill_value='interpolate', interpolation_samples=0) # not sure we want to interpolate the raw buffer. maybe just the tmp buffer.
+                        self.currentBuffer.append(self.currentPacket) # not sure we want to interpolate the raw buffer. maybe just the tmp buffer.
                     except Exception as e:
                         print('Failed to merge. Do we have different data types?')
                         print('BUFFER')
-                        for tr in self.currentBuffer.raw:
-                            print(f'id={tr.id}, type={tr.data.dtype}')
+                        for block in self.currentBuffer.blocks.values():
+                            print(f'id={block.seed_id}, type={block.data.dtype}')
                         print('PACKET')
-                        for tr in self.currentPacket:
-                            print(f'id={tr.id}, type={tr.data.dtype}')
+                        for block in self.currentPacket:
+                            print(f'id={block.seed_id}, type={block.data.dtype}')
                         raise e
                     self.update_timings('buffer_update')
                 else: # since detached_packet still set to True, this will be handled by logic below
                     pass
             else: # Create buffer from current packet
-                self.currentBuffer = Buffer(self.currentPacket, self.filterdef, bufferSecs=self.bufferSecs) # create new buffer
+                self.currentBuffer = Buffer(self.currentPacket, self.filterdef, bufferSecs=self.bufferSecs, cache=self.processingCache) # create new buffer
                 self.update_timings('buffer_setup')
 
+        # the STA/LTA has to see every packet, so it carries on from one to the next whichever path the packet takes
+        quiet_data = None
+        if self.quietGate:
+            quiet_data = self.quietGate.update(self.currentPacket, self.get_gains(self.currentPacket), self.quiet_level)
+            self.update_timings('quiet_gate')
+            if quiet_data and not self.allow_quiet():
+                quiet_data = None
+            self.quietGate.count(quiet_data)
+
         if detached_packet: # process current packet without buffering
             packet_processed = self.process_detached_packet(update_now)
+
+        elif quiet_data: # quiet packet: the buffer only needs the raw data, for when the full path is next needed
+            packet_processed = self.process_quiet_packet(quiet_data)
+            self.currentBuffer.trim2seconds()
         
         else: # process current packet with buffering
             if self.verbose:
@@ -146,32 +258,29 @@ class RealTimeDataClient(object):
             ### If we have not appended enough packets yet to fill the calibrated buffer    ###
             ### detrending & filtering could produce odd results. So the tmp buffer, which  ### 
             ### is used for processing, is kept None until calibrated buffer is full        ###
-            s = self.currentBuffer.raw[0].stats
-            currentBufferSecs = s.endtime - s.starttime + s.delta
+            currentBufferSecs = self.currentBuffer.seconds()
             if self.verbose and currentBufferSecs >= self.bufferSecs: # buffer full
                 print('buffer is full')
             if currentBufferSecs > 0.0: # SCAFFOLD process regardless of buffer length
-                self.currentBuffer.tmp = self.currentBuffer.raw.copy()
                 buffer_filtered = self.currentBuffer.filter()
                 if buffer_filtered:
                     self.update_timings('buffer_filtering')
 
                     # apply calibration correction to waveform data in the tmp buffer 
-                    success = self.calibrate_Stream(self.currentBuffer.tmp, update=update_now)
+                    success = self.calibrate_blocks(self.currentBuffer.tmp.values(), update=update_now)
                     self.update_timings('calibrate')
                     if not success:
                         IOError('Failed to calibrate buffer')
 
                     if self.verbose:
-                        print('RAW BUFFER\n', self.currentBuffer.raw)
+                        print('RAW BUFFER\n', list(self.currentBuffer.blocks.values()))
 
                     ### Update the current packet from the correct portion of the filtered buffer ###
                     self.currentPacket = self.currentBuffer.trim2packet(self.currentPacket)
                     self.update_timings('buffer_trim2packet') 
-                    s = self.currentPacket[0].stats
-                    stime = min([tr.stats.starttime for tr in self.currentPacket])
-                    etime = max([tr.stats.endtime for tr in self.currentPacket])
-                    if etime - stime > self.currentPacket[0].stats.delta: # otherwise we probably got no data
+                    stime = min([block.start_ns for block in self.currentPacket])
+                    etime = max([block.end_ns for block in self.currentPacket])
+                    if etime - stime > self.currentPacket[0].delta_ns: # otherwise we probably got no data
                         packet_processed = True
                 
                 else:
@@ -179,17 +288,43 @@ class RealTimeDataClient(object):
                 self.currentBuffer.trim2seconds() # trims calibrated data buffer back to self.bufferSecs (=self.CurrentBuffer.bufferSecs)
             elif self.verbose:
                 print(f'buffer length now: {currentBufferSecs} seconds. Analysis will start when it reaches ({self.bufferSecs} seconds)')
-                self.currentBuffer.print()
+                print(list(self.currentBuffer.blocks.values()))
         return packet_processed
 
     def process_detached_packet(self, update_now):
         if self.verbose:
             print('Detached packet')
-        self.currentPacket.detrend('constant')
-        self.calibrate_Stream(self.currentPacket, update=update_now, pre_filt=None)
+        signal = lazy_import('scipy.signal')
+        for block in self.currentPacket: # as Trace.detrend('constant')
+            block.data = signal.detrend(block.data, type='constant')
+        self.calibrate_blocks(self.currentPacket, update=update_now, pre_filt=None)
         self.update_timings('calibrate')
         return True
 
+    def process_quiet_packet(self, quiet_data):
+        ''' the quiet path: rather than detrending, filtering and calibrating the whole buffer, the current packet is just 
+        the raw counts minus their running mean (from the QuietGate), divided by the gain '''
+        for block in self.currentPacket:
+            block.data = (quiet_data[block.seed_id] / self.gains[block.seed_id]).astype(self.dtype)
+        self.update_timings('quiet_packet')
+        return True
+
+    def get_gains(self, packet):
+        ''' the overall sensitivity of each ChannelBlock in packet, from the inventory (seed_id -> gain). Blocks with no response are 
+        left out, as is everything until calibrate_blocks() has loaded the inventory '''
+        if self.inventory:
+            for block in packet:
+                if not block.seed_id in self.gains:
+                    try:
+                        self.gains[block.seed_id] = self.inventory.get_response(block.seed_id, to_utc(block.start_ns)).instrument_sensitivity.value
+                    except Exception:
+                        continue
+        return self.gains
+
+    def allow_quiet(self):
+        ''' subclasses can veto the quiet path, e.g. threshold_monitor.py does while any channel is above a threshold '''
+        return True
+
     def analyze(self):
         pass
 
@@ -204,10 +339,8 @@ class RealTimeDataClient(object):
             self.update_timings('updating_latency')
         return packet_is_late
 
-    def calibrate_Stream(self, st, update=False, pre_filt=None):
-        calibrated = False
-
-        # get or update inventory
+    def load_inventory(self, update=False):
+        ''' read the inventory, if it has not been read yet, or if an update is due '''
         if not self.inventory or update:
             try:
                 #self.inventory = obspy.read_inventory(os.path.join(os.getenv('HOME'), 'pipeline', self.xmlfile), format='STATIONXML') #, level='response')
@@ -215,72 +348,264 @@ class RealTimeDataClient(object):
             except:
                 raise IOError(f'Could not read inventory {self.xmlfile} from current directory {os.getcwd()}')
             else:
-                self.response_last_update_time = obspy.UTCDateTime()
+                self.response_last_update_ns = self.clock.now_ns()
+                self.gains = {}
+                if self.processingCache: # responses may have changed, even within the same epochs
+                    self.processingCache.set_inventory(self.inventory)
+
+    def calibrate_blocks(self, blocks, update=False, pre_filt=None):
+        '''
+        Calibrates the data of each ChannelBlock in blocks, in place: removes the full instrument response if remove_instrument_response 
+        is set (with cached spectra if there is a processing cache, otherwise with ObsPy), or else just divides by the overall sensitivity 
+        (same as calib), from Counts to m/s^2. Without a response, a block is left as it is. Returns False if any response could not 
+        be removed
+        '''
+        calibrated = True
+
+        # get or update inventory
+        self.load_inventory(update)
+
+        for block in blocks:
+            starttime = to_utc(block.start_ns)
+            try:
+                response = self.inventory.get_response(block.seed_id, starttime)
+            except Exception: # no response for this block, which Stream.attach_response() would just warn about
+                continue
+            try:
+                if self.remove_instrument_response and self.processingCache and self.processingCache.cacheable(response):
+                    block.data = self.processingCache.remove_response_data(block.data, block.seed_id, block.sampling_rate, starttime, response, \
+                                                                           pre_filt=pre_filt, output='ACC')
+                elif self.remove_instrument_response: # full instrument response removal by ObsPy
+                    tr = block.to_trace()
+                    tr.stats.response = response
+                    tr.remove_response(pre_filt=pre_filt, output='ACC')
+                    block.data = tr.data.astype(self.dtype, copy=False) # ObsPy always returns double precision
+                else: # calibration correction only from Counts to m/s^2 requested
+                    block.data /= response.instrument_sensitivity.value
+            except Exception:
+                print(f'Failed to remove response for {block.seed_id}')
+                calibrated = False
+
+        return calibrated
 
-        # attach response for each Trace in Stream        
+    def calibrate_windows(self, X, block, starttime):
+        '''
+        calibrate_blocks() for windows of the data of ChannelBlock block that were processed together, one per row of the 2-D array X. 
+        The response is looked up once, for starttime, and the gain, or the cached response spectrum, is applied to every row at once. 
+        Returns the calibrated windows, or X itself if the response could not be found
+        '''
+        self.load_inventory(update=not self.inventory)
         try:
-            st.attach_response(self.inventory)
+            response = self.inventory.get_response(block.seed_id, starttime)
         except:
             print('Failed to attach response')
-
-        # remove response, or calibrate waveform data in each Trace
+            return X
         try:
-            if self.remove_instrument_response: # full instrument response removal requested
-                st.remove_response(pre_filt=pre_filt, output='ACC')
-            else: # calibration correction only from Counts to m/s^2 requested
-                for tr in st:
-                    if 'response' in tr.stats:
-                        gain = tr.stats.response.instrument_sensitivity.value
-                        tr.data /= gain                
+            if self.remove_instrument_response and self.processingCache and self.processingCache.cacheable(response):
+                return self.processingCache.remove_response_data(X, block.seed_id, block.sampling_rate, starttime, response, output='ACC')
+            elif self.remove_instrument_response:
+                rows = []
+                for x in X:
+                    row = ChannelBlock(block.seed_id, starttime.ns, block.sampling_rate, x.copy()).to_trace()
+                    row.stats.response = response
+                    row.remove_response(pre_filt=None, output='ACC')
+                    rows.append(row.data.astype(self.dtype, copy=False))
+                return np.array(rows)
+            else:
+                return X / response.instrument_sensitivity.value
         except:
             print('Failed to remove response')
-        else:
-            calibrated = True
-
-        return calibrated
+            return X
 
     def updateCurrentPacket(self): 
         got_new_packet = False
-        st = self.client.nextpacket2Stream(starttime=self.nextpacketstarttime, verbose=self.verbose) # starttime only used in datascope2obspy
-        for tr in st: # merge interpolation can fail without recasting int64 to float
-            tr.data = tr.data.astype(float)
-        self.nextpacketstarttime = min([tr.stats.endtime for tr in st]) # update so next call to datascope2obspy will not repeat same time range
+        try:
+            packet = self.client.nextpacket2Blocks(starttime_ns=self.nextpacketstarttime, verbose=self.verbose) # starttime only used in datascope2obspy
+        except TimeoutError as e: # no packet within read_timeout. the client reconnects itself, and the watchdog raises the alarm if this goes on
+            print(f'{self.station}: {e}')
+            return got_new_packet
+        self.clock.observe(packet)
+        if self.watchdog:
+            self.watchdog.feed()
+        for block in packet: # merge interpolation can fail without recasting int64 to float
+            block.data = block.data.astype(self.dtype)
+        self.nextpacketstarttime = min([block.end_ns for block in packet]) # in ns. update so next call to datascope2obspy will not repeat same time range
+        if self.resequencer: # put packets back in time order for each SEED id, dropping duplicates. may hold some blocks back
+            self.update_timings('nextpacket2Stream')
+            packet = self.resequencer.push(packet)
+            self.update_timings('resequence')
         if self.verbose:
-            print(f'RAW_PACKET: seconds = {self.secondsPerPacket:.02f}, Traces = {len(st)}')
-            print(f'Stream={st}')       
+            print(f'RAW_PACKET: seconds = {self.secondsPerPacket:.02f}, blocks = {len(packet)}')
+            print(f'packet={packet}')       
 
-        # remove any Trace objects without valid data (just NaN or Inf or empty), and fill any remaining missing or Inf values with median (will not affect PGA, but could affect other measurement types)
-        for tr in st:
-            if not(np.any(np.isfinite(tr.data))):
-                st.remove(tr)
-            else:
-                value = np.nanmedian(tr.data)
-                tr.data = np.nan_to_num(tr.data, nan=value, posinf=value, neginf=value)                 
+        self.remove_bad_data(packet)
 
-        if len(st)>0: 
-            self.currentPacket = st
+        if len(packet)>0: 
+            self.currentPacket = packet
             got_new_packet = True
         self.update_timings('nextpacket2Stream')
         return got_new_packet
+
+    def flush_resequencer(self):
+        ''' once the run has read up to endtime, release whatever the resequencer is still holding (the next run of blocks for each 
+        SEED id) as the current packet, rather than waiting for packets after endtime '''
+        packet = self.resequencer.flush() if self.resequencer else []
+        self.remove_bad_data(packet)
+        if len(packet) > 0:
+            self.currentPacket = packet
+            return True
+        return False
+
+    def remove_bad_data(self, packet):
+        ''' remove any ChannelBlocks without valid data (just NaN or Inf or empty) from the list packet, and fill any remaining missing
+        or Inf values with median (will not affect PGA, but could affect other measurement types) '''
+        packet[:] = [block for block in packet if np.any(np.isfinite(block.data))]
+        for block in packet:
+            value = np.nanmedian(block.data)
+            block.data = np.nan_to_num(block.data, nan=value, posinf=value, neginf=value)                 
+
+    def detect_gaps(self, packet):
+        '''
+        Compares each ChannelBlock in a new packet with the last packet for the same SEED id, and returns a list of (seed_id, gapstart, 
+        gapend, delta), all in ns, for any gaps between them (ignoring overlaps, i.e. old or repeated packets). Also counts SeedLink records missing 
+        from the sequence numbers of each station. SeedLink sequence numbers are 24-bit, so they wrap around.
+        Each gap is counted in self.gaps and appended to gaps_<station>.csv.
+        '''
+        gaps = []
+        for block in packet:
+            seed_id = block.seed_id
+            delta = block.delta_ns
+            if seed_id in self.last_endtime:
+                gapstart = self.last_endtime[seed_id] + delta
+                gapend = block.start_ns - delta
+                if gapend - gapstart > -delta // 2: # at least one sample missing
+                    gaps.append((seed_id, gapstart, gapend, delta))
+            self.last_endtime[seed_id] = max([block.end_ns, self.last_endtime.get(seed_id, block.end_ns)])
+
+        for seqnum in sorted(set([block.seqnum for block in packet if block.seqnum is not None])):
+            netsta = f'{self.network}.{self.station}'
+            if seqnum < 0:
+                continue
+            if netsta in self.last_seqnum:
+                nmissing = (seqnum - self.last_seqnum[netsta] - 1) % 2**24
+                if nmissing < 2**23: # otherwise it is an old packet, not a gap
+                    self.missing_records[netsta] = self.missing_records.get(netsta, 0) + nmissing
+                else:
+                    continue
+            self.last_seqnum[netsta] = seqnum
+
+        for seed_id, gapstart, gapend, delta in gaps:
+            seconds = (gapend - gapstart + delta) / 1e9 # number of missing samples x delta
+            gapstart, gapend = to_utc(gapstart), to_utc(gapend)
+            print(f'Gap of {seconds:.2f} seconds for {seed_id} from {gapstart} to {gapend}')
+            gapinfo = self.gaps.setdefault(seed_id, {'gaps':0, 'missing_seconds':0.0, 'backfilled_seconds':0.0})
+            gapinfo['gaps'] += 1
+            gapinfo['missing_seconds'] += seconds
+            if not os.path.isfile(self.gapsfile):
+                append_to_csvfile(self.gapsfile, 'seed_id,gapstart,gapend,seconds\n')
+            append_to_csvfile(self.gapsfile, f'{seed_id},{gapstart},{gapend},{seconds}\n')
+        self.update_timings('detect_gaps')
+        return gaps
+
+    def fetch_gap_data(self, gaps):
+        ''' Fetches the data missing from gaps found by detect_gaps(). Returns a list of ChannelBlocks, or None if there was nothing to 
+        fetch or it failed '''
+        gaps = [gap for gap in gaps if gap[2] - gap[1] <= self.max_backfill_seconds * 1e9]
+        if not gaps:
+            return None
+        gapstart = to_utc(min([gap[1] for gap in gaps]))
+        gapend = to_utc(max([gap[2] for gap in gaps]))
+        try:
+            if not self.backfill_client:
+                if self.backfill_api == 'datascope2obspy':
+                    from datascope2obspy import DatascopeClient
+                    self.backfill_client = DatascopeClient('default', secondsPerPacket=self.secondsPerPacket, mode='archive')
+                    self.backfill_client.select_stream(self.network, self.station, self.location, self.channel)
+                else:
+                    self.backfill_client = self.client
+            st = self.backfill_client.get_waveforms(gapstart, gapend)
+        except Exception as e:
+            print(f'Could not backfill {self.station} from {gapstart} to {gapend}: {e}')
+            return None
+        blocks = slice_blocks([block for block in stream2blocks(st) if block.seed_id in [gap[0] for gap in gaps]], gapstart.ns, gapend.ns)
+        for block in blocks:
+            block.data = block.data.astype(self.dtype)
+            self.gaps[block.seed_id]['backfilled_seconds'] += np.isfinite(block.data).sum() / block.sampling_rate
+        self.update_timings('backfill_fetch')
+        return blocks
+
+    def backfill(self, gaps):
+        '''
+        Fetches the data missing from gaps found by detect_gaps(), and processes & analyzes it in secondsPerPacket windows, just as if 
+        those packets had arrived, before the packet after the gap is processed. This puts the late data into the buffer, and 
+        re-evaluates the gap (e.g. for PGA) rather than interpolating over it. 
+        '''
+        blocks = self.fetch_gap_data(gaps)
+        if not blocks:
+            return
+        gapstart = min([block.start_ns for block in blocks])
+        gapend = max([block.end_ns for block in blocks])
+        packet_ns = int(round(self.secondsPerPacket * 1e9))
+        packet_after_gap = self.currentPacket
+        packetstarttime = gapstart
+        while packetstarttime <= gapend:
+            self.currentPacket = slice_blocks(blocks, packetstarttime, min([packetstarttime + packet_ns, gapend]))
+            self.remove_bad_data(self.currentPacket)
+            if len(self.currentPacket) > 0:
+                self.npackets += 1
+                if self.process():
+                    self.analyze()
+            packetstarttime += packet_ns
+        self.currentPacket = packet_after_gap
+        self.update_timings('backfill_analyze')
             
     def run(self):
 
+        if self.mode == 'archive' and self.api == 'datascope2obspy' and self.archive_chunk_seconds > 0:
+            self.run_archive()
+            return
+
         if self.verbose:
-            print('Date: ', obspy.UTCDateTime().strftime('%Y-%m-%d'))
-            print('Time now: ', obspy.UTCDateTime().strftime('%H:%M:%S'))
+            print('Date: ', self.clock.now().strftime('%Y-%m-%d'))
+            print('Time now: ', self.clock.now().strftime('%H:%M:%S'))
             print(f'Will attempt to load data from {self.starttime.strftime("%H:%M:%S")} to {self.endtime.strftime("%H:%M:%S")}')
             msg = f'Loading {self.duration} seconds of data for {self.station} {self.channel} from {self.datasource} using {self.api}'
             print(msg)  
 
         ############################# Loop over packets ###################
-        self.nextpacketstarttime = self.starttime 
-        while self.nextpacketstarttime < self.endtime:
+        if self.quietGate and self.quiet_level is None: # with no limit on the peak, a slow rise that never triggers the STA/LTA stays quiet
+            print(f'{self.station}: quiet gate off, because quiet_level is not set')
+            self.quietGate = None
+        self.nextpacketstarttime = self.starttime.ns # in ns, like every packet time. See updateCurrentPacket()
+        if self.resumed_state:
+            self.restore_state(self.resumed_state)
+        if self.mode == 'realtime' and self.stall_seconds > 0:
+            self.watchdog = StallWatchdog(self.stall_seconds, self.stalled, clock=self.clock)
+            self.watchdog.start()
+        while self.nextpacketstarttime < self.endtime.ns or (self.resequencer and self.resequencer.holding()):
 
             if self.verbose:
                 print('\n')
             got_new_packet = False
-            while not got_new_packet: # keep looping till the packet Stream is non-empty
-                got_new_packet = self.updateCurrentPacket()
+            while not got_new_packet: # keep looping till the packet is non-empty
+                if self.nextpacketstarttime >= self.endtime.ns: # read up to endtime, so release any held packets rather than read on
+                    got_new_packet = self.flush_resequencer()
+                    if not self.resequencer or not self.resequencer.holding():
+                        break
+                else:
+                    got_new_packet = self.updateCurrentPacket()
+            if not got_new_packet:
+                break
+
+            if self.is_behind():
+                self.catch_up()
+                continue
+            if self.catchup_remainder:
+                self.finish_catch_up()
+
+            gaps = self.detect_gaps(self.currentPacket)
+            if gaps and self.backfill_gaps:
+                self.backfill(gaps)
             
             '''
             We got a new packet. We'll update latency info, process, and analyze the packet.
@@ -291,8 +616,9 @@ class RealTimeDataClient(object):
  
             self.update_timings('load_loop_update')
             packet_is_late = self.update_latency()
-            if packet_is_late: # for example, if maximum_latency = 600, and latency of current packet exceeds that
+            if packet_is_late and not self.catchup_latency: # for example, if maximum_latency = 600, and latency of current packet exceeds that
                 # we should have sent alarm when calling update_latency and now we skip to getting another packet
+                # (unless catch-up is on, in which case late data are still checked)
                 continue
             
             packet_processed = self.process()
@@ -305,14 +631,369 @@ class RealTimeDataClient(object):
                 IOError('Failed to process (and analyze) packet!')
                 #if self.mode == 'archive': # SCAFFOLD to get test alarm /test_alarm_datascope2obspy_202310181904 to work, which is stuck processing same time over and over as a packet has no length after processing
                 #    self.nextpacketstarttime += self.secondsPerPacket
+            self.write_checkpoint()
             if self.verbose:
-                print(f'next packet start time = {self.nextpacketstarttime}')
+                print(f'next packet start time = {to_utc(self.nextpacketstarttime)}')
+        if self.catchup_remainder:
+            self.finish_catch_up()
+        self.write_checkpoint(force=True)
+        self.stop_watchdog()
         ########################### End loop over packets #################
 
+    def stalled(self, seconds, new_stall):
+        ''' called by the StallWatchdog (from its own thread) when no packets have arrived for stall_seconds, 
+        and every stall_seconds after that until they do '''
+        print(f'STALL: no packets from {self.station} for {seconds:.0f} seconds')
+        if self.latency_on:
+            self.latencyObj.stall(self.nslc, seconds, new_stall=new_stall)
+
+    def stop_watchdog(self):
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None # threads cannot be pickled, e.g. to return this object from a worker process
+
+    def is_behind(self):
+        ''' in realtime mode, True if the current packet ended more than catchup_latency seconds ago, i.e. there is a backlog on the server '''
+        if self.mode != 'realtime' or not self.catchup_latency > 0:
+            return False
+        return (self.clock.now_ns() - max([block.end_ns for block in self.currentPacket])) / 1e9 > self.catchup_latency
+
+    def catch_up(self):
+        '''
+        Catch up with a backlog of packets, e.g. after a stall or a restart. Rather than processing one packet at a time, keep reading 
+        packets (which are already waiting on the server, so they come back at once) until we have catchup_batch_seconds of data, or we 
+        are no longer behind. Then detrend, filter and calibrate the batch in one pass, with the buffer in front of it as warm-up, 
+        and analyze every secondsPerPacket window of it, just like a chunk in archive mode (see process_chunk and analyze_chunk). 
+        While we are still behind, only whole windows are analyzed, and any data left over go in front of the next batch. Once we are
+        not, the rest is analyzed too, here or by finish_catch_up().
+        Latency is still tracked for each packet, and gaps are still detected (and backfilled, if requested) within the batch.
+        Finally the buffer is updated from the batch, so normal packet processing can carry on where the batch ended.
+        '''
+        batch = []
+        while True:
+            packet = self.currentPacket
+            gaps = self.detect_gaps(packet)
+            if gaps and self.backfill_gaps:
+                gap_blocks = self.fetch_gap_data(gaps)
+                if gap_blocks:
+                    batch += gap_blocks
+            self.update_latency()
+            batch += packet
+            batchseconds = (max([block.end_ns for block in batch]) - min([block.start_ns for block in batch])) / 1e9
+            caught_up = self.nextpacketstarttime >= self.endtime.ns or not self.is_behind()
+            if batchseconds >= self.catchup_batch_seconds or caught_up:
+                break
+            got_new_packet = False
+            while not got_new_packet:
+                got_new_packet = self.updateCurrentPacket()
+        batch = merge_blocks(batch)
+        self.update_timings('catchup_read_batch')
+        if self.verbose:
+            print(f'Catching up: processing {batchseconds:.1f} seconds of data in one batch')
+
+        # analyze whole secondsPerPacket windows only, unless we have caught up. any data left over are analyzed with the next batch
+        unanalyzed = batch
+        if self.catchup_remainder:
+            unanalyzed = merge_blocks(self.catchup_remainder + unanalyzed)
+            self.catchup_remainder = None
+        chunkstarttime = to_utc(min([block.start_ns for block in unanalyzed]))
+        batchendtime = to_utc(max([block.end_ns + block.delta_ns for block in unanalyzed]))
+        chunkendtime = chunkstarttime + self.secondsPerPacket * int((batchendtime - chunkstarttime) / self.secondsPerPacket + 1e-6)
+        if caught_up or chunkendtime <= chunkstarttime:
+            chunkendtime = batchendtime
+        if chunkendtime < batchendtime:
+            self.catchup_remainder = [block.copy() for block in slice_blocks(unanalyzed, start_ns=chunkendtime.ns)]
+        self.analyze_batch(unanalyzed, chunkstarttime, chunkendtime)
+
+        # carry on from the end of the batch
+        if self.bufferSecs > 0.0:
+            if isinstance(self.currentBuffer, Buffer):
+                self.currentBuffer.append(batch)
+            else:
+                self.currentBuffer = Buffer(batch, self.filterdef, bufferSecs=self.bufferSecs, cache=self.processingCache)
+            self.currentBuffer.trim2seconds()
+        self.write_checkpoint()
+
+    def finish_catch_up(self):
+        ''' analyze the data left over from the last catch-up batch, now that packets are no longer behind, or the run has ended '''
+        remainder = self.catchup_remainder
+        self.catchup_remainder = None
+        chunkstarttime = to_utc(min([block.start_ns for block in remainder]))
+        chunkendtime = to_utc(max([block.end_ns + block.delta_ns for block in remainder]))
+        packet = self.currentPacket # analyze_chunk() replaces it with each window in turn
+        self.analyze_batch(remainder, chunkstarttime, chunkendtime)
+        self.currentPacket = packet
+
+    def analyze_batch(self, batch, chunkstarttime, chunkendtime):
+        ''' process and analyze a catch-up batch from chunkstarttime to chunkendtime, with the buffer in front of it as warm-up for the filter '''
+        if isinstance(self.currentBuffer, Buffer):
+            blocks = merge_blocks(list(self.currentBuffer.blocks.values()) + batch)
+        else:
+            blocks = [block.copy() for block in batch]
+        if self.process_chunk(blocks, chunkstarttime, chunkendtime):
+            self.analyze_chunk(blocks, chunkstarttime, chunkendtime)
+            self.update_timings('catchup_analyze_batch')
+
+    def checkpoint_state(self):
+        '''
+        The state to save in a checkpoint: where we are in the data stream (the end time of the last packet, and its sequence 
+        number if the client provides one), and the raw buffer, as a list of ChannelBlocks. The raw buffer is all the filter state there
+        is, since the whole buffer is filtered again for each packet. Subclasses add their own state to this dict.
+        '''
+        return {'nslc': self.nslc,
+                'nextpacketstarttime': to_utc(self.nextpacketstarttime),
+                'seqnum': self.last_seqnum.get(f'{self.network}.{self.station}', -1), # not from currentPacket, which loses it in processing
+                'buffer': list(self.currentBuffer.blocks.values()) if isinstance(self.currentBuffer, Buffer) else None}
+
+    def restore_state(self, state):
+        ''' restore the state saved by checkpoint_state(), so that analysis can resume with the next packet, rather than waiting for the buffer to fill '''
+        if state['seqnum'] >= 0: # so records missed while we were down are counted
+            self.last_seqnum[f'{self.network}.{self.station}'] = state['seqnum']
+        if state['buffer']:
+            buffer = state['buffer']
+            if isinstance(buffer, obspy.Stream): # a checkpoint from before buffers were kept as ChannelBlocks
+                buffer = stream2blocks(buffer)
+            self.currentBuffer = Buffer(buffer, self.filterdef, bufferSecs=self.bufferSecs, cache=self.processingCache)
+
+    def write_checkpoint(self, force=False):
+        ''' 
+        In realtime mode, save checkpoint_state() every checkpoint_seconds (or now, if force=True). The checkpoint is written to a 
+        temporary file which is then renamed over the old one, so a crash never leaves a half-written checkpoint behind.
+        '''
+        if self.mode != 'realtime' or not self.checkpoint_seconds > 0:
+            return
+        now = self.clock.now_ns()
+        if not force and self.last_checkpoint_ns is not None and now < self.last_checkpoint_ns + int(self.checkpoint_seconds * 1e9):
+            return
+        tmpfile = self.checkpointfile + '.tmp'
+        with open(tmpfile, 'wb') as fptr:
+            pickle.dump(self.checkpoint_state(), fptr)
+            fptr.flush()
+            os.fsync(fptr.fileno())
+        os.replace(tmpfile, self.checkpointfile)
+        self.last_checkpoint_ns = now
+        self.update_timings('checkpoint')
+
+    def load_checkpoint(self):
+        ''' Returns the state saved in this station's checkpoint, or None if there is no checkpoint, it is for a different nslc, 
+        or it is older than max_checkpoint_age '''
+        if not os.path.isfile(self.checkpointfile):
+            return None
+        try:
+            with open(self.checkpointfile, 'rb') as fptr:
+                state = pickle.load(fptr)
+        except Exception as e:
+            print(f'Could not read checkpoint {self.checkpointfile}: {e}')
+            return None
+        if state.get('nslc') != self.nslc or state['nextpacketstarttime'] < self.clock.now() - self.max_checkpoint_age:
+            return None
+        print(f'Resuming {self.nslc} from checkpoint at {state["nextpacketstarttime"]}')
+        return state
+
+    def run_archive(self):
+        '''
+        High-throughput alternative to run() for archive mode. Rather than reading, filtering and analyzing one packet at a time,
+        we read archive_chunk_seconds of data at a time, detrend/filter/calibrate every packet of the chunk at once, and then call 
+        analyze_chunk(), which analyzes every secondsPerPacket window in the chunk, just as if it had arrived as a packet. Gaps in 
+        each chunk are counted and logged by detect_gaps(), as in the packet loop, but not backfilled, as there is nothing more to read.
+        Each chunk is read with bufferSecs of data in front of it (the end of the previous chunk), since each packet is processed 
+        with the buffer in front of it, as in the packet path. See read_chunks() for how the reads overlap with the processing.
+        '''
+        if self.verbose:
+            print(f'Archive mode: processing {self.duration} seconds of data in chunks of {self.archive_chunk_seconds} seconds')
+
+        chunk_seconds = max([self.archive_chunk_seconds, self.secondsPerPacket])
+        chunk_seconds = round(chunk_seconds / self.secondsPerPacket) * self.secondsPerPacket # a whole number of packets per chunk
+        for chunkstarttime, chunkendtime, blocks in self.read_chunks(chunk_seconds):
+            self.update_timings('archive_read_chunk')
+            self.detect_gaps(finite_runs(slice_blocks(blocks, start_ns=chunkstarttime.ns))) # the buffer in front was checked with the chunk before
+            if self.process_chunk(blocks, chunkstarttime, chunkendtime):
+                self.analyze_chunk(blocks, chunkstarttime, chunkendtime)
+                self.update_timings('archive_analyze_chunk')
+
+    def read_chunks(self, chunk_seconds):
+        '''
+        Yields (chunkstarttime, chunkendtime, list of ChannelBlocks) for each chunk_seconds chunk from starttime to endtime, each read from bufferSecs
+        before chunkstarttime (but not before starttime). If readahead_packets > 0, the chunks are read in a background thread, 
+        one chunk ahead, so the next chunk is being read from disk while the current one is processed
+        '''
+        chunks = []
+        chunkstarttime = self.starttime
+        while chunkstarttime < self.endtime:
+            chunks.append((chunkstarttime, min([chunkstarttime + chunk_seconds, self.endtime])))
+            chunkstarttime = chunks[-1][1]
+
+        def read(chunkstarttime, chunkendtime):
+            return stream2blocks(self.client.get_waveforms(max([self.starttime, chunkstarttime - self.bufferSecs]), chunkendtime))
+
+        if self.readahead_packets <= 0:
+            for chunkstarttime, chunkendtime in chunks:
+                yield chunkstarttime, chunkendtime, read(chunkstarttime, chunkendtime)
+            return
+
+        # the thread and queue are local, not attributes, so the client can still be pickled
+        chunk_queue = queue.Queue(maxsize=1) # the next chunk waits here, while the reader is already reading the one after
+        stop = threading.Event()
+        def reader():
+            for chunkstarttime, chunkendtime in chunks:
+                try:
+                    item = (chunkstarttime, chunkendtime, read(chunkstarttime, chunkendtime))
+                except Exception as e: # raised again in the main thread
+                    item = e
+                while not stop.is_set():
+                    try:
+                        chunk_queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set() or isinstance(item, Exception):
+                    return
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            for chunk in chunks:
+                item = chunk_queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def process_chunk(self, blocks, chunkstarttime, chunkendtime):
+        '''
+        Detrend, filter and calibrate each secondsPerPacket packet of a chunk of archive data, with the same result as the packet loop.
+        There, each packet (which ends with the first sample of the next) is appended to the buffer, and the whole buffer is detrended, 
+        padded, tapered, filtered and calibrated, before the packet is trimmed back out of it. Here, the buffer each packet would have 
+        been processed in is a row of a 2-D array (a view of the chunk), and rows of the same length are processed together. 
+        As in the packet loop, the first packet of the run is just demeaned and calibrated, and missing samples are filled as 
+        fill_packets() describes. blocks (a list of ChannelBlocks) must start bufferSecs before chunkstarttime, or at the start of the run.
+
+        The data of each block are then replaced by the processed data from chunkstarttime to chunkendtime inclusive, each sample as 
+        processed with the first packet it belongs to, so the first sample of each packet is the last sample of the packet before. 
+        block.packet_starts holds the first sample of each packet as processed with its own packet, and block.nan_mask marks the 
+        samples that were missing. chunk_packets() puts each packet back together from these. Blocks with no data are removed. 
+        '''
+        signal = lazy_import('scipy.signal')
+        sliding_window_view = np.lib.stride_tricks.sliding_window_view
+        nwin = int(np.ceil((chunkendtime - chunkstarttime) / self.secondsPerPacket - 1e-6)) # packets in the chunk
+        for block in list(blocks): # not blocks itself, which we remove blocks from
+            sampling_rate = block.sampling_rate
+            nper = int(round(self.secondsPerPacket * sampling_rate)) # samples per packet, besides the first sample of the next
+            nbuffer = int(round(self.bufferSecs * sampling_rate))
+            first = int(round((chunkstarttime.ns - block.start_ns) / 1e9 * sampling_rate)) # the first sample of the chunk
+            runstart = int(round((self.starttime.ns - block.start_ns) / 1e9 * sampling_rate)) # the first sample of the run
+
+            # samples outside the block are missing, just as for packets
+            lead = max([0, -first])
+            trail = max([0, first + nwin * nper + 1 - block.npts])
+            raw = np.concatenate((np.full(lead, np.nan), block.data, np.full(trail, np.nan))).astype(self.dtype)
+            first, runstart = first + lead, runstart + lead
+            data = fill_packets(raw, first, nper)
+            if data is None:
+                blocks.remove(block)
+                continue
+
+            # the last sample of each packet, and the first sample of the buffer it was processed in. That goes back bufferSecs from the 
+            # end of the last packet with data, which was not the packet before if that had no data, and not before the run started. 
+            # The first packet of the run with data is processed on its own, as are all packets without a buffer
+            ends = first + nper * np.arange(1, nwin + 1)
+            k0 = first % nper # the first sample of the first whole packet of the block
+            packet_ends = np.arange(k0 + nper, len(raw), nper)
+            has_data = ~sliding_window_view(~np.isfinite(raw), nper + 1)[k0::nper][0:len(packet_ends)].all(axis=1) & (packet_ends - nper >= runstart)
+            last_end = np.maximum.accumulate(np.where(has_data, packet_ends, -1))
+            previous_ends = np.concatenate(([-1], last_end))[(ends - k0) // nper - 1] # of the last packet with data before each packet
+            buffer_start = packet_ends[np.argmax(has_data)] - nper if runstart >= 0 and has_data.any() else max([runstart, 0])
+            detached = ((previous_ends < 0) & (runstart >= 0)) | (self.bufferSecs <= 0.0)
+            starts = np.where(detached, ends - nper, np.maximum(buffer_start, previous_ends - nbuffer))
+            processed = np.empty((nwin, nper + 1), dtype=self.dtype)
+            for npts, detach in set(zip((ends - starts + 1).tolist(), detached.tolist())):
+                rows = np.flatnonzero((ends - starts + 1 == npts) & (detached == detach))
+                for batch in np.array_split(rows, int(np.ceil(len(rows) / 256))): # bounds the memory used
+                    X = sliding_window_view(data, npts)[starts[batch]]
+                    if detach: # as process_detached_packet()
+                        X = signal.detrend(X, type='constant', axis=1).astype(self.dtype, copy=False)
+                    else:
+                        X = self.filter_windows(X, sampling_rate)
+                    t0 = to_utc(block.start_ns + (starts[batch[0]] - lead) * block.delta_ns)
+                    processed[batch] = self.calibrate_windows(X, block, t0)[:, -(nper + 1):]
+            self.update_timings('archive_filter_chunk')
+
+            block.data = np.concatenate((processed[0, 0:1], processed[:, 1:].reshape(-1)))
+            block.start_ns = chunkstarttime.ns
+            block.packet_starts = processed[:, 0]
+            block.nan_mask = ~np.isfinite(raw[first:first + nwin * nper + 1])
+        return len(blocks) > 0
+
+    def filter_windows(self, X, sampling_rate):
+        ''' Buffer.filter() for a 2-D array of buffers of the same length, one per row: detrend, and if requested taper and filter '''
+        n = X.shape[1]
+        if n < 2:
+            return X.copy()
+        # the least-squares line through each buffer, as in Buffer.detrend()
+        x = X.astype(np.float64)
+        sx = x.sum(axis=1)
+        stx = x @ np.arange(n)
+        st_rel = n * (n - 1) / 2.0
+        stt_rel = (n - 1) * n * (2 * n - 1) / 6.0
+        slope = (n * stx - st_rel * sx) / (n * stt_rel - st_rel**2)
+        intercept = (sx - slope * st_rel) / n
+        # in the precision of the data, as Buffer.detrend() does with Python floats
+        X = X - (intercept.astype(self.dtype)[:, np.newaxis] + slope.astype(self.dtype)[:, np.newaxis] * np.arange(n, dtype=self.dtype))
+        if self.filterdef:
+            data = np.concatenate((X, np.flip(X, axis=1)), axis=1)
+            data *= buffer_taper(2 * n, self.processingCache)
+            if self.processingCache and self.filterdef['type'] in ['bandpass', 'highpass', 'lowpass']:
+                data = self.processingCache.filter_data(data, sampling_rate, self.filterdef).astype(self.dtype, copy=False)
+            else:
+                data = np.array([filter_data(row, sampling_rate, self.filterdef) for row in data])
+            X = data[:, 0:n]
+        return X
+
+    def analyze_chunk(self, blocks, chunkstarttime, chunkendtime):
+        '''
+        Analyze each secondsPerPacket packet of a chunk processed by process_chunk(), as if it had arrived on its own.
+        Subclasses can override this with a vectorized version that does not make a packet for each window.
+        '''
+        packets = {}
+        for block in blocks:
+            packets[block.seed_id] = chunk_packets(block, int(round(self.secondsPerPacket * block.sampling_rate)))
+        nwin = max([len(data) for data, nan_mask in packets.values()])
+        packet_ns = int(round(self.secondsPerPacket * 1e9))
+        for w in range(nwin):
+            self.currentPacket = []
+            for block in blocks:
+                data, nan_mask = packets[block.seed_id]
+                if w < len(data) and not nan_mask[w].all(): # skip blocks with no real data in this packet
+                    self.currentPacket.append(ChannelBlock(block.seed_id, chunkstarttime.ns + w * packet_ns, block.sampling_rate, data[w]))
+            if len(self.currentPacket) > 0:
+                self.npackets += 1
+                self.analyze()
+
     def report(self):
         if self.benchmark:
             self.timingObj.report(self.npackets)
 
+        if hasattr(self.client, 'report'): # e.g. per-source latency from hedged2obspy
+            self.client.report()
+
+        if self.resequencer:
+            self.resequencer.report()
+
+        if self.quietGate:
+            self.quietGate.report()
+
+        if self.processingCache:
+            self.processingCache.report()
+
+        if self.latency_on and self.latencyObj.stalls:
+            print(f'{self.station}: {self.latencyObj.stalls} stalls, longest {self.latencyObj.longest_stall:.0f} seconds without packets')
+
+        for seed_id, gapinfo in self.gaps.items():
+            print(f"{seed_id}: {gapinfo['gaps']} gaps, {gapinfo['missing_seconds']:.1f} seconds missing, {gapinfo['backfilled_seconds']:.1f} seconds backfilled")
+        for netsta, nmissing in self.missing_records.items():
+            print(f'{netsta}: {nmissing} SeedLink records missing')
+
         if self.latency_on and self.mode == 'realtime':
             self.latencyObj.report()
             titlestr = f"Data latency for {self.nslc} using {self.api}"
@@ -320,81 +1001,795 @@ class RealTimeDataClient(object):
             self.latencyObj.plot(title=titlestr, outfile=outfile)
 
     def close(self): # close api client
+        self.stop_watchdog()
         self.client.close()
+        if self.benchmark: # IMPORT_TIMES belongs to this process, so keep a copy for the report
+            self.timingObj.import_times = dict(IMPORT_TIMES)
 
 ################################################################################
+class ChannelBlock:
+    '''
+    The samples of one SEED id: a numpy array, the time of its first sample as integer ns, and the sampling rate. This is all the packet
+    loop needs to know about a channel, so packets and the buffer are lists and dicts of these rather than ObsPy Streams, whose Traces 
+    deep-copy their stats, and add to their processing history, every time they are copied, trimmed, tapered, filtered or merged.
+    A block can also carry the time its packet arrived (loadtime_ns) and its SeedLink sequence number (seqnum), as Trace stats do, and 
+    for an archive chunk, packet_starts and nan_mask (see RealTimeDataClient.process_chunk()). to_trace() converts a block to an 
+    ObsPy Trace, for calibration, plotting and export.
+    '''
+    __slots__ = ('seed_id', 'start_ns', 'sampling_rate', 'data', 'loadtime_ns', 'seqnum', 'packet_starts', 'nan_mask')
+
+    def __init__(self, seed_id, start_ns, sampling_rate, data, loadtime_ns=None, seqnum=None):
+        self.seed_id = seed_id
+        self.start_ns = start_ns
+        self.sampling_rate = sampling_rate
+        self.data = data
+        self.loadtime_ns = loadtime_ns
+        self.seqnum = seqnum
+        self.packet_starts = None
+        self.nan_mask = None
+
+    @classmethod
+    def from_trace(cls, tr):
+        ''' a block that shares its data array with ObsPy Trace tr, and keeps its loadtime and seqnum, if it has them '''
+        s = tr.stats
+        loadtime = s.get('loadtime')
+        return cls(tr.id, s.starttime.ns, s.sampling_rate, tr.data, loadtime_ns=loadtime.ns if loadtime else None, seqnum=s.get('seqnum'))
+
+    def __repr__(self):
+        return f'{self.seed_id} | {to_utc(self.start_ns)} - {to_utc(self.end_ns)} | {self.sampling_rate} Hz, {self.npts} samples'
+
+    @property
+    def npts(self):
+        return len(self.data)
+
+    @property
+    def delta_ns(self):
+        return int(round(1e9 / self.sampling_rate))
+
+    @property
+    def end_ns(self):
+        return self.start_ns + (self.npts - 1) * self.delta_ns
+
+    def index(self, time_ns):
+        ''' the number of the sample nearest to time_ns, counting from the first sample of the block '''
+        return int(round((time_ns - self.start_ns) / self.delta_ns))
+
+    def copy(self):
+        return ChannelBlock(self.seed_id, self.start_ns, self.sampling_rate, self.data.copy(), loadtime_ns=self.loadtime_ns, seqnum=self.seqnum)
+
+    def slice(self, start_ns=None, end_ns=None):
+        ''' the samples from the nearest to start_ns to the nearest to end_ns, inclusive, as Trace.slice() would, sharing the data 
+        array with this block. Either end may be None, for the start or end of the block. Returns None if there are no samples '''
+        i0 = 0 if start_ns is None else max([self.index(start_ns), 0])
+        i1 = self.npts - 1 if end_ns is None else min([self.index(end_ns), self.npts - 1])
+        if i1 < i0:
+            return None
+        return ChannelBlock(self.seed_id, self.start_ns + i0 * self.delta_ns, self.sampling_rate, self.data[i0:i1+1], \
+                            loadtime_ns=self.loadtime_ns, seqnum=self.seqnum)
+
+    def to_trace(self):
+        ''' an ObsPy Trace, which shares its data array with the block '''
+        network, station, location, channel = self.seed_id.split('.')
+        return obspy.Trace(data=self.data, header={'network':network, 'station':station, 'location':location, 'channel':channel, \
+                                                   'sampling_rate':self.sampling_rate, 'starttime':to_utc(self.start_ns)})
+
+def stream2blocks(st):
+    ''' the Traces of an ObsPy Stream as a list of ChannelBlocks, which share their data arrays with the Traces '''
+    return [ChannelBlock.from_trace(tr) for tr in st]
+
+def slice_blocks(blocks, start_ns=None, end_ns=None):
+    ''' ChannelBlock.slice() for a list of blocks, like Stream.slice(): blocks with no samples in the time range are left out '''
+    sliced = [block.slice(start_ns, end_ns) for block in blocks]
+    return [block for block in sliced if block is not None]
+
+def finite_runs(blocks):
+    ''' each run of finite samples of a list of ChannelBlocks as a block of its own, sharing the data array, in time order. Archive reads
+    fill missing data with NaNs, and this turns them back into the gaps between blocks that detect_gaps() looks for '''
+    runs = []
+    for block in blocks:
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], np.isfinite(block.data).astype(np.int8), [0]))))
+        for i0, i1 in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            runs.append(ChannelBlock(block.seed_id, block.start_ns + i0 * block.delta_ns, block.sampling_rate, block.data[i0:i1]))
+    return sorted(runs, key=lambda block: block.start_ns)
+
+def merge_blocks(blocks):
+    '''
+    Merges a list of ChannelBlocks into one block per SEED id, in SEED id order, just as Stream.merge(method=1, fill_value='interpolate',
+    interpolation_samples=0) would: blocks are taken in time order, and where one overlaps the end of the data so far, its samples are 
+    kept, a block that lies within the data so far is dropped, and gaps are filled by linear interpolation. The blocks passed in are 
+    not changed. Each merged block has the seqnum of its first block, and the latest loadtime_ns, since its data were complete then.
+    '''
+    by_id = {}
+    for block in blocks:
+        if block.npts > 0:
+            by_id.setdefault(block.seed_id, []).append(block)
+    merged = []
+    for seed_id in sorted(by_id):
+        parts = sorted(by_id[seed_id], key=lambda block: (block.start_ns, block.end_ns))
+        block = parts[0].copy()
+        for part in parts[1:]:
+            if part.sampling_rate != block.sampling_rate:
+                raise Exception(f"Can't merge traces with same ids but differing sampling rates! ({seed_id})")
+            i0 = block.index(part.start_ns)
+            if i0 + part.npts > block.npts: # otherwise part lies within the data so far
+                gap = interpolate_gap(block.data[-1], part.data[0], i0 - block.npts, block.data.dtype)
+                block.data = np.concatenate((block.data[0:i0], gap, part.data))
+        loadtimes = [part.loadtime_ns for part in parts if part.loadtime_ns is not None]
+        block.loadtime_ns = max(loadtimes) if loadtimes else None
+        merged.append(block)
+    return merged
+
+def interpolate_gap(left, right, nsamples, dtype):
+    ''' the nsamples samples that fill a gap between samples left and right by linear interpolation, as Stream.merge() would '''
+    return np.linspace(left, right, max([nsamples, 0]) + 2)[1:-1].astype(dtype)
+
+def fill_packets(data, first, nper):
+    '''
+    Fills the missing (NaN or Inf) samples of a numpy array just as the packet loop would, for packets of nper + 1 samples starting 
+    at sample first + k * nper, for any integer k (each packet ends with the first sample of the next). In a packet with some data, 
+    they are filled with the median of the packet (see RealTimeDataClient.remove_bad_data()), and where two packets share a sample, 
+    the later packet wins, as in Buffer.append(). Samples in packets with no data at all are interpolated across, as Buffer.append()
+    interpolates across a missing packet. Returns the filled copy of data, or None if there are no data.
+    '''
+    nan_mask = ~np.isfinite(data)
+    if nan_mask.all():
+        return None
+    filled = data.copy()
+    if not nan_mask.any():
+        return filled
+    # the packets with missing samples: the sample at the start of a packet is also the last sample of the one before
+    missing = np.flatnonzero(nan_mask) - first % nper
+    filled_mask = ~nan_mask
+    for k in np.unique(np.concatenate((missing // nper, (missing - 1) // nper))):
+        i0 = first % nper + k * nper
+        packet = slice(max([i0, 0]), i0 + nper + 1)
+        if not nan_mask[packet].all():
+            fill = nan_mask[packet]
+            filled[packet][fill] = np.nanmedian(data[packet])
+            filled_mask[packet] |= fill
+    if not filled_mask.all():
+        good = np.flatnonzero(filled_mask)
+        bad = np.flatnonzero(~filled_mask)
+        filled[bad] = np.interp(bad, good, filled[good])
+    return filled
+
+def chunk_packets(block, nper):
+    '''
+    The packets of a ChannelBlock processed by RealTimeDataClient.process_chunk(), as a 2-D array with one row per packet, of its nper + 1 
+    samples just as the packet loop would have processed them, and a matching 2-D boolean array of which samples were missing
+    '''
+    sliding_window_view = np.lib.stride_tricks.sliding_window_view
+    data = sliding_window_view(block.data, nper + 1)[::nper].copy()
+    data[:, 0] = block.packet_starts
+    return data, sliding_window_view(block.nan_mask, nper + 1)[::nper]
+
 class Buffer:    
-    def __init__(self, stpacket, filterdef, bufferSecs=10.0): # a buffer is created from the first packet but for SlinkServer, also need to check NSLC and have one for each
-        # pre-pad or trim to seconds
-        self.raw = stpacket.copy() # a buffer Stream for unfiltered, but calibration corrected waveform data
-        self.tmp = None # the buffer Stream we do any processing on
+    def __init__(self, packet, filterdef, bufferSecs=10.0, cache=None): # a buffer is created from the first packet (a list of ChannelBlocks) but for SlinkServer, also need to check NSLC and have one for each
+        self.blocks = {} # seed_id -> ChannelBlock: the raw buffer, of unfiltered waveform data
+        self.tmp = None # seed_id -> ChannelBlock: the buffer we do any processing on. See filter()
         self.bufferSecs = bufferSecs
         self.filterdef = filterdef
+        self.cache = cache # ProcessingCache for the filter design, or None to let ObsPy design it every time
+        self.sums = {} # seed_id -> running sums of the raw buffer, for detrend(). See resync()
+        self.resync_updates = 1000 # work the sums out from scratch after this many calls to append()
+        self.updates = 0
+        self.append(packet) # which also works out the sums
+
+    def seconds(self):
+        ''' the length of the raw buffer, in seconds '''
+        start_ns = min([block.start_ns for block in self.blocks.values()])
+        end_ns = max([block.end_ns + block.delta_ns for block in self.blocks.values()])
+        return (end_ns - start_ns) / 1e9
+
+    def resync(self):
+        '''
+        Works out, from scratch, the running sums that detrend() needs for each SEED id: the number of samples n, the sum of the samples
+        sx, and the sum of sample number times sample stx. Sample numbers count from the first sample of the buffer now, and first is 
+        the sample number of the first sample in the buffer. After this, append() and trim2seconds() update the sums with just the 
+        samples that enter or leave the buffer. They are worked out again every resync_updates updates, so rounding errors cannot 
+        build up, and sample numbers stay small.
+        '''
+        self.sums = {}
+        for seed_id, block in self.blocks.items():
+            x = block.data.astype(float)
+            self.sums[seed_id] = {'first': 0, 'n': len(x), 'sx': x.sum(), 'stx': np.arange(len(x)) @ x}
+        self.updates = 0
+
+    def add_samples(self, sums, x, first, sign=1.0):
+        ''' add (or with sign=-1, remove) samples x, the first of which is sample number first, to the running sums '''
+        if len(x) > 0:
+            x = x.astype(float)
+            sums['n'] += int(sign) * len(x)
+            sums['sx'] += sign * x.sum()
+            sums['stx'] += sign * (np.arange(first, first + len(x)) @ x)
+
+    def append(self, packet):
+        '''
+        Merges packet (a list of ChannelBlocks, from one packet or a batch of them) into the raw buffer, just as merge_blocks() would: 
+        where the packet overlaps the end of the buffer, its samples are kept, and any gap is filled by linear interpolation. The 
+        running sums are updated with only the samples that change.
+        '''
+        for new in packet:
+            if new.npts == 0:
+                continue
+            seed_id = new.seed_id
+            block = self.blocks.get(seed_id)
+            if block is None: # a new SEED id
+                self.blocks[seed_id] = ChannelBlock(seed_id, new.start_ns, new.sampling_rate, new.data.copy())
+                self.sums[seed_id] = None
+                continue
+            if new.sampling_rate != block.sampling_rate:
+                raise Exception(f"Can't merge traces with same ids but differing sampling rates! ({seed_id})")
+            sums = self.sums.get(seed_id)
+            x = new.data
+            n = block.npts
+            i0 = block.index(new.start_ns) # the first sample of the new block, counting from the first sample of the buffer
+            i1 = i0 + len(x)
+            if i0 >= 0 and i1 > n: # the new block continues the buffer, replacing any samples it overlaps
+                gap = interpolate_gap(block.data[-1], x[0], i0 - n, block.data.dtype)
+                if sums:
+                    self.add_samples(sums, block.data[i0:], sums['first'] + i0, sign=-1.0)
+                    self.add_samples(sums, gap, sums['first'] + n)
+                    self.add_samples(sums, x, sums['first'] + i0)
+                block.data = np.concatenate((block.data[0:i0], gap, x))
+            elif i0 < 0 and i1 < n: # the new block comes before the buffer, which keeps its own samples where they overlap
+                before = x[0:-i0]
+                gap = interpolate_gap(x[-1], block.data[0], -i1, x.dtype)
+                if sums:
+                    self.add_samples(sums, before, sums['first'] + i0)
+                    self.add_samples(sums, gap, sums['first'] + i1)
+                    sums['first'] += i0
+                block.data = np.concatenate((before, gap, block.data))
+                block.start_ns = new.start_ns
+            elif i0 < 0: # the new block spans the whole buffer, so replaces it
+                block.data = x.copy()
+                block.start_ns = new.start_ns
+                self.sums[seed_id] = None
+            # otherwise the new block lies within the buffer, which keeps its own samples, as Stream.merge() does
+        self.updates += 1
+        if self.updates >= self.resync_updates or None in self.sums.values():
+            self.resync()
 
     def trim2seconds(self):
         ''' trim buffer to bufferSecs seconds to stop it growing too long and consuming unnecessary RAM '''
-        etime = max([tr.stats.endtime for tr in self.raw])
-        stime = min([tr.stats.starttime for tr in self.raw])
-        if etime - self.bufferSecs > stime:
-            self.raw.trim(starttime=etime-self.bufferSecs)
+        etime = max([block.end_ns for block in self.blocks.values()])
+        stime = min([block.start_ns for block in self.blocks.values()])
+        cut_ns = etime - int(round(self.bufferSecs * 1e9))
+        if cut_ns > stime:
+            for seed_id, block in list(self.blocks.items()):
+                k = block.index(cut_ns) # number of samples to trim off the start
+                if k <= 0:
+                    continue
+                sums = self.sums.get(seed_id)
+                if sums: # remove the samples trimmed off the start from the running sums
+                    self.add_samples(sums, block.data[0:k], sums['first'], sign=-1.0)
+                    sums['first'] += k
+                if k >= block.npts: # a SEED id with no data left
+                    del self.blocks[seed_id]
+                    self.sums.pop(seed_id, None)
+                    continue
+                block.data = block.data[k:]
+                block.start_ns += k * block.delta_ns
+
+    def detrend(self):
+        '''
+        Removes the linear trend from the tmp buffer. The least-squares line through the buffer comes from the running sums, rather 
+        than from fitting the whole buffer again, so there is just one pass over the buffer, to subtract it. Gives the same result 
+        as Stream.detrend('linear'), whose scipy function is still used for any block the sums do not match.
+        '''
+        for seed_id, block in self.tmp.items():
+            sums = self.sums.get(seed_id)
+            n = block.npts
+            if not sums or sums['n'] != n or n < 2:
+                signal = lazy_import('scipy.signal')
+                block.data = signal.detrend(block.data, type='linear').astype(block.data.dtype, copy=False)
+                continue
+            # with sample numbers counted from the first sample in the buffer, t = 0 ... n-1
+            st_rel = n * (n - 1) / 2.0
+            stt_rel = (n - 1) * n * (2 * n - 1) / 6.0
+            stx_rel = sums['stx'] - sums['first'] * sums['sx']
+            slope = float((n * stx_rel - st_rel * sums['sx']) / (n * stt_rel - st_rel**2))
+            intercept = float((sums['sx'] - slope * st_rel) / n)
+            block.data = block.data - (intercept + slope * np.arange(n, dtype=block.data.dtype)) # Python floats keep the precision of the data
+
+    def taper(self, npts):
+        ''' the Hann taper that Stream.taper(0.25) applies to npts samples '''
+        return buffer_taper(npts, self.cache)
 
     def filter(self):
+        ''' copies the raw buffer to the tmp buffer, and detrends, and if requested tapers and filters, the tmp buffer '''
         buffer_filtered = False
-        # replace any nan values
-        #handle_bad_data(self.tmp, fill_value='mean') # remove any nan values, including trailing nans, before detrending?
-    
-        try:
-            self.tmp.detrend('linear')
-        except NotImplementedError as e: # may have multiple traces with same SEED id that cannot be merged
-            print('Warning: failed to detrend buffer')
-            return buffer_filtered
+        self.tmp = {seed_id: block.copy() for seed_id, block in self.blocks.items()}
+        self.detrend()
 
         # filter, if requested
         if self.filterdef:
-            filterdef = self.filterdef
+            for block in self.tmp.values():
+                npts = block.npts
 
-            # pad with reversed buffer - needed for tapering and/or two-way filtering
-            for tr in self.tmp:
-                tr.data = np.concatenate((tr.data, np.flip(tr.data)))
+                # pad with reversed buffer - needed for tapering and/or two-way filtering
+                data = np.concatenate((block.data, np.flip(block.data)))
 
-            # taper
-            self.tmp.taper(0.25)
+                # taper
+                data *= self.taper(len(data))
 
-            # filter
-            if filterdef['type']=='bandpass':
-                self.tmp.filter(filterdef['type'],freqmin=filterdef['freq'][0], freqmax=filterdef['freq'][1],corners=filterdef['corners'], zerophase=filterdef['zerophase'])
-            else:
-                self.tmp.filter(filterdef['type'], freq=filterdef['freq'][0], corners=filterdef['corners'], zerophase=filterdef['zerophase'])
-
-            # unpad the buffer
-            for tr in self.tmp:
-                N = int(tr.stats.npts/2)
-                tr.data = tr.data[0:N]
+                # filter, then unpad the buffer
+                data = filter_data(data, block.sampling_rate, self.filterdef, cache=self.cache)
+                block.data = data[0:npts]
 
         buffer_filtered = True
         return buffer_filtered
 
-    def trim2packet(self, packet_st):
-        """ Trims tmp buffer to same time range as current packet. Used to update current packet after filtering the buffer """
-        stime = min([tr.stats.starttime for tr in packet_st])
-        etime = max([tr.stats.endtime for tr in packet_st])       
-        return self.tmp.copy().trim(starttime=stime, endtime=etime)
+    def trim2packet(self, packet):
+        """ Trims tmp buffer to same time range as current packet. Used to update current packet (a list of ChannelBlocks) after filtering the buffer """
+        stime = min([block.start_ns for block in packet])
+        etime = max([block.end_ns for block in packet])
+        return [block.copy() for block in slice_blocks(self.tmp.values(), stime, etime)]
+################################################################################
+def hann_taper(npts, max_percentage):
+    ''' the taper that Trace.taper(max_percentage, type='hann') multiplies npts samples by '''
+    signal = lazy_import('scipy.signal')
+    wlen = min([int(max_percentage * npts), int(npts / 2)])
+    taper_sides = signal.windows.hann(2 * wlen if 2 * wlen == npts else 2 * wlen + 1)
+    return np.hstack((taper_sides[0:wlen], np.ones(npts - 2 * wlen), taper_sides[len(taper_sides) - wlen:]))
+
+def buffer_taper(npts, cache=None):
+    ''' the Hann taper that Buffer.filter() applies to npts samples, i.e. a padded buffer, from the cache if there is one '''
+    if cache:
+        return cache.get(('taper', npts, 0.25), lambda: hann_taper(npts, 0.25))
+    return hann_taper(npts, 0.25)
+
+def filter_data(data, sampling_rate, filterdef, cache=None):
+    ''' filter a numpy array of samples, as filter_Stream() would filter a Trace of them, and return the result in the same precision '''
+    if cache and filterdef['type'] in ['bandpass', 'highpass', 'lowpass']:
+        return cache.filter_data(data, sampling_rate, filterdef).astype(data.dtype, copy=False)
+    st = obspy.Stream([obspy.Trace(data=data, header={'sampling_rate':sampling_rate})])
+    filter_Stream(st, filterdef)
+    return st[0].data
+
+def filter_peak_gain(sampling_rate, filterdef):
+    ''' the most filterdef can amplify the peak of any signal by: the sum of the absolute values of its impulse response, which is at 
+    least the peak of its amplitude response, max |H(f)|. 1.0 if there is no filter '''
+    if not filterdef:
+        return 1.0
+    npts = int(np.ceil(40.0 / min(filterdef['freq']) * sampling_rate)) # long enough for the impulse response to die away
+    impulse = np.zeros(2 * npts + 1)
+    impulse[npts] = 1.0 # in the middle, as a zero-phase filter runs backwards too
+    return float(np.abs(filter_data(impulse, sampling_rate, filterdef)).sum())
+
+def filter_Stream(st, filterdef, cache=None):
+    ''' filter st in place, as described by filterdef, with a Butterworth filter designed once per sampling rate if there is a cache. 
+    The filter runs in double precision, but each Trace keeps the precision it came in with '''
+    dtypes = [tr.data.dtype for tr in st]
+    if cache and filterdef['type'] in ['bandpass', 'highpass', 'lowpass']:
+        cache.filter(st, filterdef)
+    elif filterdef['type']=='bandpass':
+        st.filter(filterdef['type'],freqmin=filterdef['freq'][0], freqmax=filterdef['freq'][1],corners=filterdef['corners'], zerophase=filterdef['zerophase'])
+    else:
+        st.filter(filterdef['type'], freq=filterdef['freq'][0], corners=filterdef['corners'], zerophase=filterdef['zerophase'])
+    for tr, dtype in zip(st, dtypes):
+        tr.data = tr.data.astype(dtype, copy=False)
+
+def response_nfft(npts):
+    '''
+    The FFT length Trace.remove_response() uses for npts samples: 2 * npts, rounded up to an even number, so the convolution does not 
+    wrap around. Beyond 5000, if that has a prime factor of 500 or more (which makes evalresp and the FFT slow), the first of the next
+    10 even numbers without one, or failing that the next power of 2. This is ObsPy's private obspy.signal.util._npts2nfft(), which 
+    we must match exactly for cached responses to give the same result
+    '''
+    from obspy.signal.util import factorize_int, next_pow_2
+    nfft = 2 * (npts + 1) if npts % 2 else 2 * npts
+    if nfft > 5000 and max(factorize_int(nfft)) >= 500:
+        for trial in range(nfft + 2, nfft + 22, 2):
+            if max(factorize_int(trial)) < 500:
+                return trial
+        return next_pow_2(nfft)
+    return nfft
+
+class ProcessingCache:
+    '''
+    A least-recently-used cache of the things that are the same for every packet, but which ObsPy works out again each time:
+        filter designs (second-order sections), keyed by sampling rate and filterdef
+        inverse instrument response spectra, with pre_filt and the water level already applied, and the time-domain taper, keyed by
+        SEED id, sampling rate, number of samples, pre_filt, output units and response epoch
+        the Hann tapers that Buffer.filter() applies, keyed by number of samples
+    Once the buffer is full, npts is the same for every packet, so each SEED id needs just one spectrum, and remove_response() costs
+    two FFTs rather than an evaluation of the full response. The result is the same as Stream.filter() and Stream.remove_response(),
+    which are still used for anything not covered here (e.g. polynomial responses).
+    '''
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.epochs = {} # seed_id -> list of (start, end) of the epochs in the inventory, as UTCDateTime (end may be None)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        ''' the cached value for key, or compute() it, cache it, and evict the least recently used value if the cache is full '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def set_inventory(self, inventory):
+        ''' called whenever the inventory is (re)loaded. Clears the cached spectra, and indexes the channel epochs '''
+        for key in [key for key in self.entries if key[0] == 'response']:
+            del self.entries[key]
+        self.epochs = {}
+        for net in inventory:
+            for sta in net:
+                for cha in sta:
+                    seed_id = f'{net.code}.{sta.code}.{cha.location_code}.{cha.code}'
+                    self.epochs.setdefault(seed_id, []).append((cha.start_date, cha.end_date))
+
+    def epoch(self, seed_id, starttime):
+        ''' the start of the inventory epoch for seed_id at starttime, in ns (UTCDateTime cannot be hashed), or None '''
+        for start, end in self.epochs.get(seed_id, []):
+            if (start is None or start <= starttime) and (end is None or starttime <= end):
+                return start.ns if start else None
+        return None
+
+    def sos(self, sampling_rate, filterdef):
+        ''' the second-order sections of the Butterworth filter described by filterdef, designed just as ObsPy does '''
+        fe = 0.5 * sampling_rate
+        if filterdef['type'] == 'bandpass' and filterdef['freq'][1] / fe - 1.0 <= -1e-6:
+            freqs, btype = [filterdef['freq'][0] / fe, filterdef['freq'][1] / fe], 'band'
+        elif filterdef['type'] == 'lowpass':
+            freqs, btype = min([filterdef['freq'][0] / fe, 1.0]), 'lowpass'
+        else: # ObsPy also applies a highpass if the high corner of a bandpass is at or above Nyquist
+            freqs, btype = filterdef['freq'][0] / fe, 'highpass'
+        key = ('sos', sampling_rate, filterdef['type'], tuple(filterdef['freq']), filterdef['corners'])
+        signal = lazy_import('scipy.signal') # not kept as an attribute, so the client can still be pickled
+        return self.get(key, lambda: signal.iirfilter(filterdef['corners'], freqs, btype=btype, ftype='butter', output='sos'))
+
+    def filter(self, st, filterdef):
+        ''' filter every Trace of st in place, like Stream.filter(), with a cached filter design '''
+        for tr in st:
+            tr.data = self.filter_data(tr.data, tr.stats.sampling_rate, filterdef)
+
+    def filter_data(self, data, sampling_rate, filterdef):
+        ''' filter a numpy array of samples, like Trace.filter(), with a cached filter design. Returns the result in double precision '''
+        signal = lazy_import('scipy.signal')
+        sos = self.sos(sampling_rate, filterdef)
+        data = signal.sosfilt(sos, data)
+        if filterdef['zerophase']:
+            data = np.flip(signal.sosfilt(sos, np.flip(data)))
+        return data
+
+    def remove_response(self, st, pre_filt=None, output='ACC', water_level=60):
+        ''' remove the instrument response attached to every Trace of st, in place, like Stream.remove_response(), with cached spectra '''
+        for tr in st:
+            response = tr.stats.response
+            dtype = tr.data.dtype # the spectra are double precision, but each Trace keeps the precision it came in with
+            if not self.cacheable(response):
+                tr.remove_response(pre_filt=pre_filt, output=output, water_level=water_level)
+                tr.data = tr.data.astype(dtype, copy=False)
+                continue
+            tr.data = self.remove_response_data(tr.data, tr.id, tr.stats.sampling_rate, tr.stats.starttime, response, pre_filt, output, water_level)
+
+    def cacheable(self, response):
+        ''' whether the response can be removed with a cached spectrum, i.e. it is not empty, and not polynomial '''
+        from obspy.core.inventory.response import PolynomialResponseStage
+        return bool(response.response_stages) and not isinstance(response.response_stages[0], PolynomialResponseStage)
+
+    def remove_response_data(self, data, seed_id, sampling_rate, starttime, response, pre_filt=None, output='ACC', water_level=60):
+        ''' remove_response() for a numpy array of samples, or a 2-D array with one window of samples per row, which all get the 
+        same spectrum. Returns the result in the same precision '''
+        npts = data.shape[-1]
+        key = ('response', seed_id, sampling_rate, npts, tuple(pre_filt) if pre_filt else None, output, water_level, self.epoch(seed_id, starttime))
+        taper, inverse, nfft = self.get(key, lambda: self.inverse_response(response, 1.0 / sampling_rate, npts, pre_filt, output, water_level))
+        x = data.astype(np.float64)
+        x -= x.mean(axis=-1, keepdims=True)
+        x *= taper
+        x = np.fft.rfft(x, n=nfft, axis=-1) * inverse
+        x[..., -1] = abs(x[..., -1]) + 0.0j
+        return np.fft.irfft(x, axis=-1)[..., 0:npts].astype(data.dtype, copy=False)
+
+    def inverse_response(self, response, delta, npts, pre_filt, output, water_level):
+        ''' what Trace.remove_response() works out for every call: the taper, and the inverse response spectrum, times the pre_filt taper '''
+        from obspy.signal.invsim import cosine_taper, cosine_sac_taper, invert_spectrum
+        nfft = response_nfft(npts)
+        freq_response, freqs = response.get_evalresp_response(delta, nfft, output=output)
+        if water_level is None:
+            freq_response[0] = 0.0
+            freq_response[1:] = 1.0 / freq_response[1:]
+        else:
+            invert_spectrum(freq_response, water_level)
+        if pre_filt:
+            freq_response *= cosine_sac_taper(freqs, flimit=pre_filt)
+        return cosine_taper(npts, 0.05, sactaper=True, halfcosine=False), freq_response, nfft
+
+    def report(self):
+        print(f'Processing cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} entries')
+
+################################################################################
+class Resequencer:
+    '''
+    Puts packets back in time order for each SEED id before they are processed. A ChannelBlock that follows on from the last one released
+    for its SEED id is released at once, so packets that arrive in order are never delayed. A block that would leave a gap is held until 
+    the missing data arrive, or until it has been held for max_hold_seconds, whichever comes first. Repeated blocks are dropped, and 
+    so are blocks that arrive after later data for their SEED id have already been released (too late to put in order). 
+    Reorders, duplicates and late Traces are counted.
+    '''
+    def __init__(self, max_hold_seconds=2.0, index_size=1000, clock=None):
+        self.max_hold_seconds = max_hold_seconds
+        self.clock = clock or Clock()
+        self.index_size = index_size # how many released start times to remember per SEED id, to recognize duplicates
+        self.held = {} # seed_id -> list of (start time in ns, arrival time, ChannelBlock), in start time order. start times are unique, as duplicates are dropped
+        self.released_until = {} # seed_id -> end time (ns) of the data released so far
+        self.released = {} # seed_id -> start times (ns) of recently released blocks
+        self.latest_start = {} # seed_id -> latest start time (ns) received
+        self.reorders = 0
+        self.duplicates = 0
+        self.late = 0
+
+    def push(self, packet):
+        ''' add the ChannelBlocks of a new packet. Returns a list of whatever blocks are now ready, in time order, merged to one block per SEED id '''
+        now = self.clock.monotonic_ns() / 1e9
+        for block in packet:
+            seed_id = block.seed_id
+            key = block.start_ns
+            released = self.released.setdefault(seed_id, deque(maxlen=self.index_size))
+            held = self.held.setdefault(seed_id, [])
+            if key in released or key in [k for k, arrival, block_held in held]:
+                self.duplicates += 1
+                continue
+            if key < self.latest_start.get(seed_id, key):
+                self.reorders += 1
+            self.latest_start[seed_id] = max([key, self.latest_start.get(seed_id, key)])
+            if seed_id in self.released_until and block.end_ns <= self.released_until[seed_id]:
+                self.late += 1
+                continue
+            bisect.insort(held, (key, now, block)) # ordered by start time, which is unique, so blocks are never compared
+        return self.release(now)
+
+    def release(self, now):
+        ''' release, for each SEED id, the held blocks that follow on from what has been released, starting with the first held block 
+        if it has been held for max_hold_seconds '''
+        ready = []
+        for seed_id, held in self.held.items():
+            run = []
+            while held:
+                key, arrival, block = held[0]
+                released_until = self.released_until.get(seed_id)
+                follows_on = released_until is None or block.start_ns <= released_until + 1.5 * block.delta_ns
+                if follows_on or (len(run) == 0 and now - arrival >= self.max_hold_seconds):
+                    held.pop(0)
+                    run.append(block)
+                    self.released[seed_id].append(key)
+                    self.released_until[seed_id] = max([block.end_ns, released_until or block.end_ns])
+                else:
+                    break
+            if len(run) > 1:
+                loadtime_ns = max([block.loadtime_ns or block.end_ns for block in run]) # the data were complete when the last block arrived
+                run = merge_blocks(run)
+                run[0].loadtime_ns = loadtime_ns
+            ready += run
+        return ready
+
+    def holding(self):
+        ''' True if any blocks are being held '''
+        return any(self.held.values())
+
+    def flush(self):
+        ''' release the first held block for each SEED id, however long it has been held, and any that follow on from it. 
+        Call this until holding() is False to release everything, e.g. at the end of a run '''
+        return self.release(float('inf'))
+
+    def report(self):
+        print(f'Resequencer: {self.reorders} packets reordered, {self.duplicates} duplicates dropped, {self.late} dropped as too late')
+
+################################################################################
+class QuietGate:
+    '''
+    Decides which packets are quiet enough to skip the expensive processing (detrending, filtering and calibrating the whole buffer)
+    and go down a quiet path instead, where the PGA is estimated from the raw counts divided by the gain. For each SEED id, a running 
+    mean and a recursive STA/LTA of the raw counts (after removing that mean) are carried from one packet to the next, a sample at a
+    time but vectorized with lfilter. A packet is quiet only if, for every ChannelBlock:
+        the gain is known and the LTA has warmed up, i.e. there have been lta_seconds of continuous data
+        the STA/LTA stays below trigger_ratio throughout the packet
+        the peak of the raw counts, minus the running mean, divided by the gain, times filter_peak_gain() of filterdef, is below 
+        quiet_level
+    Any gap resets the STA/LTA for that SEED id, so packets are not quiet again until it has warmed up. The caller picks quiet_level
+    (e.g. threshold_monitor.py uses half the lowest threshold), so that the quiet path is only taken well below any threshold. As the
+    filter cannot amplify the peak by more than filter_peak_gain(), a threshold crossing takes the full path, as long as the running 
+    mean tracks the offset the full path detrends, and the instrument response is not removed (the caller turns the gate off if it is).
+    '''
+    def __init__(self, sta_seconds=1.0, lta_seconds=30.0, trigger_ratio=2.5, filterdef=None):
+        self.sta_seconds = sta_seconds
+        self.lta_seconds = lta_seconds
+        self.trigger_ratio = trigger_ratio
+        self.filterdef = filterdef # the filter of the full path
+        self.peak_gains = {} # sampling rate -> filter_peak_gain()
+        self.state = {} # seed_id -> {'next_ns': time of the next sample, 'warm_ns': when the LTA has warmed up, 'zi': {'mean', 'sta', 'lta'}}
+        self.quiet = 0
+        self.full = 0
+
+    def update(self, packet, gains, quiet_level):
+        ''' 
+        Feeds the raw counts of a packet (a list of ChannelBlocks) through the STA/LTA. Returns a dict of seed_id -> raw counts minus 
+        their running mean, if the packet is quiet, or None if it is not. quiet_level (m/s^2) must be set: the STA/LTA alone would 
+        let a slow rise through
+        '''
+        if quiet_level is None:
+            raise ValueError('QuietGate needs a quiet_level')
+        signal = lazy_import('scipy.signal') # not kept as an attribute, so the client can still be pickled
+        quiet_data = {}
+        for block in packet:
+            seed_id = block.seed_id
+            delta_ns = block.delta_ns
+            start_ns = block.start_ns
+            c_sta = 1.0 / (self.sta_seconds * block.sampling_rate)
+            c_lta = 1.0 / (self.lta_seconds * block.sampling_rate)
+            state = self.state.get(seed_id)
+            nskip = 0 # samples already seen, e.g. packets that overlap by a sample
+            if state:
+                nskip = int(round((state['next_ns'] - start_ns) / delta_ns))
+                if nskip < 0 or nskip >= block.npts: # a gap, or nothing new: start again
+                    state = None
+            if not state:
+                nskip = 0
+                state = {'warm_ns': start_ns + int(self.lta_seconds * 1e9), 
+                         'zi': [np.array([(1.0 - c_lta) * block.data[0]]), np.zeros(1), np.zeros(1)]}
+                self.state[seed_id] = state
+            state['next_ns'] = start_ns + block.npts * delta_ns
+
+            # one-pole (exponential) running mean, then STA and LTA of the squared counts minus that mean
+            x = block.data[nskip:].astype(float)
+            zi_mean, zi_sta, zi_lta = state['zi']
+            mean, zi_mean = signal.lfilter([c_lta], [1.0, c_lta - 1.0], x, zi=zi_mean)
+            energy = (x - mean) ** 2
+            sta, zi_sta = signal.lfilter([c_sta], [1.0, c_sta - 1.0], energy, zi=zi_sta)
+            lta, zi_lta = signal.lfilter([c_lta], [1.0, c_lta - 1.0], energy, zi=zi_lta)
+            state['zi'] = [zi_mean, zi_sta, zi_lta]
+
+            if quiet_data is None: # already not quiet, but every block still needs its STA/LTA updating
+                continue
+            demeaned = block.data.astype(float)
+            demeaned[0:nskip] -= mean[0]
+            demeaned[nskip:] -= mean
+            if not block.sampling_rate in self.peak_gains:
+                self.peak_gains[block.sampling_rate] = filter_peak_gain(block.sampling_rate, self.filterdef)
+            if start_ns < state['warm_ns'] or not seed_id in gains or np.any(sta >= self.trigger_ratio * lta) or \
+               np.max(np.abs(demeaned)) * self.peak_gains[block.sampling_rate] / gains[seed_id] >= quiet_level:
+                quiet_data = None
+                continue
+            quiet_data[seed_id] = demeaned
+        return quiet_data if quiet_data else None
+
+    def count(self, quiet_data):
+        if quiet_data:
+            self.quiet += 1
+        else:
+            self.full += 1
+
+    def report(self):
+        print(f'Quiet gate: {self.quiet} packets took the quiet path, {self.full} the full path')
+
+################################################################################
+class StallWatchdog:
+    ''' 
+    Runs a thread that checks, every check_interval seconds, how long it has been since feed() was last called (i.e. since the last packet
+    arrived). If that exceeds stall_seconds, on_stall(seconds, True) is called, then on_stall(seconds, False) every stall_seconds while the 
+    stall goes on. 
+    This works even while the main thread is blocked inside a client waiting for a packet, which is when latency cannot otherwise be measured.
+    '''
+    def __init__(self, stall_seconds, on_stall, check_interval=1.0, clock=None):
+        self.stall_seconds = stall_seconds
+        self.on_stall = on_stall
+        self.check_interval = min([check_interval, stall_seconds])
+        self.clock = clock or Clock()
+        self.last_feed = self.clock.monotonic_ns()
+        self.next_alarm = self.stall_seconds
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+
+    def start(self):
+        self.last_feed = self.clock.monotonic_ns()
+        self.thread.start()
+
+    def feed(self):
+        self.last_feed = self.clock.monotonic_ns()
+        self.next_alarm = self.stall_seconds
+
+    def watch(self):
+        while not self.stop_event.wait(self.check_interval):
+            self.check()
+
+    def check(self):
+        ''' what the thread does every check_interval. Can also be called directly, e.g. with a SimulatedClock '''
+        seconds = (self.clock.monotonic_ns() - self.last_feed) / 1e9
+        if seconds >= self.next_alarm:
+            new_stall = self.next_alarm == self.stall_seconds
+            self.next_alarm += self.stall_seconds
+            try:
+                self.on_stall(seconds, new_stall)
+            except Exception as e:
+                print(f'Failed to handle stall: {e}')
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.check_interval + 1.0)
+
+################################################################################
+class Clock:
+    '''
+    The wall clock. Everything in the realtime logic that needs the time now - latency and stall alarm timeouts, trimming the latency 
+    and threshold histories, checkpoints, reloading responses, deciding to catch up, holding packets to resequence them - asks a Clock 
+    rather than reading the wall clock itself, so that a SimulatedClock can be passed in instead. Benchmark timings always use the
+    wall clock.
+    '''
+    def now_ns(self):
+        ''' the time now, in integer ns since 1970 '''
+        return now_ns()
+
+    def monotonic_ns(self):
+        ''' a time in integer ns for measuring durations, which never goes backwards '''
+        return time.monotonic_ns()
+
+    def now(self):
+        ''' the time now, as a UTCDateTime '''
+        return to_utc(self.now_ns())
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def observe(self, packet):
+        ''' called with each packet (a list of ChannelBlocks) as it arrives. The wall clock takes no notice of packets '''
+        pass
+
+class SimulatedClock(Clock):
+    '''
+    A clock driven by packet timestamps: each packet moves it on to the time the packet arrived (its loadtime, or its endtime if it has
+    no loadtime), and sleep() moves it on without waiting. It never goes backwards. So realtime behaviour, e.g. latency alarms and their
+    timeouts, can be replayed from recorded or made-up packets as fast as they can be processed.
+    '''
+    def __init__(self, starttime=None):
+        self.t_ns = starttime.ns if starttime else 0
+
+    def now_ns(self):
+        return self.t_ns
+
+    def monotonic_ns(self):
+        return self.t_ns
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.t_ns += int(round(seconds * 1e9))
+
+    def set(self, time):
+        ''' move the clock on to time (a UTCDateTime), unless it is already later '''
+        self.t_ns = max([self.t_ns, time.ns])
+
+    def observe(self, packet):
+        if len(packet) > 0:
+            self.t_ns = max([self.t_ns] + [block.loadtime_ns or block.end_ns for block in packet])
+
 ################################################################################
 class timings():
     def __init__(self, tstart): #SCAFFOLD: added tstart
         self.timings = {}
-        this_time = obspy.UTCDateTime()
-        self.timings['initial_setup'] = this_time - tstart
-        self.last_time = this_time
+        self.timings['initial_setup'] = (now_ns() - tstart.ns) / 1e9
+        self.last_ns = time.perf_counter_ns()
+        self.import_times = IMPORT_TIMES
     
     def update(self, stringID):
-        this_time = obspy.UTCDateTime()
-        tdiff = this_time - self.last_time
+        this_ns = time.perf_counter_ns()
+        tdiff = (this_ns - self.last_ns) / 1e9
         if stringID in self.timings.keys():
             self.timings[stringID] += tdiff
         else:
             self.timings[stringID] = tdiff
-        self.last_time = this_time
+        self.last_ns = this_ns
 
     def report(self, npackets):
         print('\nSUMMARY:')
@@ -404,88 +1799,112 @@ class timings():
                 continue
             v = self.timings[k]
             print(f'Label {k} took {v:5.2f} seconds: average {v*1000/npackets:5.1f} milliseconds per time window')
+        # like python -X importtime, but just for startup and the heavy modules we import when first needed
+        print('IMPORTS:')
+        for k, v in sorted(self.import_times.items(), key=lambda item: -item[1]):
+            print(f'Importing {k} took {v*1000:7.1f} milliseconds')
 
 ################################################################################
 class latency():
     ROWNUM = -1
     def __init__(self, station, seconds_to_keep=600, \
-                 maximum_latency=60, email_list=[], outputdir='.', alarm_timeout=60):
+                 maximum_latency=60, email_list=[], outputdir='.', alarm_timeout=60, clock=None):
         self.rownum = []
         self.seed_id = []
-        self.time = []
+        self.time = [] # time, start and end are in ns. See to_dataframe()
         self.start = []
         self.end = []
         self.min_latency = []
         self.duration = []
         self.station = station
         self.seconds_to_keep = seconds_to_keep
-        self.last_trimmed_time = obspy.UTCDateTime()
+        self.clock = clock or Clock()
+        self.last_trimmed_ns = self.clock.now_ns()
         self.maximum_latency = maximum_latency
         self.last_latency = maximum_latency * 10 # prevent alarm with first set of packets
         self.email_list = email_list
         self.outputdir = outputdir
         self.csvfile = os.path.join(self.outputdir,f'latency_{station}.csv')
-        self.last_alarmtime = obspy.UTCDateTime(1900,1,1) # a dummy value
+        self.last_alarm_ns = 0 # a dummy value
         self.alarm_timeout = alarm_timeout
-        # start the output file
-        row = 'rownum,seed_id,time,starttime,endtime,latency,duration\n'
-        append_to_csvfile(self.csvfile, row)
+        self.stalls = 0 # number of times no packets arrived for stall_seconds
+        self.longest_stall = 0.0
+        # start the output file, unless this station is being restarted
+        if not os.path.isfile(self.csvfile):
+            row = 'rownum,seed_id,time,starttime,endtime,latency,duration\n'
+            append_to_csvfile(self.csvfile, row)
 
-    def update(self, st):
+    def update(self, packet):
         packet_is_late = False
         alarm_seed_ids = []
         max_current_latency = 0.0
-        now = obspy.UTCDateTime()
-
-        for tr in st:
-            self.ROWNUM += 1
-            self.rownum.append(self.ROWNUM)        
-            s = tr.stats
-            this_latency = s.loadtime - s.endtime
-            this_duration = s.endtime - s.starttime + s.delta
-            max_current_latency = max([max_current_latency, this_latency])
-            self.seed_id.append(tr.id)
-            self.time.append(s.loadtime)
-            self.start.append(s.starttime)
-            self.end.append(s.endtime)
-            self.min_latency.append(this_latency)
-            self.duration.append(this_duration)
-            row = f'{self.ROWNUM},{tr.id},{s.loadtime},{s.starttime},{s.endtime},{this_latency},{this_duration}' + '\n'
-            append_to_csvfile(self.csvfile, row)
-
-            # Latency alarm criteria
-            if self.maximum_latency > 0: # maximum_latency must be a positive number, else disable alarms
-                if this_latency > self.maximum_latency: # over the limit
-                    packet_is_late = True
-                    if this_latency > self.last_latency + 0.5: # latency must have increased over previous value - should eliminate startup latency too
-                        alarm_seed_ids.append(tr.id)
-                        
-        # We still only send an alarm if we are beyond the latency_alarm_timeout period 
-        if alarm_seed_ids:
-            if now > self.last_alarmtime + self.alarm_timeout: # did we exceed latency criteria for any seed_id?
-                self.send_alarm(alarm_seed_ids)
-                self.last_alarmtime = now
-        self.last_latency = max_current_latency
-
-        # trim the object
-        if obspy.UTCDateTime() > self.last_trimmed_time + self.seconds_to_keep:
-            self.trim()
+        now = self.clock.now_ns()
+        send_alarm = False
+        trim_now = False
+        rows = ''
+
+        with LATENCY_LOCK: # just while the lists change. the files are written after, so a slow disk cannot hold up the StallWatchdog
+            for block in packet:
+                self.ROWNUM += 1
+                self.rownum.append(self.ROWNUM)        
+                load_ns, start_ns, end_ns = block.loadtime_ns, block.start_ns, block.end_ns
+                this_latency = (load_ns - end_ns) / 1e9
+                this_duration = (end_ns - start_ns) / 1e9 + 1.0 / block.sampling_rate
+                max_current_latency = max([max_current_latency, this_latency])
+                self.seed_id.append(block.seed_id)
+                self.time.append(load_ns)
+                self.start.append(start_ns)
+                self.end.append(end_ns)
+                self.min_latency.append(this_latency)
+                self.duration.append(this_duration)
+                rows += f'{self.ROWNUM},{block.seed_id},{to_utc(load_ns)},{to_utc(start_ns)},{to_utc(end_ns)},{this_latency},{this_duration}' + '\n'
+
+                # Latency alarm criteria
+                if self.maximum_latency > 0: # maximum_latency must be a positive number, else disable alarms
+                    if this_latency > self.maximum_latency: # over the limit
+                        packet_is_late = True
+                        if this_latency > self.last_latency + 0.5: # latency must have increased over previous value - should eliminate startup latency too
+                            alarm_seed_ids.append(block.seed_id)
+                            
+            # We still only send an alarm if we are beyond the latency_alarm_timeout period 
+            if alarm_seed_ids:
+                if now > self.last_alarm_ns + int(self.alarm_timeout * 1e9): # did we exceed latency criteria for any seed_id?
+                    send_alarm = True
+                    self.last_alarm_ns = now
+            self.last_latency = max_current_latency
+
+            # trim the object
+            if now > self.last_trimmed_ns + int(self.seconds_to_keep * 1e9):
+                self.trim()
+                trim_now = True
+
+        if rows:
+            append_to_csvfile(self.csvfile, rows)
+        if trim_now:
             trim_csvfile(self.csvfile)
-
+        if send_alarm: # outside the lock, which send_alarm() takes again to plot
+            self.send_alarm(alarm_seed_ids)
         return packet_is_late 
 
     def plot(self, outfile='latency.png', seed_ids=None, load_csv=False, title=None):
+        pd = lazy_import('pandas')
         timecol = 'time'
         ycol = 'min_latency'
         if load_csv:
             df = pd.read_csv(self.csvfile)
             df['datetime'] = [obspy.UTCDateTime(tstr).datetime for tstr in df[timecol]]    
         else:
-            self.trim() # trim so we always have a consistent 10-minute plot, or whatever seconds_to_keep is set to
-            df = self.to_dataframe()
+            with LATENCY_LOCK: # the StallWatchdog thread plots too
+                self.trim() # trim so we always have a consistent 10-minute plot, or whatever seconds_to_keep is set to
+                df = self.to_dataframe()
             df['datetime'] = [t.datetime for t in df[timecol]]
-        seed_ids = df['seed_id'].unique()
 
+        with PLOT_LOCK:
+            self._plot(df, ycol, outfile)
+
+    def _plot(self, df, ycol, outfile):
+        plt = lazy_import('matplotlib.pyplot')
+        seed_ids = df['seed_id'].unique()
         fig, ax = plt.subplots(1,1)
         cols = ['k', 'b', 'g']
         for index,seed_id in enumerate(seed_ids):
@@ -508,24 +1927,26 @@ class latency():
         plt.close()
 
     def to_dataframe(self):
+        pd = lazy_import('pandas')
         df = pd.DataFrame()
         df['rownum'] = self.rownum
         df['seed_id'] = self.seed_id
-        df['time'] = self.time
-        df['start'] = self.start
-        df['end'] = self.end
+        df['time'] = [to_utc(t) for t in self.time]
+        df['start'] = [to_utc(t) for t in self.start]
+        df['end'] = [to_utc(t) for t in self.end]
         df['min_latency'] = self.min_latency
         df['duration'] = self.duration
         return df
 
     def report(self):
-        df = self.to_dataframe()
+        with LATENCY_LOCK:
+            df = self.to_dataframe()
         print('Latency DataFrame:\n',df)
         print('Latency DataFrame stats:\n',df.describe())
 
     def trim(self):
         # find index N where self.time is within the last self.seconds_to_keep seconds
-        N = next(x for x, val in enumerate(self.time) if val>self.time[-1]-self.seconds_to_keep)        
+        N = next(x for x, val in enumerate(self.time) if val>self.time[-1]-int(self.seconds_to_keep * 1e9))        
         self.rownum = self.rownum[N:]
         self.seed_id = self.seed_id[N:]
         self.time = self.time[N:]
@@ -535,6 +1956,7 @@ class latency():
         self.duration = self.duration[N:]
 
     def load(self):
+        pd = lazy_import('pandas')
         df = pd.read_csv(self.csvfile)
         self.rownum = df['rownum']
         self.seed_id = df['seed_id']
@@ -544,13 +1966,39 @@ class latency():
         self.min_latency = df['min_latency']
         self.duration = df['duration']
 
-    def send_alarm(self, seed_ids):
-        now = obspy.UTCDateTime()
+    def stall(self, seed_id, seconds, new_stall=True):
+        ''' 
+        No packets have arrived for seconds seconds, so there is no packet to measure latency on. Count the stall (unless new_stall is 
+        False, i.e. it is the same one as last time), and send a latency alarm for seed_id, as long as it is not within alarm_timeout of 
+        the last one. The late packets that arrive when the stall ends are not alarmed again, unless their latency keeps increasing.
+        '''
+        send_alarm = False
+        with LATENCY_LOCK: # called from the StallWatchdog thread, while the packet loop may be in update()
+            if new_stall:
+                self.stalls += 1
+            self.longest_stall = max([self.longest_stall, seconds])
+            now = self.clock.now_ns()
+            if self.maximum_latency > 0:
+                if now > self.last_alarm_ns + int(self.alarm_timeout * 1e9):
+                    send_alarm = True
+                    self.last_alarm_ns = now
+                self.last_latency = max([self.last_latency, seconds])
+        if send_alarm:
+            self.send_alarm([seed_id], stalled_seconds=seconds)
+
+    def send_alarm(self, seed_ids, stalled_seconds=None):
+        now = self.clock.now()
         station = seed_ids[0].split('.')[1]
         subject = f"Latency Alarm at {station} at {now}"
         body = f"Latency Alarm on {seed_ids} at {now.strftime('%Y-%m-%dT%H:%M:%S')}"
-        pngfile = os.path.join(self.outputdir, f"latency_alarm_{self.station}_{now.strftime('%Y%m%d%H%M%S')}.png")
-        self.plot(outfile=pngfile, load_csv=False)
+        pngfile = None
+        if stalled_seconds:
+            body += f": no packets for {stalled_seconds:.0f} seconds"
+        with LATENCY_LOCK:
+            packets_arrived = len(self.time) > 0
+        if packets_arrived: # nothing to plot if no packets have arrived yet
+            pngfile = os.path.join(self.outputdir, f"latency_alarm_{self.station}_{now.strftime('%Y%m%d%H%M%S')}.png")
+            self.plot(outfile=pngfile, load_csv=False)
         send_email_alarm(subject, body, self.email_list, pngfile=pngfile, verbose=True)    
 
 ################################################################################
@@ -574,9 +2022,9 @@ def send_email_alarm(subject, body, email_list, pngfile=None, verbose=True):
 
 #######################################
 def append_to_csvfile(csvfile, row, timeout=0.3):
-    now = obspy.UTCDateTime()
+    deadline = time.monotonic_ns() + int(timeout * 1e9)
     success = False
-    while obspy.UTCDateTime() - now < timeout:
+    while time.monotonic_ns() < deadline:
         try:
             with open(csvfile, 'a') as fptr:
                 fcntl.flock(fptr, fcntl.LOCK_EX | fcntl.LOCK_NB) # lock the file
@@ -588,7 +2036,7 @@ def append_to_csvfile(csvfile, row, timeout=0.3):
             print('Exception in append_to_csvfile\n',e)
             time.sleep(0.05)
     if not success:
-        raise IOError(f'Terminating in append_to_csvfile function at {now} for {csvfile}') 
+        raise IOError(f'Terminating in append_to_csvfile function at {obspy.UTCDateTime()} for {csvfile}') 
 """
 def trim_csvfile(csvfile, seconds=100.0, timeout=0.3):
     # idea is just to keep up to one hour of rows in the CSV files, so they do not become too large
@@ -654,10 +2102,10 @@ def trim_csvfile(csvfile, seconds=None, timeout=0.1):
     if numlines <= numlinestokeep:
         return
 
-    now = obspy.UTCDateTime()
+    deadline = time.monotonic_ns() + int(timeout * 1e9)
     read=False
     lines=[]
-    while obspy.UTCDateTime() - now < timeout and read==False:
+    while time.monotonic_ns() < deadline and read==False:
         try:
             with open(csvfile, 'r') as fptr:
                 fcntl.flock(fptr, fcntl.LOCK_EX | fcntl.LOCK_NB) # lock the file so nothing else messes with it
@@ -670,8 +2118,8 @@ def trim_csvfile(csvfile, seconds=None, timeout=0.1):
 
     if len(lines)>numlinestokeep:
         written=False
-        now = obspy.UTCDateTime()
-        while obspy.UTCDateTime() - now < timeout and written==False:
+        deadline = time.monotonic_ns() + int(timeout * 1e9)
+        while time.monotonic_ns() < deadline and written==False:
             try:
                 with open(csvfile, 'w') as fptr2:
                     fcntl.flock(fptr2, fcntl.LOCK_EX | fcntl.LOCK_NB) # lock the file so nothing else messes with it
@@ -682,7 +2130,9 @@ def trim_csvfile(csvfile, seconds=None, timeout=0.1):
             except Exception as e:
                 print(f'Exception writing lines to {csvfile}: {e}')
 
-def get_params(argv):
+def get_params(argv, clock=None):
+    ''' the parameters from the parameter file and command line. Whether to run in realtime or archive mode depends on whether
+    endtime is past by clock: the wall clock by default, or with simulated_clock, a SimulatedClock starting at starttime '''
 
     ###########################################################################
     # SETTING UP PARAMETERS FROM COMMAND LINE & PARAMETER FILE
@@ -724,11 +2174,13 @@ def get_params(argv):
             udt = obspy.UTCDateTime(udt)
         return obspy.UTCDateTime(round(udt.timestamp-0.5)) # 0.5 second subtraction makes this behave like a floor function - rounds down
 
-    params['starttime'] = round_utcdatetime(params['starttime']) if 'starttime' in params else round_utcdatetime(obspy.UTCDateTime()) # just rounds to the nearest second
+    params['starttime'] = round_utcdatetime(params['starttime']) if 'starttime' in params else round_utcdatetime((clock or Clock()).now()) # just rounds to the nearest second
     params['endtime'] = round_utcdatetime(params['endtime']) if 'endtime' in params else obspy.UTCDateTime(2099,12,31)
     if 'duration' in params and params['duration']>0.0:
         params['endtime'] = params['starttime'] + params['duration']
-    if params['endtime']<obspy.UTCDateTime(): # if endtime is in past, turn on archive mode
+    if not clock:
+        clock = SimulatedClock(params['starttime']) if params.get('simulated_clock') else Clock()
+    if params['endtime']<clock.now(): # if endtime is in past, turn on archive mode
         params['mode']='archive'
     else:
         params['mode']='realtime'
@@ -8,23 +8,37 @@ Description: This library provides a consistent data ingestion interface with sl
              waveform data since the previous chunk of data was fetched. Each packet is fetched as an ObsPy Stream object and contains 1 or many Trace objects.
 
              DatascopeClient (a new class, defined below) accomplishes this by wrapping wf2obspy's get_waveforms() function, which does the heavy lifting..
+             If Antelope is not installed, wfdisc2obspy's get_waveforms() function, which reads wfdisc tables directly, is used instead.
+
+             In archive mode, a background thread reads ahead several packets at a time, so the next chunk of data is being loaded from disk
+             while the current packet is being processed.
 """
 
 import sys
+import time
 from obspy import UTCDateTime
 from os import path
 import numpy as np
+import threading
+import queue
 
 thisdir = path.realpath(path.dirname(__file__))
 pymodsdir = path.join(thisdir.split('rt')[0], 'pymodules')
 sys.path.append(pymodsdir)
-import wf2obspy
+antelope_imported = False
+try:
+    import wf2obspy
+    antelope_imported = True
+except (ImportError, KeyError): # KeyError if $ANTELOPE is not set
+    print('antelope not imported: using wfdisc2obspy instead of wf2obspy')
+import wfdisc2obspy
+from data_ingestion import stream2blocks, to_utc
 
 class DatascopeClient(object):
 
     DEFAULT_DB = "/aec/db/waveforms/waveforms"
 
-    def __init__(self, dbname, secondsPerPacket=1.0, starttime=None, mode='realtime'): 
+    def __init__(self, dbname, secondsPerPacket=1.0, starttime=None, mode='realtime', endtime=None, readahead_packets=0, read_timeout=0.0): 
         """ 
         initializes a DatascopeClient object with a single attribute - 
 
@@ -32,6 +46,10 @@ class DatascopeClient(object):
             dbname (str, optional): a database name. If blank "", defaults to AEC waveforms db
             secondsPerPacket (float, optional): limits the maximum 'packet' to the last secondsPerPacket seconds (default: 1.0). But starttime can be shifted with dbstarttime parameter.
             starttime (UTCDateTime, optional): Start the packet at this time, and end secondsPerPacket later, or current time (whichever is earlier).
+            mode (str, optional): 'realtime' or 'archive'
+            endtime (UTCDateTime, optional): in archive mode, read ahead no further than this time
+            readahead_packets (int, optional): in archive mode, read this many packets of data per read, in a background thread (default: 0, i.e. off)
+            read_timeout (float, optional): in realtime mode, raise TimeoutError if no packet is complete within this many seconds (default: 0, i.e. wait forever)
 
         Returns:
             an ObsPy Stream object containing 1 or many Trace objects, corresponding to the data packet
@@ -46,6 +64,15 @@ class DatascopeClient(object):
             self.starttime = UTCDateTime()
 
         self.mode = mode
+        self.endtime = endtime
+        self.readahead_packets = readahead_packets
+        self.read_timeout = read_timeout
+
+        # read-ahead state: the chunk currently being sliced into packets, and the background thread filling a queue with the next chunks
+        self.chunk = None # tuple of (chunk_starttime, chunk_endtime, Stream)
+        self.chunk_queue = None
+        self.readahead_thread = None
+        self.readahead_stop = None
 
     def select_stream(self, network, station, location, channel):
         """
@@ -89,12 +116,21 @@ class DatascopeClient(object):
         
         max_nsecs = 0.0 # total seconds of data in the "packet"
         got_data = False
+        # in realtime mode, wait between polls rather than re-reading the database as fast as possible: first until the end of the packet 
+        # should have been written, then for poll_interval, which doubles (up to secondsPerPacket) each time there is still not enough data
+        poll_interval = self.secondsPerPacket / 10
+        deadline = time.monotonic() + self.read_timeout if self.read_timeout else None
         
         while not got_data:
-            if self.dbname == 'default' and self.mode =='archive':
-                st = wf2obspy.get_waveforms(self.network, self.station, self.location, self.channel, starttime, endtime)
-            else: # SCAFFOLD> was getting nothing back so removing dbname from call
-                st = wf2obspy.get_waveforms(self.network, self.station, self.location, self.channel, starttime, endtime ) #, dbname=self.dbname)
+            if self.mode == 'realtime':
+                if starttime + self.secondsPerPacket > NOW: # packet not due yet
+                    time.sleep(starttime + self.secondsPerPacket - NOW)
+                    NOW = UTCDateTime()
+                endtime = min([NOW, starttime + self.secondsPerPacket])
+            if self.mode == 'archive' and self.readahead_packets > 0:
+                st = self.readahead_slice(starttime, endtime)
+            else:
+                st = self.get_waveforms(starttime, endtime)
             if verbose:
                 print('wf2obspy returned ',st)
             # returns nan in place of missing data. so remove trailing nan.
@@ -126,8 +162,10 @@ class DatascopeClient(object):
                     else:
                         if verbose:
                             print(f'datascope2obspy still only got {max_nsecs} seconds of data')
+                        poll_interval = self.wait_to_poll(poll_interval, deadline)
             elif self.mode == 'realtime':
-                # we are in realtime mode, and got no (non-nan) data. so we loop again.
+                # we are in realtime mode, and got no (non-nan) data. so we wait, and loop again.
+                poll_interval = self.wait_to_poll(poll_interval, deadline)
                 continue
             else:
                 # we are in archive mode, and got no (non-nan) data. looping again is pointless, as nothing new coming. so increment time by one packet length.
@@ -136,10 +174,125 @@ class DatascopeClient(object):
 
         return st
 
+    def nextpacket2Blocks(self, starttime_ns=None, verbose=False):
+        """
+        Fetches the next packet from a Datascope wfdisc table, as nextpacket2Stream() does, and returns it as a list of data_ingestion.ChannelBlocks, which is 
+        what data_ingestion.py processes
+
+        Parameters:
+            starttime_ns (int, optional): starttime for nextpacket2Stream(), in ns
+
+        Returns:
+            a list with one ChannelBlock per Trace of the packet, sharing its data array, and keeping its loadtime (and seqnum, if any)
+        """
+        starttime = to_utc(starttime_ns) if starttime_ns is not None else None
+        return stream2blocks(self.nextpacket2Stream(starttime=starttime, verbose=verbose))
+
+    def wait_to_poll(self, poll_interval, deadline):
+        """ Sleeps for poll_interval seconds, and returns the next poll interval. Raises TimeoutError if that would take us past deadline """
+        if deadline and time.monotonic() + poll_interval > deadline:
+            raise TimeoutError(f'no complete packet from {self.dbname} for {self.read_timeout} seconds')
+        time.sleep(poll_interval)
+        return min([poll_interval * 2, self.secondsPerPacket])
+
+    def get_waveforms(self, starttime, endtime):
+        """ Reads the selected streams from starttime to endtime with wf2obspy (or wfdisc2obspy if Antelope is not installed) """
+        get_waveforms = wf2obspy.get_waveforms if antelope_imported else wfdisc2obspy.get_waveforms
+        if self.dbname == 'default' and self.mode =='archive':
+            return get_waveforms(self.network, self.station, self.location, self.channel, starttime, endtime)
+        elif not antelope_imported and self.dbname != 'default': # a database of our own, e.g. a test fixture
+            return get_waveforms(self.network, self.station, self.location, self.channel, starttime, endtime, dbname=self.dbname)
+        else: # SCAFFOLD> was getting nothing back so removing dbname from call
+            return get_waveforms(self.network, self.station, self.location, self.channel, starttime, endtime ) #, dbname=self.dbname)
+
+    def start_readahead(self, starttime):
+        """ (Re)starts the background thread that reads chunks of readahead_packets packets from starttime onwards """
+        self.stop_readahead()
+        self.readahead_stop = threading.Event()
+        self.chunk = None
+        self.chunk_queue = queue.Queue(maxsize=2) # double buffering: at most 2 chunks waiting, while another is being sliced
+        self.readahead_thread = threading.Thread(target=self.readahead_worker, args=(starttime,), daemon=True)
+        self.readahead_thread.start()
+
+    def stop_readahead(self):
+        if self.readahead_thread:
+            self.readahead_stop.set()
+            while self.readahead_thread.is_alive(): # drain the queue so the worker is not blocked on put()
+                try:
+                    self.chunk_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        # drop the thread, queue and event (and any cached data), so this object can be pickled, e.g. to return it from a multiprocessing Pool
+        self.readahead_thread = None
+        self.readahead_stop = None
+        self.chunk_queue = None
+        self.chunk = None
+
+    def readahead_worker(self, starttime):
+        """ runs in a background thread, putting (chunk_starttime, chunk_endtime, Stream) tuples on the queue, then None when done """
+        readahead_stop = self.readahead_stop
+        chunk_queue = self.chunk_queue
+        chunk_seconds = self.readahead_packets * self.secondsPerPacket
+        t = starttime
+        while not readahead_stop.is_set() and (not self.endtime or t < self.endtime):
+            t2 = t + chunk_seconds
+            if self.endtime:
+                t2 = min([t2, self.endtime])
+            try:
+                st = self.get_waveforms(t, t2)
+            except Exception as e:
+                print(f'datascope2obspy read-ahead failed for {t} to {t2}: {e}')
+                break
+            while not readahead_stop.is_set():
+                try:
+                    chunk_queue.put((t, t2, st), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            t = t2
+        chunk_queue.put(None)
+
+    def next_chunk(self):
+        """ get the next chunk from the read-ahead queue. returns None if the read-ahead thread has finished """
+        if not self.readahead_thread:
+            return None
+        chunk = self.chunk_queue.get()
+        if chunk is None:
+            self.readahead_thread = None
+            self.readahead_stop = None
+            self.chunk_queue = None
+        return chunk
+
+    def readahead_slice(self, starttime, endtime):
+        """
+        Returns the packet from starttime to endtime, sliced from the chunks read ahead in the background thread.
+        Falls back to a direct read if the packet lies outside what the read-ahead thread can provide.
+        """
+        if self.readahead_thread is None and self.chunk is None:
+            self.start_readahead(starttime)
+        elif self.chunk and starttime < self.chunk[0]: # we have gone backwards in time
+            self.start_readahead(starttime)
+
+        # advance (or extend) the current chunk until it covers the whole packet
+        while self.chunk is None or endtime > self.chunk[1]:
+            chunk = self.next_chunk()
+            if chunk is None:
+                break
+            if self.chunk is None or starttime >= self.chunk[1]:
+                self.chunk = chunk
+            else: # packet straddles two chunks, so join the end of the current chunk to the next one
+                st = self.chunk[2].slice(starttime=starttime) + chunk[2]
+                st.merge(method=1)
+                self.chunk = (starttime, chunk[1], st)
+
+        if self.chunk is None or starttime < self.chunk[0] or endtime > self.chunk[1]:
+            return self.get_waveforms(starttime, endtime)
+        return self.chunk[2].slice(starttime=starttime, endtime=endtime).copy()
+
     def close(self):
         """ 
-        Added for consistency. 
-        Does nothing because wf2obspy.get_waveforms opens and closes database
+        Stops the read-ahead thread, if there is one. 
+        Otherwise does nothing because wf2obspy.get_waveforms opens and closes database
         with each read
         """
-        pass
+        self.stop_readahead()
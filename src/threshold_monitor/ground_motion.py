@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+File: ground_motion.py
+Author: Glenn Thompson
+Date: 2026-10-19
+Description: This library computes ground-motion metrics other than PGA from the processed (highpass filtered, calibrated) acceleration
+             packets that threshold_monitor.py analyzes, so they can be thresholded in the same way:
+
+             PGV      peak ground velocity (m/s), from recursive (trapezoidal) integration of acceleration. The integrator leaks at the
+                      highpass corner frequency, so it does not drift.
+             PSA<T>   5%-damped pseudo-spectral acceleration (m/s^2) at period T seconds, e.g. PSA0.3 or PSA1.0, from a recursive
+                      filter that models a damped single-degree-of-freedom oscillator.
+             CAV      cumulative absolute velocity (m/s): the integral of |acceleration| over the last cumulative_seconds.
+             ARIAS    Arias intensity (m/s): pi/2g times the integral of acceleration squared over the last cumulative_seconds.
+             PGA<W>   peak ground acceleration (m/s^2) over a sliding window of W seconds, e.g. PGA5.0, however long the packets are.
+                      This is a running maximum (see RunningMax), so each sample is handled once.
+
+             combined_peaks() combines the channels of a station into the vector-sum horizontal (or 3-D), or geometric-mean horizontal,
+             peak acceleration, which can be thresholded instead of the peak acceleration of each channel (see pga_component).
+
+             GroundMotionMetrics (a new class, defined below) is incremental: the filter state for each SEED id is carried from one packet
+             (or archive chunk) to the next, so each sample is only filtered once, rather than re-processing the whole buffer for every
+             packet. Channels with the same sampling rate and length (e.g. the 3 channels of a station) are filtered together, as one 2-D array.
+"""
+from collections import deque
+import numpy as np
+from data_ingestion import chunk_packets, lazy_import
+
+G = 9.80665 # m/s^2. threshold_monitor.py converts thresholds in g with this too
+METRIC_UNITS = {'PGA':'m/s^2', 'PGV':'m/s', 'PSA':'m/s^2', 'CAV':'m/s', 'ARIAS':'m/s'}
+
+def parse_metric(metric):
+    """
+    Splits a metric name into its type and period (or window length), e.g. 'PSA0.3' -> ('PSA', 0.3), 'PGA5.0' -> ('PGA', 5.0), 
+    'PGV' -> ('PGV', None). Raises ValueError if unknown
+    """
+    metric = metric.upper()
+    if metric[0:3] in ['PSA', 'PGA'] and len(metric) > 3:
+        try:
+            period = float(metric[3:])
+        except ValueError:
+            raise ValueError(f'{metric}: {metric[0:3]} needs a period or window length in seconds, e.g. {metric[0:3]}1.0')
+        if period <= 0.0:
+            raise ValueError(f'{metric}: period or window length must be positive')
+        return metric[0:3], period
+    if metric in METRIC_UNITS:
+        return metric, None
+    raise ValueError(f'Unknown ground-motion metric {metric}. Choose from PGA, PGV, PSA<period>, CAV, ARIAS')
+
+def metric_units(metric):
+    """ Returns the units of a metric, e.g. 'm/s' for PGV """
+    return METRIC_UNITS[parse_metric(metric)[0]]
+
+def oscillator_coefficients(period, damping, sampling_rate):
+    """
+    Returns IIR filter coefficients (b, a) that turn ground acceleration into the relative displacement of a damped oscillator.
+    This is the bilinear transform of H(s) = 1 / (s^2 + 2*damping*w*s + w^2), with w prewarped so the natural frequency is exact,
+    and scaled so the static (zero frequency) response is exact too.
+
+    Parameters:
+        period (float): natural period of the oscillator, in seconds. Must be more than 4 samples long
+        damping (float): fraction of critical damping, e.g. 0.05
+        sampling_rate (float): in Hz
+
+    Returns:
+        (b, a) for scipy.signal.lfilter
+    """
+    if period * sampling_rate < 4.0:
+        raise ValueError(f'PSA period {period} s is too short for {sampling_rate} Hz data')
+    w = 2 * np.pi / period
+    wp = 2 * sampling_rate * np.tan(w / (2 * sampling_rate))
+    signal = lazy_import('scipy.signal')
+    b, a = signal.bilinear([1.0], [1.0, 2 * damping * wp, wp**2], sampling_rate)
+    return b * (wp / w)**2, a
+
+def integrator_coefficients(corner, sampling_rate):
+    """ Returns IIR filter coefficients (b, a) for trapezoidal integration that leaks (forgets) at corner Hz, e.g. the highpass corner """
+    dt = 1.0 / sampling_rate
+    leak = np.exp(-2 * np.pi * corner * dt)
+    return np.array([dt / 2, dt / 2]), np.array([1.0, -leak])
+
+class GroundMotionMetrics(object):
+
+    def __init__(self, metrics, damping=0.05, corner=0.05, cumulative_seconds=60.0):
+        """
+        Parameters:
+            metrics (list of str): metrics to compute, e.g. ['PGV', 'PSA0.3', 'PSA1.0', 'CAV', 'ARIAS', 'PGA5.0']. PGA of each packet is 
+                                   computed by threshold_monitor.py
+            damping (float, optional): oscillator damping for PSA, as a fraction of critical. Default: 0.05
+            corner (float, optional): corner frequency (Hz) below which velocity is not integrated, so it does not drift. Use the highpass
+                                      filter corner. Default: 0.05
+            cumulative_seconds (float, optional): CAV and Arias intensity are integrated over this many seconds. Default: 60
+        """
+        self.metrics = [metric.upper() for metric in metrics]
+        self.metric_types = {metric: parse_metric(metric) for metric in self.metrics}
+        self.damping = damping
+        self.corner = corner
+        self.cumulative_seconds = cumulative_seconds
+        self.coefficients = {} # (metric, sampling_rate) -> (b, a)
+        self.state = {} # seed_id -> {'next_ns': time of the next sample, 'zi': {metric: filter state}, 'cumulative': {metric: [deque, total]}, 
+                        #             'running_max': {metric: RunningMax}}
+
+    def filter_metrics(self):
+        """ metrics that need a recursive filter: PGV and PSA """
+        return [metric for metric in self.metrics if self.metric_types[metric][0] in ['PGV', 'PSA']]
+
+    def get_coefficients(self, metric, sampling_rate):
+        key = (metric, sampling_rate)
+        if not key in self.coefficients:
+            kind, period = self.metric_types[metric]
+            if kind == 'PGV':
+                self.coefficients[key] = integrator_coefficients(self.corner, sampling_rate)
+            else:
+                self.coefficients[key] = oscillator_coefficients(period, self.damping, sampling_rate)
+        return self.coefficients[key]
+
+    def new_state(self, nextsample_ns, sampling_rate):
+        zi = {}
+        for metric in self.filter_metrics():
+            b, a = self.get_coefficients(metric, sampling_rate)
+            zi[metric] = np.zeros(max([len(a), len(b)]) - 1)
+        cumulative = {metric: [deque(), 0.0] for metric in self.metrics if self.metric_types[metric][0] in ['CAV', 'ARIAS']}
+        running_max = {metric: RunningMax(self.metric_types[metric][1]) for metric in self.metrics if self.metric_types[metric][0] == 'PGA'}
+        return {'next_ns': nextsample_ns, 'zi': zi, 'cumulative': cumulative, 'running_max': running_max}
+
+    def continues(self, block):
+        """ True if ChannelBlock block follows on from (or overlaps) the samples already processed for its SEED id, so its filter state carries over """
+        state = self.state.get(block.seed_id)
+        return bool(state) and block.start_ns <= state['next_ns'] + block.delta_ns // 2
+
+    def align(self, block):
+        """
+        Returns the samples of ChannelBlock block that come after those already processed for its SEED id (packets may overlap by a 
+        sample), and its nan_mask (if any) to match. If there is a gap before block, or this is the first block for its SEED id, its
+        filter state is reset.
+        """
+        delta_ns = block.delta_ns
+        start_ns = block.start_ns
+        data = block.data
+        nan_mask = block.nan_mask
+        state = self.state.get(block.seed_id)
+        if not self.continues(block): # new, or gap
+            self.state[block.seed_id] = self.new_state(start_ns, block.sampling_rate)
+        elif start_ns < state['next_ns'] - delta_ns // 2: # overlap
+            nskip = int(round((state['next_ns'] - start_ns) / delta_ns))
+            data = data[nskip:]
+            if nan_mask is not None:
+                nan_mask = nan_mask[nskip:]
+            start_ns += nskip * delta_ns
+        return data, nan_mask, start_ns, delta_ns
+
+    def update(self, packet, window_seconds=None):
+        """
+        Computes each metric for each ChannelBlock of a packet, or for each window_seconds window of a processed archive chunk.
+
+        Parameters:
+            packet (list of data_ingestion.ChannelBlock): processed acceleration (m/s^2), following on in time from the last packet 
+                               passed in. Blocks may have a boolean nan_mask (see data_ingestion.RealTimeDataClient.process_chunk), in which
+                               case windows with no real data are left out
+            window_seconds (float, optional): split each block into windows this long. Default: None, i.e. one window per block
+
+        Returns:
+            a dict of metric -> a list with one dict per window, each of which maps seed_id -> {'value', 'starttime', 'endtime', 'peaktime'},
+            with times in ns, like threshold_monitor.MyDataClient.computePGA()
+        """
+        signal = lazy_import('scipy.signal')
+        metric_dicts = {metric: [] for metric in self.metrics}
+
+        # align each block with the last one for its SEED id, then group blocks that can be filtered together
+        groups = {} # (sampling_rate, npts) -> list of (seed_id, data, nan_mask, start_ns, delta_ns)
+        for block in packet:
+            data, nan_mask, start_ns, delta_ns = self.align(block)
+            if len(data) == 0:
+                continue
+            self.state[block.seed_id]['next_ns'] = start_ns + len(data) * delta_ns
+            groups.setdefault((block.sampling_rate, len(data)), []).append((block.seed_id, data, nan_mask, start_ns, delta_ns))
+
+        for (sampling_rate, npts), traces in groups.items():
+            X = np.array([data for (seed_id, data, nan_mask, start_ns, delta_ns) in traces], dtype=float)
+            dt = 1.0 / sampling_rate
+            nper = npts if not window_seconds else int(round(window_seconds * sampling_rate))
+            nwin = int(np.ceil(npts / nper))
+
+            # the value of each metric for every (trace, window), and the index of the sample within the window it peaked at
+            values = {}
+            for metric in self.metrics:
+                kind, period = self.metric_types[metric]
+                if kind in ['PGV', 'PSA']:
+                    b, a = self.get_coefficients(metric, sampling_rate)
+                    zi = np.array([self.state[seed_id]['zi'][metric] for (seed_id, *rest) in traces])
+                    Y, zf = signal.lfilter(b, a, X, axis=1, zi=zi)
+                    for i, (seed_id, *rest) in enumerate(traces):
+                        self.state[seed_id]['zi'][metric] = zf[i]
+                    Y = np.abs(Y)
+                    if kind == 'PSA':
+                        Y *= (2 * np.pi / period)**2
+                    Y = pad_windows(Y, nwin, nper)
+                    ind_max = np.argmax(Y, axis=2)
+                    values[metric] = (np.take_along_axis(Y, ind_max[..., np.newaxis], axis=2)[..., 0], ind_max)
+                elif kind == 'PGA': # running maximum, updated window by window below
+                    values[metric] = (None, None)
+                else: # CAV or ARIAS: the integral over each window, accumulated below
+                    Y = np.abs(X) if kind == 'CAV' else X**2 * np.pi / (2 * G)
+                    values[metric] = (pad_windows(Y, nwin, nper).sum(axis=2) * dt, None)
+
+            for i, (seed_id, data, nan_mask, start_ns, delta_ns) in enumerate(traces):
+                no_data = np.zeros(nwin, dtype=bool)
+                if nan_mask is not None:
+                    no_data = pad_windows(nan_mask[np.newaxis, :], nwin, nper, fill=True)[0].all(axis=1)
+                for w in range(nwin):
+                    wstart_ns = start_ns + w * nper * delta_ns
+                    wend_ns = wstart_ns + (min([nper, npts - w * nper]) - 1) * delta_ns
+                    for metric in self.metrics:
+                        value, ind_max = values[metric]
+                        if value is None: # running maximum, over the sliding windows ending at each sample of this window
+                            running_max = self.state[seed_id]['running_max'][metric]
+                            this_value, peak_ns = running_max.update(X[i, w*nper:(w+1)*nper], wstart_ns, delta_ns)
+                        elif ind_max is None: # cumulative metric: add this window, and forget windows older than cumulative_seconds
+                            windows, total = self.state[seed_id]['cumulative'][metric]
+                            windows.append((wend_ns, value[i, w]))
+                            total += value[i, w]
+                            while windows[0][0] <= wend_ns - self.cumulative_seconds * 1e9:
+                                total -= windows.popleft()[1]
+                            self.state[seed_id]['cumulative'][metric][1] = total
+                            this_value, peak_ns = total, wend_ns
+                        else:
+                            this_value, peak_ns = value[i, w], wstart_ns + ind_max[i, w] * delta_ns
+                        if no_data[w]:
+                            continue
+                        dicts = metric_dicts[metric]
+                        while len(dicts) <= w:
+                            dicts.append(dict())
+                        dicts[w][seed_id] = {'value':float(this_value), 'starttime':wstart_ns, 'endtime':wend_ns, 'peaktime':int(peak_ns)}
+        return metric_dicts
+
+class RunningMax(object):
+
+    def __init__(self, window_seconds):
+        """
+        The running maximum of |x| over a sliding window of window_seconds, for one SEED id. This keeps a deque of the samples that 
+        could still be the maximum of a later window, i.e. those larger than every later sample, as (time in ns, value), so times are 
+        increasing and values decreasing from front to back. Each sample is added and removed at most once, so the cost per sample is 
+        O(1) on average, however long the window or the packets are.
+        """
+        self.window_ns = int(round(window_seconds * 1e9))
+        self.candidates = deque()
+
+    def update(self, x, start_ns, delta_ns):
+        """
+        Adds samples x, the first of which is at start_ns. Returns (value, peak_ns): the largest |x| in any window ending at one of 
+        these samples, i.e. in (start_ns - window, last sample], and the time it occurred
+        """
+        candidates = self.candidates
+        cutoff = start_ns - self.window_ns
+        while candidates and candidates[0][0] <= cutoff:
+            candidates.popleft()
+        a = np.abs(x)
+        if len(a) > 0:
+            # samples of x larger than every later sample of x, found without a Python loop over samples
+            later_max = np.empty(len(a))
+            later_max[-1] = -np.inf
+            later_max[0:-1] = np.maximum.accumulate(a[::-1])[::-1][1:]
+            ind = np.flatnonzero(a > later_max)
+            while candidates and candidates[-1][1] <= a[ind[0]]:
+                candidates.pop()
+            candidates.extend(zip((start_ns + ind * delta_ns).tolist(), a[ind].tolist()))
+        peak_ns, value = candidates[0]
+        return value, peak_ns
+
+# ways of combining the channels of a station into one peak acceleration, and the component code that replaces the last letter of 
+# the channel code in the SEED id they are reported under, e.g. AK.PS01..HNH for the vector sum of HNE and HNN
+PGA_COMPONENTS = {'vector_sum':'H', 'vector_sum_3d':'3', 'geometric_mean':'G'}
+
+def combined_peaks(blocks, method, window_seconds=None):
+    """
+    Combines the channels of a station, sample by sample, into one peak acceleration per window. The channels are aligned on their 
+    common time span by integer sample offsets, and the combination and peak search are done on the aligned 2-D array in one pass.
+
+    Parameters:
+        blocks (list of data_ingestion.ChannelBlock): processed acceleration for one station, e.g. HNE, HNN and HNZ. Horizontal 
+                           channels end in E, N, 1 or 2, and vertical channels in Z or 3. Blocks may have a nan_mask, as in computePGA_chunk()
+        method (str): one of
+                      vector_sum      the peak of sqrt(E^2 + N^2), i.e. the largest horizontal acceleration in any direction
+                      vector_sum_3d   the peak of sqrt(E^2 + N^2 + Z^2)
+                      geometric_mean  the peak of sqrt(|E| x |N|)
+        window_seconds (float, optional): split the aligned data into windows this long. Default: None, i.e. one window
+
+    Returns:
+        a list with one dict per window, each mapping the combined SEED id to {'value', 'starttime', 'endtime', 'peaktime'}, with times
+        in ns, like threshold_monitor.MyDataClient.computePGA_chunk(). Windows without data for every channel are empty. The list is empty 
+        if the channels needed are missing, or do not overlap
+    """
+    horizontals = [block for block in blocks if block.seed_id[-1] in 'EN12']
+    verticals = [block for block in blocks if block.seed_id[-1] in 'Z3']
+    channels = horizontals[0:2] + (verticals[0:1] if method == 'vector_sum_3d' else [])
+    if len(horizontals) < 2 or (method == 'vector_sum_3d' and not verticals):
+        return []
+    sampling_rate = channels[0].sampling_rate
+    if any([block.sampling_rate != sampling_rate for block in channels]):
+        return []
+    delta_ns = int(round(1e9 / sampling_rate))
+    start_ns = max([block.start_ns for block in channels])
+    end_ns = min([block.end_ns for block in channels])
+    if end_ns < start_ns:
+        return []
+    npts = int(round((end_ns - start_ns) / delta_ns)) + 1
+
+    # align: a view of the common time span of each block
+    offsets = [int(round((start_ns - block.start_ns) / delta_ns)) for block in channels]
+    npts = min([npts] + [block.npts - i0 for block, i0 in zip(channels, offsets)])
+    X = np.array([block.data[i0:i0+npts] for block, i0 in zip(channels, offsets)], dtype=float)
+    nan_masks = [block.nan_mask[i0:i0+npts] for block, i0 in zip(channels, offsets) if block.nan_mask is not None]
+
+    nper = npts if not window_seconds else int(round(window_seconds * sampling_rate))
+    if window_seconds and all([block.packet_starts is not None and i0 % nper == 0 for block, i0 in zip(channels, offsets)]):
+        # a processed archive chunk: one window per packet, as the packet loop would have processed it
+        packets = [(data[i0//nper:], nan[i0//nper:]) for (data, nan), i0 in zip([chunk_packets(block, nper) for block in channels], offsets)]
+        nwin = min([len(data) for data, nan in packets])
+        W = np.array([data[0:nwin] for data, nan in packets], dtype=float) # (channel, window, sample)
+        no_data = np.array([nan[0:nwin].all(axis=1) for data, nan in packets]).any(axis=0)
+        window_npts = [nper + 1] * nwin
+    else:
+        nwin = int(np.ceil(npts / nper))
+        W = pad_windows(X, nwin, nper)
+        no_data = np.zeros(nwin, dtype=bool)
+        for nan_mask in nan_masks:
+            no_data |= pad_windows(nan_mask[np.newaxis, :], nwin, nper, fill=True)[0].all(axis=1)
+        window_npts = [min([nper, npts - w * nper]) for w in range(nwin)]
+    if method == 'geometric_mean':
+        A = np.sqrt(np.abs(W[0]) * np.abs(W[1])) # (window, sample)
+    else:
+        A = np.sqrt(np.einsum('ijk,ijk->jk', W, W))
+    ind_max = np.argmax(A, axis=1)
+    values = A[np.arange(nwin), ind_max]
+
+    seed_id = channels[0].seed_id[0:-1] + PGA_COMPONENTS[method]
+    peak_dicts = []
+    for w in range(nwin):
+        peak_dicts.append(dict())
+        if no_data[w]:
+            continue
+        wstart_ns = start_ns + w * nper * delta_ns
+        wend_ns = wstart_ns + (window_npts[w] - 1) * delta_ns
+        peak_dicts[w][seed_id] = {'value':float(values[w]), 'starttime':wstart_ns, 'endtime':wend_ns, \
+                                  'peaktime':wstart_ns + int(ind_max[w]) * delta_ns}
+    return peak_dicts
+
+def pad_windows(Y, nwin, nper, fill=0.0):
+    """ Reshapes a 2-D (trace, sample) array into 3-D (trace, window, sample), padding the last window with fill """
+    ntr, npts = Y.shape
+    if npts == nwin * nper:
+        return Y.reshape(ntr, nwin, nper)
+    padded = np.full((ntr, nwin * nper), fill, dtype=Y.dtype)
+    padded[:, 0:npts] = Y
+    return padded.reshape(ntr, nwin, nper)
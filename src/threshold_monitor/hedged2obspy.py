@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+File: hedged2obspy.py
+Author: Glenn Thompson
+Date: 2026-10-19
+Description: This library provides the same data ingestion interface as slink2obspy, orb2obspy and datascope2obspy, but reads packets from two
+             (or more) sources at the same time, e.g. two Seedlink servers or orbservers carrying the same data, and passes on whichever copy
+             of each packet arrives first. So a slow or stalled server no longer delays alarms, as long as the other one keeps up.
+
+             HedgedClient (a new class, defined below) wraps one client per source, each of which is read in its own thread. Traces are
+             deduplicated by SEED id and start time, using an index of the most recent packets seen. The latency of every copy received
+             from each source is tracked, so report() shows which source is faster.
+"""
+import time
+import threading
+import queue
+from collections import deque
+import numpy as np
+from obspy import Stream, UTCDateTime
+from data_ingestion import stream2blocks
+
+class HedgedClient(object):
+
+    def __init__(self, clients, names=None, index_size=10000, read_timeout=0.0, max_reconnect_backoff=60.0):
+        """
+        Parameters:
+            clients (list): clients for each source, e.g. two SlinkClient objects. Each must have select_stream() and nextpacket2Stream()
+            names (list of str, optional): a name for each source, used in report(). Default: '0', '1', ...
+            index_size (int, optional): how many (SEED id, start time) pairs to remember for deduplication. This needs to cover the
+                                        maximum delay between the two copies of a packet, e.g. 10000 is nearly an hour for 3 channels
+                                        at 1 packet per second
+            read_timeout (float, optional): raise TimeoutError if no new packet arrives from any source within this many seconds. 0 to wait forever
+            max_reconnect_backoff (float, optional): after a source fails, wait 1, 2, 4 ... seconds, up to this many, before reading it again
+        """
+        self.clients = clients
+        self.names = names if names else [str(i) for i in range(len(clients))]
+        self.index_size = index_size
+        self.read_timeout = read_timeout
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.seen = set() # (SEED id, start time in ns) of recent packets
+        self.seen_order = deque() # same, in the order they were added, so the oldest can be forgotten
+        self.source_stats = {name: {'traces':0, 'first':0, 'duplicates':0, 'latencies':deque(maxlen=1000), 'max_latency':0.0} for name in self.names}
+        # the threads, queue and stop event are only created by start(), and removed by close(), so a HedgedClient can still be pickled
+        self.readers = None
+        self.packet_queue = None
+        self.stop_reading = None
+
+    def select_stream(self, network, station, location, channel):
+        """ Selects the same streams (SEED ids) from every source. See slink2obspy.SlinkClient.select_stream() """
+        for client in self.clients:
+            client.select_stream(network, station, location, channel)
+        self.network = network
+        self.station = station
+        self.location = location
+        self.channel = channel
+
+    def move_pointer(self, starttime):
+        """ Moves the pointer of every source to starttime (a UTCDateTime) """
+        for client in self.clients:
+            client.move_pointer(starttime)
+
+    def start(self):
+        """ Starts one reader thread per source. Called by the first call to nextpacket2Stream() """
+        self.packet_queue = queue.Queue()
+        self.stop_reading = threading.Event()
+        self.readers = [threading.Thread(target=self.reader, args=(i, self.packet_queue, self.stop_reading), daemon=True) for i in range(len(self.clients))]
+        for reader in self.readers:
+            reader.start()
+
+    def reader(self, i, packet_queue, stop_reading):
+        """ Reader thread: reads packets from source i, and puts them on the queue as (i, Stream), until stop_reading is set """
+        client = self.clients[i]
+        backoff = 1.0
+        while not stop_reading.is_set():
+            try:
+                st = client.nextpacket2Stream()
+            except TimeoutError as e: # the client reconnects itself, and the other source may still be fine
+                print(f'Source {self.names[i]}: {e}')
+                continue
+            except Exception as e:
+                if stop_reading.is_set(): # client was closed under us
+                    break
+                print(f'Failed to read packet from source {self.names[i]}: {e}. Trying again in {backoff} seconds')
+                stop_reading.wait(backoff)
+                backoff = min([backoff * 2, self.max_reconnect_backoff])
+                continue
+            backoff = 1.0
+            packet_queue.put((i, st))
+
+    def nextpacket2Stream(self, starttime=None, verbose=False):
+        """
+        Returns the next packet, from whichever source it arrives from first, as an ObsPy Stream
+
+        Parameters:
+            starttime (ObsPy UTCDateTime): ignored
+
+        Returns:
+            an ObsPy Stream object, containing only the Traces not already received from another source. Each Trace has stats.source
+            set to the name of the source it came from
+        """
+        if not self.readers:
+            self.start()
+        deadline = time.monotonic() + self.read_timeout if self.read_timeout else None
+        while True:
+            try:
+                i, st = self.packet_queue.get(timeout=max([deadline - time.monotonic(), 0.0]) if deadline else None)
+            except queue.Empty:
+                raise TimeoutError(f'no new packet from any source for {self.read_timeout} seconds')
+            st = self.deduplicate(i, st)
+            if len(st) > 0:
+                if verbose:
+                    print(f'packet from source {self.names[i]}: {st}')
+                return st
+
+    def nextpacket2Blocks(self, starttime_ns=None, verbose=False):
+        """
+        Fetches the next packet, from whichever source it arrives from first, as nextpacket2Stream() does, and returns it as a list of data_ingestion.ChannelBlocks, which is 
+        what data_ingestion.py processes
+
+        Parameters:
+            starttime_ns (int): ignored
+
+        Returns:
+            a list with one ChannelBlock per Trace of the packet, sharing its data array, and keeping its loadtime (and seqnum, if any)
+        """
+        return stream2blocks(self.nextpacket2Stream(verbose=verbose))
+
+    def deduplicate(self, i, st):
+        """ Returns a Stream of the Traces in st (from source i) that have not been seen before, and updates the latency of source i """
+        stats = self.source_stats[self.names[i]]
+        now = UTCDateTime()
+        first = Stream()
+        for tr in st:
+            latency = tr.stats.get('loadtime', now) - tr.stats.endtime
+            stats['traces'] += 1
+            stats['latencies'].append(latency)
+            stats['max_latency'] = max([stats['max_latency'], latency])
+            key = (tr.id, tr.stats.starttime.ns)
+            if key in self.seen:
+                stats['duplicates'] += 1
+                continue
+            self.seen.add(key)
+            self.seen_order.append(key)
+            if len(self.seen_order) > self.index_size:
+                self.seen.discard(self.seen_order.popleft())
+            stats['first'] += 1
+            tr.stats['source'] = self.names[i]
+            if 'seqnum' in tr.stats: # sequence numbers differ between servers, so they cannot be used for gap detection or to resume
+                del tr.stats['seqnum']
+            first.append(tr)
+        return first
+
+    def get_waveforms(self, starttime, endtime):
+        """ Fetches a time window of data (e.g. to fill a gap) from the first source that can provide it """
+        error = None
+        for client in self.clients:
+            try:
+                return client.get_waveforms(starttime, endtime)
+            except Exception as e:
+                error = e
+        raise error
+
+    def report(self):
+        """ Prints, for each source, how many Traces it provided first, how many were duplicates, and its latency """
+        print('\nSOURCES:')
+        for name, stats in self.source_stats.items():
+            if stats['traces'] == 0:
+                print(f'Source {name}: no data')
+                continue
+            latencies = np.array(stats['latencies'])
+            print(f"Source {name}: {stats['traces']} traces, first for {stats['first']}, {stats['duplicates']} duplicates. " + \
+                  f"Latency (last {len(latencies)}): median {np.median(latencies):.2f} s, 95th percentile {np.percentile(latencies, 95):.2f} s, " + \
+                  f"max (all) {stats['max_latency']:.2f} s")
+
+    def close(self):
+        """ Stops the reader threads and closes every source """
+        if self.stop_reading:
+            self.stop_reading.set()
+        for client in self.clients:
+            try:
+                client.close()
+            except Exception as e:
+                print(f'Failed to close source: {e}')
+        if self.readers:
+            for reader in self.readers:
+                reader.join(timeout=1.0)
+        self.readers = None
+        self.packet_queue = None
+        self.stop_reading = None
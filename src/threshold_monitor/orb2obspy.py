@@ -18,6 +18,7 @@ Caveats:
   So maybe align by packet time into a Stream before returning the packet stream to data_ingestion.py?
 
 """
+import time
 from numpy import array
 from obspy import Stream, Trace, UTCDateTime
 
@@ -25,14 +26,16 @@ from antelope.orb import Orb, OrbIncompleteException, OrbAfterError, OrbResurrec
 from antelope.Pkt import Packet
 
 import signal
+from data_ingestion import stream2blocks
 
 class OrbserverClient(Orb):
 
     DEFAULT_ORB = "137.229.32.211:6520"
 
-    def __init__(self, orbname, starttime=None, secondsPerPacket=1.0, timeoutsecs=-1, grouppackets=True, nslc='*.*.*.*', *args, **kwargs): 
+    def __init__(self, orbname, starttime=None, secondsPerPacket=1.0, timeoutsecs=-1, grouppackets=True, nslc='*.*.*.*', max_reconnect_backoff=60.0, *args, **kwargs): 
         if orbname == 'default':
             orbname = self.DEFAULT_ORB
+        self.orbname = orbname
         try:
             print(f'Initiating orbserver client for {nslc}')
             super().__init__(orbname, *args, **kwargs) # default keyword args are: permissions=’r’, select=None, reject=None, exhume=None, auto_bury=True, bury_interval=10. no args.
@@ -51,7 +54,9 @@ class OrbserverClient(Orb):
             self.move_pointer(starttime)
         self.last_packet_stream = None
         self.secondsPerPacket = secondsPerPacket
-        #self.timeoutsecs = timeoutsecs
+        self.timeoutsecs = timeoutsecs # give up waiting for a packet after this many seconds (raising TimeoutError). <=0 to wait forever
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.reconnect_backoff = 1.0
         self.starttime = starttime
         self.grouppackets = grouppackets
         self.last_packet_id = None
@@ -98,18 +103,47 @@ class OrbserverClient(Orb):
                 print(f'moved pointer for {self.nslc}')
                 #return 0
 
+    def reconnect(self):
+        """ Waits reconnect_backoff seconds (doubling it each time, up to max_reconnect_backoff), then reconnects to the orbserver, 
+        with the same packet selection, and moves the pointer back to the last packet read """
+        print(f'Reconnecting to {self.orbname} in {self.reconnect_backoff} seconds')
+        time.sleep(self.reconnect_backoff)
+        self.reconnect_backoff = min([self.reconnect_backoff * 2, self.max_reconnect_backoff])
+        try:
+            self.close()
+        except Exception:
+            pass
+        try:
+            self.connect()
+            self.select(self.selectexpr)
+            if self.last_packet_id is not None:
+                self.seek(self.last_packet_id)
+        except Exception as e:
+            print(f'Failed to reconnect to {self.orbname}: {e}')
+
     def nextpacket(self):
+        """ Reaps the next packet. Raises TimeoutError if there is none within timeoutsecs seconds """
         got_packet = False
+        deadline = time.monotonic() + self.timeoutsecs if self.timeoutsecs > 0 else None
         while not got_packet:
             try:
-                (_pkt_id, srcname, pkt_time, pkt_data) = self.reap()
+                if deadline:
+                    (_pkt_id, srcname, pkt_time, pkt_data) = self.reap_timeout(max([deadline - time.monotonic(), 0.0]))
+                else:
+                    (_pkt_id, srcname, pkt_time, pkt_data) = self.reap()
+            except OrbIncompleteException: # reap_timeout ran out of time
+                if deadline and time.monotonic() >= deadline:
+                    raise TimeoutError(f'no packet from {self.orbname} for {self.timeoutsecs} seconds')
             except Exception as e:
                 print(f'nextpacket: Exception with orbreap: {e}')
-                continue
+                if deadline and time.monotonic() >= deadline:
+                    raise TimeoutError(f'no packet from {self.orbname} for {self.timeoutsecs} seconds')
+                self.reconnect() # without this, a broken connection would fail again at once, in a busy loop
             else:
                 #if pkt_time >= self.starttime.timestamp:
                 packet = Packet(srcname=srcname, time=pkt_time, packet=pkt_data)
                 self.last_packet_id = _pkt_id
+                self.reconnect_backoff = 1.0
                 got_packet = True
         return packet
 
@@ -166,6 +200,19 @@ class OrbserverClient(Orb):
             st = self.group_packets_by_time(verbose=verbose)
         return st
     
+    def nextpacket2Blocks(self, starttime_ns=None, verbose=False):
+        """
+        Fetches the next packet from an Orbserver, as nextpacket2Stream() does, and returns it as a list of data_ingestion.ChannelBlocks, which is 
+        what data_ingestion.py processes
+
+        Parameters:
+            starttime_ns (int): ignored
+
+        Returns:
+            a list with one ChannelBlock per Trace of the packet, sharing its data array, and keeping its loadtime (and seqnum, if any)
+        """
+        return stream2blocks(self.nextpacket2Stream(verbose=verbose))
+
     def group_packets_by_time(self, verbose=False):
         """
         added this upon expansion from 1 to 33 channels. idea is to group packets from all 33 channels that share a common start time into a single Stream object, 
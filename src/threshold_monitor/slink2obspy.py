@@ -8,22 +8,34 @@ Description: This library provides a consistent data ingestion interface with or
 
              SlinkClient (a new class, defined below) accomplishes this by subclassing and expanding ObsPy's EasySeedLinkClient class
 """
+import time
 from obspy import Stream, UTCDateTime
 
 from obspy.clients.seedlink.easyseedlink import EasySeedLinkClient
 from obspy.clients.seedlink.basic_client import Client as BasicSeedLinkClient
 from obspy.clients.seedlink.slpacket import SLPacket
+from data_ingestion import stream2blocks
 
 class SlinkClient(EasySeedLinkClient):
 
     DEFAULT_SERVER_URL = "137.229.32.109:18321"
 
-    def __init__(self, server_url, starttime=None, secondsPerPacket=2.0):
+    def __init__(self, server_url, starttime=None, secondsPerPacket=2.0, seqnum=None, read_timeout=60.0, max_reconnect_backoff=60.0):
         if server_url == 'default':
             server_url = self.DEFAULT_SERVER_URL 
         super().__init__(server_url, autoconnect=True)
+        self.server_url = server_url
+        # if the server sends nothing for read_timeout seconds, ObsPy's SeedLinkConnection drops the connection and reconnects after 
+        # netdly seconds. we double netdly after each failed attempt, up to max_reconnect_backoff, and reset it once packets arrive
+        self.read_timeout = read_timeout
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.reconnect_backoff = 1.0
+        if read_timeout:
+            self.conn.set_net_timeout(read_timeout)
+        self.conn.set_net_delay(self.reconnect_backoff)
         if starttime:
             self.move_pointer(starttime)
+        self.seqnum = seqnum # if set, resume after the packet with this sequence number, once streams are selected
         self.last_packet_stream = None
         self.secondsPerPacket = secondsPerPacket
 
@@ -41,23 +53,55 @@ class SlinkClient(EasySeedLinkClient):
             None 
         """    
         super().select_stream(network, station, selector=channel) # selector is like EHZ or EH?
+        if self.seqnum is not None and self.seqnum >= 0:
+            for stream in self.conn.streams:
+                if stream.net == network and stream.station == station:
+                    stream.seqnum = self.seqnum
         self.network = network
         self.station = station
         self.location = location
         self.channel = channel       
 
-    def move_pointer(self, lastpacketendtime):
-        """ does nothing. for consistency with orb2obspy """
-        pass
+    def get_waveforms(self, starttime, endtime):
+        """
+        Fetches a time window of data for the selected streams, e.g. to fill a gap. This uses a separate Seedlink connection, 
+        so the realtime connection is not disturbed.
+
+        Parameters:
+            starttime (UTCDateTime): start of the time window
+            endtime (UTCDateTime): end of the time window
+
+        Returns:
+            an ObsPy Stream
+        """
+        host, port = self.server_url.split(':')
+        client = BasicSeedLinkClient(host, port=int(port))
+        return client.get_waveforms(self.network, self.station, self.location, self.channel, starttime, endtime)
+
+    def move_pointer(self, starttime):
+        """ Asks the Seedlink server to start sending data from starttime (a UTCDateTime), like orb2obspy. 
+        This is ignored if we are resuming from a sequence number instead. """
+        self.conn.begin_time = starttime
+
+    def reconnect(self):
+        """ Drops the connection, so SeedLinkConnection.collect() reconnects after reconnect_backoff seconds, which is then doubled """
+        try:
+            self.conn.disconnect()
+        except Exception as e:
+            print(f'failed to disconnect: {e}')
+        self.conn.set_net_delay(self.reconnect_backoff)
+        self.reconnect_backoff = min([self.reconnect_backoff * 2, self.max_reconnect_backoff])
 
     def nextpacket(self):
         """
         Reads next packet from seedlink server. Return packet object.
+        Raises TimeoutError if reading keeps failing for read_timeout seconds.
         """
 
         # initializing output data
         packet = None
         got_packet = False
+        deadline = time.monotonic() + self.read_timeout if self.read_timeout else None
 
         # Grabbing the next packet from the seedlink server
         while not got_packet:
@@ -66,6 +110,9 @@ class SlinkClient(EasySeedLinkClient):
             except Exception as e:
                 print('failed to read packet')
                 print(e)
+                if deadline and time.monotonic() > deadline:
+                    raise TimeoutError(f'no packet from {self.server_url} for {self.read_timeout} seconds')
+                self.reconnect() # without this, a broken connection would fail again at once, in a busy loop
             else:
                 if packet == SLPacket.SLTERMINATE:
                     self.on_terminate()
@@ -84,6 +131,9 @@ class SlinkClient(EasySeedLinkClient):
                 # Ignore in-stream INFO packets (not supported)
                 if packet_type not in (SLPacket.TYPE_SLINF, SLPacket.TYPE_SLINFT):
                     got_packet=True
+                    if self.reconnect_backoff > 1.0:
+                        self.reconnect_backoff = 1.0
+                        self.conn.set_net_delay(self.reconnect_backoff)
     
         return packet
 
@@ -92,6 +142,7 @@ class SlinkClient(EasySeedLinkClient):
         st = Stream()
         tr = packet.get_trace()
         tr.stats['loadtime']=UTCDateTime()
+        tr.stats['seqnum'] = packet.get_sequence_number() # so data_ingestion.py can checkpoint where we got to
         if not self.secondsPerPacket:
             self.secondsPerPacket = tr.stats.endtime - tr.stats.starttime + tr.stats.delta
         st.append(tr)
@@ -112,6 +163,19 @@ class SlinkClient(EasySeedLinkClient):
         st = self.group_packets_by_time(verbose=verbose)
         return st
         
+    def nextpacket2Blocks(self, starttime_ns=None, verbose=False):
+        """
+        Fetches the next packet from a Seedlink server, as nextpacket2Stream() does, and returns it as a list of data_ingestion.ChannelBlocks, which is 
+        what data_ingestion.py processes
+
+        Parameters:
+            starttime_ns (int): ignored
+
+        Returns:
+            a list with one ChannelBlock per Trace of the packet, sharing its data array, and keeping its loadtime (and seqnum, if any)
+        """
+        return stream2blocks(self.nextpacket2Stream(verbose=verbose))
+
     def group_packets_by_time(self, verbose=False):
         """
         added this upon expansion from 1 to 33 channels. idea is to group packets from all 33 channels that share a common start time into a single Stream object, 
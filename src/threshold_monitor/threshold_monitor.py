@@ -1,55 +1,63 @@
 #!/usr/bin/env python
-from obspy import UTCDateTime
+import time
+t_imports = time.perf_counter()
+from obspy import UTCDateTime, read_inventory
 tstart = UTCDateTime()
 import os
 import sys
 import numpy as np
 import data_ingestion
+import ground_motion
 import subprocess # for sending alarms
-import pandas as pd
-import matplotlib.pyplot as plt
 import multiprocessing as mp
 import re
 import fcntl
-mysql_imported = False
-try:
-    import mysql.connector as mysql
-    mysql_imported = True
-except:
-    print('mysql not imported')
+import glob
+import threading
+import queue
+import pickle
+# pandas, matplotlib.pyplot and mysql.connector are only imported when first needed, with data_ingestion.lazy_import
+data_ingestion.IMPORT_TIMES['startup'] = time.perf_counter() - t_imports
 ################################################################################
 ###                            CLASSES                                       ###
 ################################################################################
 
 class thresholdHistory(object):
     ROWNUM = -1
-    def __init__(self, thresholds, station, outputdir = None, seconds_to_keep=60):
+    def __init__(self, thresholds, station, outputdir = None, seconds_to_keep=60, metric='PGA', clock=None):
         if outputdir: 
             self.outputdir = outputdir
         else:
             self.outputdir = UTCDateTime().isoformat()
         self.rownum = []
         self.seed_id = []
-        self.starttime = []
+        self.starttime = [] # starttime, endtime and peaktime are in ns. See to_dataframe()
         self.endtime = []
         self.peaktime = []
         self.value = []
         self.status = []
         self.thresholds = thresholds
         self.seconds_to_keep = seconds_to_keep
-        self.last_trimmed_time = UTCDateTime()
+        self.clock = clock or data_ingestion.Clock()
+        self.last_trimmed_ns = self.clock.now_ns()
         self.previous_state = {}
         self.secondsPerPacket = None
         self.outputdir = outputdir
         self.station = station
-        self.csvfile = os.path.join(self.outputdir, f'threshold_history_{station}.csv')
-        # start the output file
-        row = 'rownum,seed_id,starttime,endtime,peaktime,value,status\n'
-        data_ingestion.append_to_csvfile(self.csvfile, row) 
+        self.metric = metric # PGA, or another ground-motion metric from ground_motion.py, e.g. PGV
+        if metric == 'PGA':
+            self.csvfile = os.path.join(self.outputdir, f'threshold_history_{station}.csv')
+        else:
+            self.csvfile = os.path.join(self.outputdir, f'threshold_history_{station}_{metric}.csv')
+        # start the output file, unless this station is being restarted
+        if not os.path.isfile(self.csvfile):
+            row = 'rownum,seed_id,starttime,endtime,peaktime,value,status\n'
+            data_ingestion.append_to_csvfile(self.csvfile, row) 
 
     def update(self, seed_id, starttime, endtime, peaktime, value, status):
+        # starttime, endtime and peaktime are in ns, and only converted to UTCDateTime for the output file
 
-        # update thresholdHistory attributes - these are all lists and there is one element per Trace from each packet Stream
+        # update thresholdHistory attributes - these are all lists and there is one element per ChannelBlock from each packet
         self.ROWNUM += 1
         self.rownum.append(self.ROWNUM)
         self.seed_id.append(seed_id)
@@ -60,11 +68,12 @@ class thresholdHistory(object):
         self.status.append(status)
 
         # update the output file
-        row = f'{self.ROWNUM},{seed_id},{starttime},{endtime},{peaktime},{value},{status}' + '\n'
+        to_utc = data_ingestion.to_utc
+        row = f'{self.ROWNUM},{seed_id},{to_utc(starttime)},{to_utc(endtime)},{to_utc(peaktime)},{value},{status}' + '\n'
         data_ingestion.append_to_csvfile(self.csvfile, row)        
         
         # trim the object
-        if UTCDateTime() > self.last_trimmed_time + self.seconds_to_keep:
+        if self.clock.now_ns() > self.last_trimmed_ns + int(self.seconds_to_keep * 1e9):
             self.trim()
             data_ingestion.trim_csvfile(self.csvfile)
         
@@ -78,12 +87,13 @@ class thresholdHistory(object):
         return thresholdDetection
 
     def to_dataframe(self):
+        pd = data_ingestion.lazy_import('pandas')
         df = pd.DataFrame()
         df['rownum'] = self.rownum
         df['seed_id'] = self.seed_id
-        df['starttime'] = self.starttime
-        df['endtime'] = self.endtime
-        df['peaktime'] = self.peaktime
+        df['starttime'] = [data_ingestion.to_utc(t) for t in self.starttime]
+        df['endtime'] = [data_ingestion.to_utc(t) for t in self.endtime]
+        df['peaktime'] = [data_ingestion.to_utc(t) for t in self.peaktime]
         df['value'] = self.value
         df['status'] = self.status
         return df
@@ -93,6 +103,7 @@ class thresholdHistory(object):
         print(df)
 
     def plot(self, outfile='threshold_history.png', load_csv=False):
+        pd = data_ingestion.lazy_import('pandas')
         timecol = 'starttime'
         if load_csv and self.ROWNUM > 0:
             df = pd.read_csv(self.csvfile)
@@ -101,7 +112,14 @@ class thresholdHistory(object):
             self.trim() # trim so we always have a consistent 10-minute plot, or whatever seconds_to_keep is set to
             df = self.to_dataframe()
             df['datetime'] = [t.datetime for t in df[timecol]]
-        units = 'm/s^2'
+
+        with data_ingestion.PLOT_LOCK:
+            self._plot(df, outfile)
+
+    def _plot(self, df, outfile):
+        plt = data_ingestion.lazy_import('matplotlib.pyplot')
+        units = ground_motion.metric_units(self.metric)
+        label = 'peak amplitude' if self.metric == 'PGA' else self.metric
         seed_ids = df['seed_id'].unique()
         #print('seed_ids: ',seed_ids)
         fig, ax = plt.subplots()
@@ -118,10 +136,10 @@ class thresholdHistory(object):
             df2 = thisdf.copy()
             df2.reset_index(inplace=True)
             df2.plot(ax=ax, x='datetime', y='value', style='.-', label=seed_id[-1], \
-                    title=f'peak amplitude vs. time for {self.station}?', 
+                    title=f'{label} vs. time for {self.station}?', 
                     ylim=[ymin/1.5, ymax*1.5], logy=True, color=cols[i])
         ax.set_xlabel(f"Date/Time on {df.loc[0, 'datetime'].strftime('%Y/%m/%d')}") # getting a string here, probably when loading from file
-        ax.set_ylabel(f'Peak amplitude ({units})')
+        ax.set_ylabel(f'{label[0].upper() + label[1:]} ({units})')
             
         handles, labels = ax.get_legend_handles_labels()
         cols = ['r', 'g', 'y']
@@ -139,7 +157,7 @@ class thresholdHistory(object):
     def trim(self):
         # trim the object lists
         # find index N where self.starttime is within the last self.seconds_to_keep seconds
-        N = next(x for x, val in enumerate(self.starttime) if val>self.starttime[-1]-self.seconds_to_keep)
+        N = next(x for x, val in enumerate(self.starttime) if val>self.starttime[-1]-int(self.seconds_to_keep * 1e9))
         self.rownum = self.rownum[N:]
         self.seed_id = self.seed_id[N:]
         self.starttime = self.starttime[N:]
@@ -152,23 +170,76 @@ class thresholdHistory(object):
 class MyDataClient(data_ingestion.RealTimeDataClient):
 
     def __init__(self, params): 
+        self.alarms_from = None # if set, alarms with a peaktime before this are not sent, e.g. during the warm-up of a backfill time shard
+        self.metrics = [] # other ground-motion metrics to compute and threshold as well as PGA, e.g. PGV, PSA1.0, CAV, ARIAS, PGA5.0. See ground_motion.py
+        self.metric_thresholds = {} # station -> metric -> thresholds, like thresholds. PSA and PGA<window> in g, PGV, CAV and ARIAS in m/s
+        self.damping = 0.05 # PSA oscillator damping, as a fraction of critical
+        self.cumulative_seconds = 60.0 # CAV and Arias intensity are integrated over this many seconds
+        self.pga_component = 'max' # threshold the PGA of each channel (max), or of the station: vector_sum, vector_sum_3d or geometric_mean
+        self.quiet_fraction = 0.5 # with quiet_gate, a packet only takes the quiet path if its estimated PGA is below this fraction of the lowest threshold
         super().__init__(params)
-        self.last_alarm = {'peaktime':UTCDateTime(1900,1,1), 
+        if self.pga_component != 'max' and not self.pga_component in ground_motion.PGA_COMPONENTS:
+            raise ValueError(f"pga_component must be max, or one of {list(ground_motion.PGA_COMPONENTS)}, not {self.pga_component}")
+        self.last_alarm = {'peaktime':UTCDateTime(1900,1,1).ns, # in ns, like every packet time 
                            'status': 'OFF',
                            'value': 0.0
                            }
 
-        g = 9.80665 # m/s^2
+        self.thresholds = dict(self.thresholds) # convert a copy, as params may be reused, e.g. when a station is restarted
+        self.thresholds[self.station] = dict(self.thresholds[self.station])
         for k, v in self.thresholds[self.station].items(): # convert thresholds from str and units g to units m/s**2
-            self.thresholds[self.station][k] = float(v) * g
-        self.thresholdHistoryObject = thresholdHistory(self.thresholds, self.station, outputdir=self.outputdir)
+            self.thresholds[self.station][k] = float(v) * ground_motion.G
+        self.thresholdHistoryObject = thresholdHistory(self.thresholds, self.station, outputdir=self.outputdir, clock=self.clock)
+        self.thresholdHistoryObjects = {'PGA': self.thresholdHistoryObject}
+
+        # other ground-motion metrics get their own thresholds and threshold history file
+        self.metrics = [metric.upper() for metric in self.metrics]
+        self.metricsObj = None
+        if self.metrics:
+            corner = self.filterdef['freq'][0] if self.filterdef and self.filterdef['type'] in ['highpass', 'bandpass'] else 0.05
+            self.metricsObj = ground_motion.GroundMotionMetrics(self.metrics, damping=self.damping, corner=corner, \
+                                                                 cumulative_seconds=self.cumulative_seconds)
+            station_metric_thresholds = self.metric_thresholds.get(self.station) or {}
+            for metric in self.metrics:
+                metric_thresholds = dict(station_metric_thresholds.get(metric) or {}) # a copy, as for thresholds
+                in_g = ground_motion.parse_metric(metric)[0] in ['PSA', 'PGA']
+                for k, v in metric_thresholds.items(): # PSA and PGA<window> thresholds are in g, like PGA
+                    metric_thresholds[k] = float(v) * ground_motion.G if in_g else float(v)
+                self.thresholdHistoryObjects[metric] = thresholdHistory({self.station: metric_thresholds}, self.station, \
+                                                                        outputdir=self.outputdir, metric=metric, clock=self.clock)
+        # the quiet path is only for packets well below every acceleration threshold, so the estimate can be off by 1/quiet_fraction
+        # without missing a threshold crossing. a station PGA combines up to 3 channels, so each channel must be lower still. the
+        # QuietGate allows for the filter too, and the quiet gate is off with remove_instrument_response, or with no thresholds to go by.
+        # PGV, PSA, CAV and Arias intensity cannot be bounded by the peak of the raw counts, so thresholds on them turn the quiet gate off
+        if self.quietGate:
+            unbounded = [metric for metric in self.metrics if ground_motion.parse_metric(metric)[0] != 'PGA' and \
+                         self.thresholdHistoryObjects[metric].thresholds[self.station]]
+            if unbounded:
+                print(f'{self.station}: quiet gate off, because of thresholds on {", ".join(unbounded)}')
+                self.quietGate = None
+        if self.quietGate and self.quiet_level is None:
+            accel_thresholds = list(self.thresholds[self.station].values())
+            for metric in self.metrics:
+                if ground_motion.parse_metric(metric)[0] == 'PGA':
+                    accel_thresholds += list(self.thresholdHistoryObjects[metric].thresholds[self.station].values())
+            if accel_thresholds:
+                nchannels = {'vector_sum':2, 'vector_sum_3d':3}.get(self.pga_component, 1)
+                self.quiet_level = self.quiet_fraction * min(accel_thresholds) / np.sqrt(nchannels)
+        if self.quietGate and self.quiet_level is None:
+            print(f'{self.station}: quiet gate off, because there are no acceleration thresholds to set quiet_level from')
+            self.quietGate = None
         if self.verbose:
             print('THRESHOLDS:')
-            print(self.thresholds)
+            print({metric: history.thresholds[self.station] for metric, history in self.thresholdHistoryObjects.items()})
         
         # connect to mysql database
         mysql_info = params['mysql_info']
-        if mysql_imported:
+        self.db = None
+        try:
+            mysql = data_ingestion.lazy_import('mysql.connector')
+        except ImportError:
+            print('mysql not imported')
+        else:
             self.db = mysql.connect(
                 user = mysql_info['user'],
                 password = mysql_info['password'],
@@ -177,21 +248,52 @@ class MyDataClient(data_ingestion.RealTimeDataClient):
             )
 
     def computePGA(self):
-        st = self.currentPacket
+        packet = self.currentPacket
+        if self.pga_component != 'max': # one PGA for the station, from all its channels
+            pga_dicts = ground_motion.combined_peaks(packet, self.pga_component)
+            return pga_dicts[0] if pga_dicts else dict()
         pga_dict = dict()
         # find max absolute value, and time of that max value
-        for tr in st:
-            x = np.absolute(tr.data)
+        for block in packet:
+            x = np.absolute(block.data)
             x_max = np.max(x)
             ind_max = np.argmax(x)
-            time_max = tr.stats.starttime + tr.stats.delta * ind_max
-            # pga_dict has starttime and endtime of packet, peak value, and time of that peak value (which falls between start and end time)
-            pga_dict[tr.id] = {'value':x_max, 'starttime':tr.stats.starttime, 'endtime':tr.stats.endtime, 'peaktime':time_max}
+            time_max = block.start_ns + block.delta_ns * int(ind_max)
+            # pga_dict has starttime and endtime of packet, peak value, and time of that peak value (which falls between start and end time), in ns
+            pga_dict[block.seed_id] = {'value':x_max, 'starttime':block.start_ns, 'endtime':block.end_ns, 'peaktime':time_max}
         return pga_dict
 
-    def PGA2thresholddetections(self, tracemax):
+    def computePGA_chunk(self, blocks):
+        ''' 
+        Vectorized equivalent of computePGA() for a processed archive chunk. Each ChannelBlock is split into one row per packet (see 
+        data_ingestion.chunk_packets()), so the max absolute value, and its time, are found for every packet at once.
+        Returns a list with one pga_dict per packet (packets with no real data for a block are left out of that pga_dict)
+        '''
+        if self.pga_component != 'max':
+            return ground_motion.combined_peaks(blocks, self.pga_component, window_seconds=self.secondsPerPacket)
+        pga_dicts = []
+        for block in blocks:
+            nper = round(self.secondsPerPacket * block.sampling_rate) # samples per packet, besides the first sample of the next
+            x, nan_mask = data_ingestion.chunk_packets(block, nper)
+            x = np.absolute(x)
+            nwin = len(x)
+            ind_max = np.argmax(x, axis=1)
+            x_max = x[np.arange(nwin), ind_max]
+            no_data = nan_mask.all(axis=1)
+            while len(pga_dicts) < nwin:
+                pga_dicts.append(dict())
+            for w in range(nwin):
+                if no_data[w]:
+                    continue
+                wstart_ns = block.start_ns + w * nper * block.delta_ns
+                pga_dicts[w][block.seed_id] = {'value':x_max[w], 'starttime':wstart_ns, 'endtime':wstart_ns + nper * block.delta_ns, \
+                                               'peaktime':wstart_ns + int(ind_max[w]) * block.delta_ns}
+        return pga_dicts
+
+    def PGA2thresholddetections(self, tracemax, metric='PGA'):
         thresholdDetections = []
-        station_thresholds = self.thresholds[self.station]
+        thresholdHistoryObject = self.thresholdHistoryObjects[metric]
+        station_thresholds = thresholdHistoryObject.thresholds[self.station]
         for seed_id in tracemax.keys():
             this = tracemax[seed_id]
             status = 'OFF'
@@ -205,24 +307,29 @@ class MyDataClient(data_ingestion.RealTimeDataClient):
                     highest_v = v
                     status = k.upper() # e.g. turn 'low' into 'LOW'. 
 
-            thisThresholdDetection = self.thresholdHistoryObject.update(seed_id, this['starttime'], this['endtime'], \
-                                                                        this['peaktime'], this['value'], status)
+            thisThresholdDetection = thresholdHistoryObject.update(seed_id, this['starttime'], this['endtime'], \
+                                                                   this['peaktime'], this['value'], status)
             if thisThresholdDetection:
                 thresholdDetections.append(thisThresholdDetection)
         return thresholdDetections            
 
-    def send_alarm(self, seed_id, starttime, endtime, peaktime, value, status, thresholdDetections):
+    def send_alarm(self, seed_id, starttime, endtime, peaktime, value, status, thresholdDetections, metric='PGA'):
         now = UTCDateTime()
-        subject = f"{status} threshold Alarm at {self.station} at {peaktime}"
+        peaktime = data_ingestion.to_utc(peaktime)
+        if metric == 'PGA':
+            subject = f"{status} threshold Alarm at {self.station} at {peaktime}"
+            pngfile = os.path.join(self.outputdir, f'threshold_alarm_{peaktime.strftime("%Y%m%d%H%M%S%F")}_{self.station}_{status}.png')
+        else:
+            subject = f"{status} {metric} threshold Alarm at {self.station} at {peaktime}"
+            pngfile = os.path.join(self.outputdir, f'threshold_alarm_{peaktime.strftime("%Y%m%d%H%M%S%F")}_{self.station}_{metric}_{status}.png')
         body = subject + '\n'
         for td in thresholdDetections:
-            body += f"Threshold Alarm at {td['seed_id']} at {td['peaktime'].strftime('%Y-%m-%dT%H:%M:%S')} exceeded {td['status']} Threshold. Level now {td['value']}"
-        pngfile = os.path.join(self.outputdir, f'threshold_alarm_{peaktime.strftime("%Y%m%d%H%M%S%F")}_{self.station}_{status}.png')
-        self.thresholdHistoryObject.plot(outfile=pngfile, load_csv=False)
+            body += f"Threshold Alarm at {td['seed_id']} at {data_ingestion.to_utc(td['peaktime']).strftime('%Y-%m-%dT%H:%M:%S')} exceeded {td['status']} Threshold. Level now {td['value']}"
+        self.thresholdHistoryObjects[metric].plot(outfile=pngfile, load_csv=False)
         data_ingestion.send_email_alarm(subject, body, self.email_list, pngfile=pngfile, verbose=True)
 
         # send update to mysql database
-        if mysql_imported:
+        if self.db:
             query_cursor = self.db.cursor()
             if self.station == "VMT":
                 sta_id = 13
@@ -238,7 +345,7 @@ class MyDataClient(data_ingestion.RealTimeDataClient):
             self.db.commit()
 
 
-    def thresholddetections2alarms(self, thresholdDetections):
+    def thresholddetections2alarms(self, thresholdDetections, metric='PGA'):
         ''' force alarm only at station level, not individual channels
         so we now track last alarm issued and use threshold_alarm_timeout parameter '''
         #print('thresholdDetections = ', thresholdDetections) # probably important enough to log even if verbose=False
@@ -255,10 +362,107 @@ class MyDataClient(data_ingestion.RealTimeDataClient):
                 endtime = td['endtime']
                 seed_id = td['seed_id']
 
+        ''' Alarms during the warm-up period of a backfill time shard belong to the previous shard '''
+        if self.alarms_from and peaktime < self.alarms_from.ns:
+            return
+
         ''' We still only send an alarm if we are beyond the threshold_alarm_timeout period OR the status has increased, e.g. from LOW to MEDIUM'''
-        if peaktime > self.last_alarm['peaktime'] + self.threshold_alarm_timeout or (maxvalue > self.last_alarm['value'] and status!=self.last_alarm['status']):
-            self.send_alarm(seed_id, starttime, endtime, peaktime, maxvalue, status, thresholdDetections)
+        if peaktime > self.last_alarm['peaktime'] + int(self.threshold_alarm_timeout * 1e9) or (maxvalue > self.last_alarm['value'] and status!=self.last_alarm['status']):
+            self.send_alarm(seed_id, starttime, endtime, peaktime, maxvalue, status, thresholdDetections, metric=metric)
     
+    def checkpoint_state(self):
+        ''' add the threshold state to the checkpoint, so alarms carry on as if there had been no restart '''
+        state = super().checkpoint_state()
+        state['previous_state'] = self.thresholdHistoryObject.previous_state
+        state['last_alarm'] = self.last_alarm
+        state['rownum'] = self.thresholdHistoryObject.ROWNUM
+        if self.metricsObj: # the filter state of each metric, so they carry on without a transient
+            state['metrics_state'] = self.metricsObj.state
+            state['metric_histories'] = {metric: (history.previous_state, history.ROWNUM) for metric, history in self.thresholdHistoryObjects.items() if metric != 'PGA'}
+        return state
+
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.thresholdHistoryObject.previous_state = state['previous_state']
+        self.last_alarm = state['last_alarm']
+        if isinstance(self.last_alarm['peaktime'], UTCDateTime): # a checkpoint from before packet times were kept in ns
+            self.last_alarm = dict(self.last_alarm, peaktime=self.last_alarm['peaktime'].ns)
+        self.thresholdHistoryObject.ROWNUM = state['rownum']
+        if self.metricsObj and 'metrics_state' in state:
+            self.metricsObj.state = state['metrics_state']
+            for metric, (previous_state, rownum) in state['metric_histories'].items():
+                if metric in self.thresholdHistoryObjects:
+                    self.thresholdHistoryObjects[metric].previous_state = previous_state
+                    self.thresholdHistoryObjects[metric].ROWNUM = rownum
+
+    def allow_quiet(self):
+        ''' no quiet path while any channel is above a threshold, so the full path decides when it drops back to OFF '''
+        for history in self.thresholdHistoryObjects.values():
+            for state in history.previous_state.values():
+                if state['status'] != 'OFF':
+                    return False
+        return True
+
+    def analyze_chunk(self, blocks, chunkstarttime, chunkendtime):
+        ''' archive mode: compute PGA for every packet-equivalent window of a chunk at once, then run the usual threshold and alarm logic on each '''
+        pga_dicts = self.computePGA_chunk(blocks)
+        self.update_timings('computing_max')
+        metric_dicts = {}
+        if self.metricsObj:
+            metric_dicts = self.update_metrics_chunk(blocks)
+            self.update_timings('computing_metrics')
+        for w, pga_dict in enumerate(pga_dicts):
+            if not pga_dict:
+                continue
+            self.npackets += 1
+            thresholdDetections = self.PGA2thresholddetections(pga_dict)
+            if len(thresholdDetections) > 0:
+                self.thresholddetections2alarms(thresholdDetections)
+            for metric, dicts in metric_dicts.items():
+                if w < len(dicts) and dicts[w]:
+                    self.metric2alarms(metric, dicts[w])
+        self.update_timings('threshold_exceedance')
+
+    def update_metrics_chunk(self, blocks):
+        '''
+        The ground-motion metrics for every packet of a processed archive chunk, as the packet loop would compute them. The metrics 
+        take each sample once, so each packet starts a sample after the one before ended. But at the start of the run, or after a 
+        packet with no data, the filter state of a channel starts afresh, and its first packet includes its own first sample.
+        '''
+        metric_dicts = {metric: [] for metric in self.metricsObj.metrics}
+        segments = {} # (first packet, end packet) -> a list of ChannelBlocks, one for each run of packets with data, of the blocks that have one there
+        for block in blocks:
+            nper = round(self.secondsPerPacket * block.sampling_rate)
+            data, nan_mask = data_ingestion.chunk_packets(block, nper)
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], (~nan_mask.all(axis=1)).astype(int), [0]))))
+            for w0, w1 in zip(edges[0::2], edges[1::2]):
+                segment = np.concatenate((data[w0, 0:1], block.data[w0*nper+1:w1*nper+1]))
+                segments.setdefault((w0, w1), []).append(data_ingestion.ChannelBlock(block.seed_id, block.start_ns + w0 * nper * block.delta_ns, \
+                                                                                     block.sampling_rate, segment))
+        for (w0, w1), segment in sorted(segments.items()):
+            continuing = [block for block in segment if self.metricsObj.continues(block)]
+            fresh = [block for block in segment if not self.metricsObj.continues(block)]
+            t1 = segment[0].start_ns + int(round(self.secondsPerPacket * 1e9))
+            # (the packet the first window is, blocks, window length). A fresh block has its first packet on its own
+            updates = [(w0, continuing, self.secondsPerPacket), (w0, data_ingestion.slice_blocks(fresh, end_ns=t1), None)]
+            if w1 > w0 + 1:
+                updates.append((w0 + 1, data_ingestion.slice_blocks(fresh, start_ns=t1), self.secondsPerPacket))
+            for offset, packet, window_seconds in updates:
+                if len(packet) == 0:
+                    continue
+                for metric, dicts in self.metricsObj.update(packet, window_seconds=window_seconds).items():
+                    for w, metric_dict in enumerate(dicts):
+                        while len(metric_dicts[metric]) <= offset + w:
+                            metric_dicts[metric].append(dict())
+                        metric_dicts[metric][offset + w].update(metric_dict)
+        return metric_dicts
+
+    def metric2alarms(self, metric, metric_dict):
+        ''' threshold exceedance and alarm decision making for a ground-motion metric other than PGA, for one packet or window '''
+        thresholdDetections = self.PGA2thresholddetections(metric_dict, metric=metric)
+        if len(thresholdDetections) > 0:
+            self.thresholddetections2alarms(thresholdDetections, metric=metric)
+
     def analyze(self):
 
         pga_dict = self.computePGA()
@@ -272,6 +476,15 @@ class MyDataClient(data_ingestion.RealTimeDataClient):
         if len(thresholdDetections) > 0:
             self.thresholddetections2alarms(thresholdDetections)
 
+        # other ground-motion metrics, from filter state carried over from the last packet
+        if self.metricsObj:
+            metric_dicts = self.metricsObj.update(self.currentPacket)
+            self.update_timings('computing_metrics')
+            for metric, dicts in metric_dicts.items():
+                for metric_dict in dicts:
+                    self.metric2alarms(metric, metric_dict)
+            self.update_timings('threshold_exceedance')
+
 ################################################################################
 ###                            FUNCTIONS                                     ###
 ################################################################################
@@ -295,12 +508,261 @@ def parse_station_matches(params):
     
     return matched_nslc
 
+def parse_time_shards(param_list):
+    ''' For archive reruns, split the time range for each station into shards of backfill_shard_seconds (default: 1 day), so that 
+    station x shard jobs can be spread over all CPU cores. Each shard starts early by an overlap long enough to fill the filter buffer 
+    and the threshold alarm timeout, so state is warmed up by the time the shard proper begins. Each shard writes to its own 
+    output directory, and merge_time_shards() puts the results back together. '''
+    shard_list = []
+    for params in param_list:
+        shard_seconds = params.get('backfill_shard_seconds', 86400)
+        overlap = params.get('bufferSecs', 0.0)
+        if params.get('filterdef'):
+            overlap = max([overlap, 2.0/params['filterdef']['freq'][0]])
+        overlap += params.get('threshold_alarm_timeout', 0.0)
+        if params.get('metrics'): # CAV and Arias intensity integrate over cumulative_seconds
+            overlap += params.get('cumulative_seconds', 60.0)
+        station = params['nslc'].split('.')[1]
+        shard_starttime = params['starttime']
+        while shard_starttime < params['endtime']:
+            shard_params = params.copy()
+            shard_params['starttime'] = max([params['starttime'], shard_starttime - overlap])
+            shard_params['endtime'] = min([params['endtime'], shard_starttime + shard_seconds])
+            shard_params['alarms_from'] = shard_starttime
+            shard_params['shard_starttime'] = shard_starttime
+            shard_params['outputdir'] = os.path.join(params['outputdir'], 'shards', f"{station}_{shard_starttime.strftime('%Y%m%dT%H%M%S')}")
+            os.makedirs(shard_params['outputdir'], exist_ok=True)
+            shard_list.append(shard_params)
+            shard_starttime += shard_seconds
+    return shard_list
+
+def merge_time_shards(datahandlers, outputdir):
+    ''' Merge the threshold histories of backfill time shards into one CSV file per station (and metric) in outputdir, in time order, 
+    dropping rows from each shard's warm-up overlap and renumbering rows. Alarm PNG files are moved to outputdir too. 
+    Returns one datahandler per station (the last shard), pointing at the merged CSV file, with packet counts and timings summed. '''
+    pd = data_ingestion.lazy_import('pandas')
+    stations = {}
+    for datahandler in datahandlers:
+        stations.setdefault(datahandler.station, []).append(datahandler)
+    merged = []
+    for station, shards in stations.items():
+        shards.sort(key=lambda datahandler: datahandler.shard_starttime)
+        last = shards[-1]
+        for metric, history in last.thresholdHistoryObjects.items():
+            dfs = []
+            for datahandler in shards:
+                df = pd.read_csv(datahandler.thresholdHistoryObjects[metric].csvfile)
+                df = df[[UTCDateTime(tstr) >= datahandler.shard_starttime for tstr in df['starttime']]]
+                dfs.append(df)
+            df = pd.concat(dfs)
+            df['rownum'] = range(len(df))
+            csvfile = os.path.join(outputdir, os.path.basename(history.csvfile))
+            df.to_csv(csvfile, index=False)
+            history.csvfile = csvfile
+            history.ROWNUM = len(df) - 1
+        for datahandler in shards:
+            for pngfile in glob.glob(os.path.join(datahandler.outputdir, '*.png')):
+                os.rename(pngfile, os.path.join(outputdir, os.path.basename(pngfile)))
+
+        last.outputdir = outputdir
+        last.npackets = sum([datahandler.npackets for datahandler in shards])
+        if last.benchmark:
+            for datahandler in shards[:-1]:
+                for k, v in datahandler.timingObj.timings.items():
+                    last.timingObj.timings[k] = last.timingObj.timings.get(k, 0.0) + v
+        merged.append(last)
+    return merged
+
 def run_parallel(params):
     datahandler = MyDataClient(params)
     datahandler.run()
     datahandler.close()
     return datahandler
 
+def station_weight(params, inventory=None):
+    ''' estimate the processing load of a station as the total sampling rate of its channels (e.g. 3 x 100 Hz = 300), from the 
+    StationXML inventory. Returns 1.0 if that cannot be worked out, so all stations count equally. '''
+    if inventory:
+        net, sta, loc, chan = params['nslc'].split('.')
+        try:
+            selected = inventory.select(network=net, station=sta, location=loc or '*', channel=chan, time=params['starttime'])
+            rates = [cha.sample_rate for network in selected for station in network for cha in station if cha.sample_rate]
+            if rates:
+                return float(sum(rates))
+        except Exception as e:
+            print(f'Could not estimate load for {params["nslc"]}: {e}')
+    return 1.0
+
+def assign_station_shards(param_list, nworkers):
+    ''' split stations into at most nworkers shards with roughly equal total load, by always giving the next heaviest station 
+    to the least loaded shard. Returns a list of lists of params dicts. '''
+    inventory = None
+    try:
+        inventory = read_inventory(param_list[0]['xmlfile'], format='STATIONXML')
+    except Exception as e:
+        print(f'Could not read inventory to balance station shards: {e}')
+    weights = [station_weight(params, inventory) for params in param_list]
+    nworkers = max([1, min([nworkers, len(param_list)])])
+    shards = [[] for i in range(nworkers)]
+    loads = [0.0] * nworkers
+    for i in sorted(range(len(param_list)), key=lambda i: -weights[i]):
+        w = loads.index(min(loads))
+        shards[w].append(param_list[i])
+        loads[w] += weights[i]
+    return shards
+
+def restart_params(params, clock=None):
+    ''' params to restart a realtime station from now by clock (the wall clock by default), rather than from when it was first started. 
+    If the station has a recent checkpoint, it will resume from that instead (see RealTimeDataClient.load_checkpoint) '''
+    params = params.copy()
+    params['starttime'] = UTCDateTime(int((clock or data_ingestion.Clock()).now().timestamp)) # round down to the second
+    return params
+
+class StationFailedError(RuntimeError):
+    ''' raised by supervise_station when it gives up on a station, with the number of times it was restarted in restarts '''
+    def __init__(self, nslc, restarts, reason):
+        super().__init__(f'Station {nslc} given up after {restarts} restarts: {reason}')
+        self.nslc = nslc
+        self.restarts = restarts
+
+def supervise_station(params, clock=None):
+    ''' run one station until it finishes normally. If it raises (e.g. IOError from append_to_csvfile), close its client and start it 
+    again after 1, 2, 4 ... seconds, capped at max_restart_backoff. The backoff starts from 1 second again once a station has 
+    run for longer than max_restart_backoff. Waiting, and deciding whether endtime has passed, go by clock: the wall clock by default,
+    or with simulated_clock, a SimulatedClock starting at starttime. 
+    A station that fails before its first packet the first time it is started is not restarted, since that is most likely a problem 
+    with its configuration. After that, a station is given up on once it has failed max_restarts times in a row without processing 
+    a packet. Either way, StationFailedError is raised, with the number of restarts. Otherwise returns the datahandler, with the number
+    of restarts in datahandler.restarts: the one that finished, or if endtime passed while waiting to restart, the last one that got as far as running. '''
+    if not clock:
+        clock = data_ingestion.SimulatedClock(params['starttime']) if params.get('simulated_clock') else data_ingestion.Clock()
+    max_backoff = params.get('max_restart_backoff', 60.0)
+    max_restarts = params.get('max_restarts', 10)
+    restarts = 0
+    failures_without_packets = 0 # in a row
+    backoff = 1.0
+    last_datahandler = None
+    while True:
+        datahandler = None
+        tic = clock.monotonic_ns()
+        try:
+            datahandler = MyDataClient(params)
+            datahandler.run()
+            datahandler.close()
+            datahandler.restarts = restarts
+            return datahandler
+        except Exception as e:
+            if datahandler:
+                last_datahandler = datahandler
+                try:
+                    datahandler.close()
+                except Exception:
+                    pass
+            if datahandler and datahandler.npackets > 0:
+                failures_without_packets = 0
+            else:
+                failures_without_packets += 1
+                if restarts == 0:
+                    raise StationFailedError(params['nslc'], restarts, f'failed before its first packet: {e}') from e
+                if failures_without_packets > max_restarts:
+                    raise StationFailedError(params['nslc'], restarts, f'failed {failures_without_packets} times in a row without processing a packet: {e}') from e
+            if (clock.monotonic_ns() - tic) / 1e9 > max_backoff: # it was running fine for a while, so this is a new failure
+                backoff = 1.0
+            restarts += 1
+            print(f'Station {params["nslc"]} failed: {e}. Restart {restarts} in {backoff} seconds')
+            clock.sleep(backoff)
+            backoff = min([backoff * 2, max_backoff])
+            if clock.now() >= params['endtime']: # the first start got as far as making a datahandler, or it would not have been restarted
+                last_datahandler.restarts = restarts
+                return last_datahandler
+            params = restart_params(params, clock)
+
+def run_station_shard(param_list, results=None, shard_index=None):
+    ''' worker process: run each station of a shard in its own thread, so each station keeps its own client, buffer and 
+    threshold state, but all share one Python interpreter (and one copy of ObsPy, pandas, matplotlib ...). Each station is 
+    restarted on its own if it fails, without touching the others. A station that supervise_station gives up on has no datahandler,
+    and its restart count is printed instead. If a results queue is given, put (shard_index, datahandlers) 
+    on it, for supervise_station_shards, as well as returning them. '''
+    datahandlers = [None] * len(param_list)
+    def run_station(i):
+        try:
+            datahandlers[i] = supervise_station(param_list[i])
+        except StationFailedError as e:
+            print(e) # the others carry on
+    threads = [threading.Thread(target=run_station, args=(i,)) for i in range(len(param_list))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if results:
+        for i, datahandler in enumerate(datahandlers): # the queue pickles results in another thread, where a failure would lose them all
+            try:
+                pickle.dumps(datahandler)
+            except Exception as e:
+                print(f'Cannot return results for {param_list[i]["nslc"]} from worker: {e}')
+                datahandlers[i] = None
+        results.put((shard_index, datahandlers))
+    return datahandlers
+
+def supervise_station_shards(station_shards, max_backoff=60.0, worker=run_station_shard, clock=None):
+    ''' realtime supervisor: run each shard of stations in its own worker process. Stations that raise are restarted within their worker 
+    by supervise_station, but if a whole worker process dies (e.g. killed, or out of memory) it is restarted here, from now, with the same 
+    exponential backoff, while the other workers carry on undisturbed. A worker that finishes without its results arriving is counted
+    as finished, with no datahandlers. Returns a list of datahandlers, with restart counts. worker is the function each worker process
+    runs, with the same arguments as run_station_shard. Whether a shard's endtime has passed, and the time it restarts from, go by 
+    clock (the wall clock by default). Worker processes run in real time, so their backoff always waits on the wall clock. '''
+    clock = clock or data_ingestion.Clock()
+    results = mp.Queue()
+    def start_worker(i):
+        process = mp.Process(target=worker, args=(station_shards[i], results, i))
+        process.start()
+        return process
+
+    processes = [start_worker(i) for i in range(len(station_shards))]
+    restarts = [0] * len(station_shards)
+    backoffs = [1.0] * len(station_shards)
+    restart_at = {} # shard index -> time to restart it
+    exited_without_result = set() # shards whose worker exited normally, but whose result had not been read when it was seen to exit
+    shard_datahandlers = {}
+    while len(shard_datahandlers) < len(station_shards):
+        try: # results must be collected as they arrive, because a process cannot exit until its queue has been read
+            i, datahandlers = results.get(timeout=1.0)
+            shard_datahandlers[i] = datahandlers
+            processes[i].join()
+            continue
+        except queue.Empty:
+            pass
+        for i, process in enumerate(processes):
+            if i in shard_datahandlers or i in restart_at or process.is_alive():
+                continue
+            if process.exitcode == 0: # finished. its result may have arrived just after the queue was read, so give it one more read
+                if i in exited_without_result:
+                    print(f'Worker for {[params["nslc"] for params in station_shards[i]]} finished, but its results were lost')
+                    shard_datahandlers[i] = []
+                else:
+                    exited_without_result.add(i)
+                continue
+            restarts[i] += 1
+            restart_at[i] = time.time() + backoffs[i]
+            print(f'Worker for {[params["nslc"] for params in station_shards[i]]} died with exit code {process.exitcode}. Restart {restarts[i]} in {backoffs[i]} seconds')
+            backoffs[i] = min([backoffs[i] * 2, max_backoff])
+        for i, t in list(restart_at.items()):
+            if time.time() >= t:
+                del restart_at[i]
+                if clock.now() >= station_shards[i][0]['endtime']:
+                    shard_datahandlers[i] = []
+                    continue
+                station_shards[i] = [restart_params(params, clock) for params in station_shards[i]]
+                processes[i] = start_worker(i)
+
+    datahandlers = []
+    for i in range(len(station_shards)):
+        for datahandler in shard_datahandlers[i]:
+            if datahandler:
+                datahandler.restarts += restarts[i]
+                datahandlers.append(datahandler)
+    return datahandlers
+
 def main(argv):
 
     ###########################################################################
@@ -314,10 +776,19 @@ def main(argv):
 
     param_list = parse_station_matches(params)
 
-    with mp.Pool(processes=len(param_list)) as mp_pool:
-        datahandlers = mp_pool.map(run_parallel, param_list)
-        mp_pool.close()
-        mp_pool.join()
+    if params['mode'] == 'archive': # backfill: station x time shard jobs, spread over all CPU cores
+        param_list = parse_time_shards(param_list)
+        processes = min([len(param_list), mp.cpu_count()])
+        with mp.Pool(processes=processes) as mp_pool:
+            datahandlers = mp_pool.map(run_parallel, param_list)
+            mp_pool.close()
+            mp_pool.join()
+        datahandlers = merge_time_shards(datahandlers, params['outputdir'])
+
+    else: # realtime: stations are shared between workers (default: one per CPU core), with one thread per station
+        nworkers = params.get('workers') or mp.cpu_count()
+        station_shards = assign_station_shards(param_list, nworkers)
+        datahandlers = supervise_station_shards(station_shards, max_backoff=params.get('max_restart_backoff', 60.0))
 
     ###########################################################################
     # THIS IS ALL ABOUT REPORTING WHAT HAPPENED
@@ -325,6 +796,8 @@ def main(argv):
 
     for datahandler in datahandlers:
         datahandler.report()
+        if hasattr(datahandler, 'restarts'):
+            print(f'{datahandler.station} was restarted {datahandler.restarts} times')
         datahandler.thresholdHistoryObject.print() # unique
         datahandler.thresholdHistoryObject.plot(outfile=os.path.join(datahandler.outputdir, f'thresholds_{datahandler.station}.png'), load_csv=True) # seed_id is automatically added to the file pattern within plot function 
 
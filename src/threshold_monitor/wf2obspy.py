@@ -63,6 +63,7 @@ OUTPUTS:
     https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.html#obspy.core.trace.Trace) determined by the inputs and the 
     data availability. All combinations of the provided networks, stations, locations, and channels will be attempted, and a 
     trace will be present in the returned Stream for each combination for which there was waveform data in the database.
+    Each trace spans starttime to endtime, and any samples missing from the database are nan.
 
 SYSTEM REQUIREMENTS:
 
@@ -113,9 +114,7 @@ sys.path.append(os.environ['ANTELOPE'] + "/data/python")
 import antelope.datascope as ds
 from obspy import Stream, Trace
 import numpy as np
-import numpy.ma as ma
 import math
-import re
 
 
 # inputs should be station, loc_code, channel, start time, and end time
@@ -152,6 +151,14 @@ def get_waveforms(network, station, location, channel, starttime, endtime, dbnam
         input = input.replace('?', '.')
         return input
 
+    # join channel and loc_code to match antelope format, handling wildcards appropriately
+    def chan_loc_regex(c, l):
+        chan = replace_wildcard(c)
+        loc = replace_wildcard(l)
+        if loc == '' or loc == '.*':
+            return chan + '.*'
+        return chan + "_" + loc
+
     # confirms if the db is supposed to be the default or a custom one
     def get_db_name(time, dbname, defaultdb):
         ym = time.strftime('%Y_%m')
@@ -180,8 +187,10 @@ def get_waveforms(network, station, location, channel, starttime, endtime, dbnam
 
     # empty Stream object for result
     st = Stream()
-    # used to validate traces. chanids[i] corresponds to st[i]
+    # used to validate traces. stachans[i] corresponds to st[i]
     stachans = []
+    # number of samples written so far. filled_to[i] corresponds to st[i]
+    filled_to = []
     
     dbname = get_db_name(starttime, dbname, defaultdb)
 
@@ -202,6 +211,16 @@ def get_waveforms(network, station, location, channel, starttime, endtime, dbnam
     
 
 
+    # build one combined regular expression per field, so each day needs only a single subset and a single trload_css,
+    # rather than one per net-sta-loc-chan combination
+    net_regex = '|'.join([replace_wildcard(n) for n in network])
+    sta_regex = '|'.join([replace_wildcard(s) for s in station])
+    chan_regex = '|'.join([chan_loc_regex(c, l) for c in channel for l in location])
+    subset_str = f"snet =~ /({net_regex})/ && sta =~ /({sta_regex})/ && chan =~ /({chan_regex})/"
+
+    # real network code for each station, filled once per call from the wfdisc/snetsta join
+    snet_lookup = {}
+
     curr_day = starttime
     # iterate over all days in databases array
     for wfdisc in databases:
@@ -213,122 +232,77 @@ def get_waveforms(network, station, location, channel, starttime, endtime, dbnam
         else:
             e2 = endtime.timestamp
 
-        # iterate over all net-sta-loc-chan combos
-        for n in network:
-            for s in station:
-                for l in location:
-                    for c in channel:
+        if e1 != e2: # trload_css does not behave as expected when e1 == e2
+            # subset to all requested net-sta-chan-loc combos at once
+            with ds.freeing(wfdisc.subset(subset_str)) as db:
+
+                # get the real network code for every station in this subset
+                for record in db.iter_record():
+                    sta, snet = record.getv('sta', 'snet')
+                    snet_lookup.setdefault(sta, snet)
+
+                # load the waveforms for all matching channels in one call
+                try:
+                    tr = db.trload_css(e1, e2)
+                except:
+                    # no data for any channel on this day. the preallocated arrays are already nan for this time range,
+                    # so no further work needs to be done
+                    tr = None
+
+                if tr is not None:
+
+                    # Iterate over the trace object
+                    for t in tr.iter_record():
+                        
+                        # get metadata from trace object
+                        samprate = t.getv('samprate')[0]
+                        sta, chan = t.getv('sta', 'chan')
+                        trace_start = t.getv('time')[0]
+
+                        # get the real network code
+                        net = snet_lookup[sta]
+
+                        # parse antelope chan_loc format
+                        chan_split = chan.split('_')
+                        chan = chan_split[0]
+                        loc = chan_split[1] if len(chan_split) > 1 else ''
+                        stachan = (sta, chan)
                         
-                        if e1 == e2: # trload_css does not behave as expected when this is the case
-                            continue
-
-                        net = replace_wildcard(n)
-                        sta = replace_wildcard(s)
-                        chan = replace_wildcard(c)
-                        loc = replace_wildcard(l)
-
-                        # join channel and loc_code to match antelope format, handling wildcards appropriately
-                        chan_str = chan
-                        if loc == '' or loc == '.*':
-                            chan_str += '.*'
-                        else:
-                            chan_str += "_" + loc
-
-                        # string to subset for current net-sta-chan-loc combo
-                        subset_str = f"snet =~ /{net}/ && sta =~ /{sta}/ && chan =~ /{chan_str}/"
-
-                        # create an empty datascope trace
-                        tr = ds.dbinvalid()
-
-                        # subset to current net-sta-chan-loc
-                        with ds.freeing(wfdisc.subset(subset_str)) as db:
-
-                            # load the waveforms
-                            try:
-                                tr = db.trload_css(e1, e2)
-                            except:
-                                # if a trace matching the current net/sta/chan/loc combo exists, add masked values to 
-                                # represent the missing data
-                                for trace in st:
-                                    trace_info = (trace.stats.network + trace.stats.station + 
-                                                trace.stats.channel + trace.stats.location)
-                                    if re.fullmatch(net+sta+chan+loc, trace_info):
-                                        gap = e2 - e1
-                                        gap_fill = np.full(math.floor(gap * trace.stats.sampling_rate), np.nan)
-                                        gap_masked = ma.masked_invalid(gap_fill)
-                                        trace.data = np.concatenate((trace.data, gap_masked))
-                                
-                                # no further work needs to be done, so skip the rest of the loop body
-                                continue
-                            
-                            # Iterate over the trace object
-                            i = 0
-                            for t in tr.iter_record():
-                                
-                                # get metadata from trace object
-                                nsamp, samprate = t.getv('nsamp', 'samprate')
-                                sta, chan = t.getv('sta', 'chan')
-                                trace_start = t.getv('time')[0]
-
-                                # get the real network code
-                                with ds.freeing(db.subset(f"sta == '{sta}' && chan == '{chan}'")) as net_subset:
-                                    net_subset.record = 0
-                                    net = net_subset.getv('snet')[0]
-
-                                # parse antelope chan_loc format
-                                chan_split = chan.split('_')
-                                chan = chan_split[0]
-                                loc = chan_split[1] if len(chan_split) > 1 else ''
-                                stachan = (sta, chan)
-                                
-                                # get the pre-existing trace from stream object if it exists, otherwise create a new trace
-                                # (the trace would already exist if there are multiple dbs in databases)
-                                if stachan not in stachans:
-                                    tr0 = Trace()
-                                    tr0.stats.network = net
-                                    tr0.stats.station = sta
-                                    tr0.stats.channel = chan
-                                    tr0.stats.location = loc
-                                    tr0.stats.sampling_rate = samprate
-                                    tr0.stats.npts += nsamp
-                                    tr0.stats.starttime = starttime
-                                else:
-                                    ind = stachans.index(stachan)
-                                    tr0 = st[ind]
-                                    if trace_start < math.floor((tr0.stats.starttime + (tr0.stats.npts / tr0.stats.sampling_rate)).timestamp):
-                                        raise RuntimeError(f"There are duplicate waveforms for {net} {sta} {chan} {loc} {curr_day.strftime('%D')}")
-
-                                d = np.array(t.trdata()) # get the actual data
-                                d[abs(d)>=1e+30] = np.nan # set any gaps in the data to nan
-
-                                # add additional nans for gaps not included in the data
-                                # gap at start
-                                if len(tr0.data) == 0: # where this is the start of the data in this trace
-                                    gap = trace_start - e1
-                                else:   # where there is already data in the trace
-                                    gap = trace_start - (tr0.stats.starttime + (tr0.stats.npts / tr0.stats.sampling_rate)).timestamp
-                                if gap >= (1/samprate):
-                                    gap_fill = np.full(math.floor(gap * samprate), np.nan)
-                                    d = np.concatenate((gap_fill, d))
-                                # gap at end
-                                gap = endtime.timestamp - t.getv('endtime')[0]
-                                if e2 == endtime.timestamp and gap >= (1/samprate) and tr.record_count - 1 == i:
-                                    gap_fill = np.full(math.floor(gap * samprate), np.nan)
-                                    d = np.concatenate((d, gap_fill))
-
-                                # mask gaps
-                                d_masked = ma.masked_invalid(d)
-
-                                # Populate the trace object
-                                tr0.data = np.concatenate((tr0.data, d_masked))
-
-                                # add the trace to the stream if there is data and it is not already in the stream
-                                if len(tr0.data) > 0 and curr_day == starttime and stachan not in stachans:
-                                    st.append(tr0)
-                                    stachans.append(stachan)
-
-                                i += 1
-                            free_tr(tr)
+                        # get the pre-existing trace from stream object if it exists, otherwise create a new trace
+                        # whose data array is preallocated to span starttime to endtime, filled with nan
+                        # (the trace would already exist if there are multiple records, or multiple dbs in databases)
+                        if stachan not in stachans:
+                            tr0 = Trace()
+                            tr0.stats.network = net
+                            tr0.stats.station = sta
+                            tr0.stats.channel = chan
+                            tr0.stats.location = loc
+                            tr0.stats.sampling_rate = samprate
+                            tr0.stats.starttime = starttime
+                            npts = math.floor((endtime - starttime) * samprate + 1e-6) + 1
+                            tr0.data = np.full(npts, np.nan)
+                            st.append(tr0)
+                            stachans.append(stachan)
+                            filled_to.append(0)
+                        ind = stachans.index(stachan)
+                        tr0 = st[ind]
+                        if trace_start < math.floor(starttime.timestamp + filled_to[ind] / samprate):
+                            raise RuntimeError(f"There are duplicate waveforms for {net} {sta} {chan} {loc} {curr_day.strftime('%D')}")
+
+                        d = np.array(t.trdata(), dtype=float) # get the actual data
+                        d[abs(d)>=1e+30] = np.nan # set any gaps in the data to nan
+
+                        # write this segment into its slot of the preallocated array. anything not written stays nan
+                        i0 = round((trace_start - starttime.timestamp) * samprate)
+                        if i0 < 0: # segment begins before starttime
+                            d = d[-i0:]
+                            i0 = 0
+                        i1 = min(i0 + len(d), tr0.stats.npts)
+                        if i1 > i0:
+                            tr0.data[i0:i1] = d[0:i1-i0]
+                            filled_to[ind] = max(filled_to[ind], i1)
+
+                    free_tr(tr)
         
         # advance by one day, and set time to 00:00:00
         if(defaultdb):
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+File: wfdisc2obspy.py
+Author: Glenn Thompson
+Date: 2026-10-19
+Description: This library is an Antelope-free replacement for wf2obspy.get_waveforms(). Rather than going through antelope.datascope, it parses the
+             fixed-width CSS3.0 wfdisc and snetsta tables directly, and memory-maps the waveform files they reference. Raw datatypes (s4, i4, s2, i2,
+             s3, i3, t4, f4, t8, f8) are read straight from the mapped file, touching only the samples inside the requested time window. For
+             miniSEED (sd) segments, the start time of each record is indexed once per file, and only the records overlapping the requested
+             time window are decoded with ObsPy.
+
+             get_waveforms() takes the same arguments, and returns a Stream in the same form, as wf2obspy.get_waveforms(), so datascope2obspy.py can use
+             either one. This means archive data can be read (and tested, or benchmarked) on a machine without Antelope installed.
+"""
+import os
+import io
+import re
+import math
+import mmap
+import numpy as np
+from collections import OrderedDict
+from obspy import Stream, Trace, read
+from obspy.io.mseed.util import get_record_information
+
+# CSS3.0 wfdisc fields, with their first and last (exclusive) character positions in each fixed-width row
+WFDISC_FIELDS = {'sta':(0,6), 'chan':(7,15), 'time':(16,33), 'wfid':(34,42), 'chanid':(43,51), 'jdate':(52,60), 'endtime':(61,78),
+                 'nsamp':(79,87), 'samprate':(88,99), 'calib':(100,116), 'calper':(117,133), 'instype':(134,140), 'segtype':(141,142),
+                 'datatype':(143,145), 'clip':(146,147), 'dir':(148,212), 'dfile':(213,245), 'foff':(246,256), 'commid':(257,265), 'lddate':(266,283)}
+WFDISC_FLOATS = ['time', 'endtime', 'samprate', 'calib', 'calper']
+WFDISC_INTS = ['wfid', 'chanid', 'jdate', 'nsamp', 'foff', 'commid']
+
+# CSS3.0 (Antelope extension) snetsta fields, which map station codes to their real (SEED) network code
+SNETSTA_FIELDS = {'snet':(0,8), 'fsta':(9,19), 'sta':(20,26), 'lddate':(27,44)}
+
+# wfdisc datatypes that can be read directly as a numpy dtype. s = big-endian (Sun), i = little-endian (Intel), t/f = big/little-endian IEEE floats
+DATATYPES = {'s4':'>i4', 'i4':'<i4', 's2':'>i2', 'i2':'<i2', 't4':'>f4', 'f4':'<f4', 't8':'>f8', 'f8':'<f8'}
+
+# miniSEED record indexes, see index_records(). (path, size, modification time) -> {foff: index of the segment starting at foff}
+RECORD_INDEXES = OrderedDict()
+MAX_INDEXED_FILES = 100 # the least recently used files are forgotten beyond this
+
+def read_table(tablefile, fields):
+    """
+    Parses a fixed-width CSS3.0 table file into a list of dicts, one per row
+
+    Parameters:
+        tablefile (str): path to the table file, e.g. /aec/db/waveforms/2024_08/waveforms_2024_08_14.wfdisc
+        fields (dict): field name -> (first, last) character positions, e.g. WFDISC_FIELDS
+
+    Returns:
+        a list of dicts, with string values stripped of whitespace
+    """
+    rows = []
+    with open(tablefile, 'r') as fptr:
+        for line in fptr:
+            if not line.strip():
+                continue
+            rows.append({k: line[i0:i1].strip() for k, (i0, i1) in fields.items()})
+    return rows
+
+def read_wfdisc(dbname):
+    """
+    Reads the wfdisc table of a Datascope database
+
+    Parameters:
+        dbname (str): the database name, e.g. /aec/db/waveforms/2024_08/waveforms_2024_08_14
+
+    Returns:
+        a list of dicts, one per wfdisc row, with numeric fields converted to float or int
+    """
+    rows = read_table(dbname + '.wfdisc', WFDISC_FIELDS)
+    for row in rows:
+        for k in WFDISC_FLOATS:
+            row[k] = float(row[k])
+        for k in WFDISC_INTS:
+            row[k] = int(row[k])
+    return rows
+
+def read_snetsta(dbname):
+    """
+    Reads the snetsta table of a Datascope database. Returns a dict mapping sta -> snet (empty if there is no snetsta table)
+    """
+    snet_lookup = {}
+    if os.path.isfile(dbname + '.snetsta'):
+        for row in read_table(dbname + '.snetsta', SNETSTA_FIELDS):
+            snet_lookup.setdefault(row['sta'], row['snet'])
+    return snet_lookup
+
+def index_records(path, mm, row):
+    """
+    Indexes the miniSEED records of the waveform segment described by a wfdisc row, so that a time window can be read without
+    decoding the whole segment. The index is cached for each file (until it changes), so the records of a segment are only walked 
+    once, rather than on every get_waveforms() call that reads from it, e.g. once per packet in archive mode.
+
+    Returns:
+        offsets: the byte offset of each record, plus the byte offset just past the last one
+        starts: the start time of each record, in ns
+        npts: the number of samples in each record
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    segments = RECORD_INDEXES.pop(key, {})
+    RECORD_INDEXES[key] = segments # now the most recently used
+    while len(RECORD_INDEXES) > MAX_INDEXED_FILES:
+        RECORD_INDEXES.popitem(last=False)
+    if not row['foff'] in segments:
+        # walk the records from foff until we have nsamp samples
+        offsets, starts, npts = [], [], []
+        offset = row['foff']
+        nsamp = 0
+        while nsamp < row['nsamp'] and offset < len(mm):
+            info = get_record_information(mm, offset=offset)
+            offsets.append(offset)
+            starts.append(info['starttime'].ns)
+            npts.append(info['npts'])
+            nsamp += info['npts']
+            offset += info['record_length']
+        segments[row['foff']] = (np.array(offsets + [offset]), np.array(starts, dtype=np.int64), np.array(npts))
+    return segments[row['foff']]
+
+def read_segment_into(out, i0, row, dbdir, mmaps, first, count):
+    """
+    Copies count samples, starting at sample number first, of the waveform segment described by a wfdisc row into out[i0:i0+count].
+    Waveform files are memory-mapped once per get_waveforms() call and cached in mmaps.
+    """
+    path = os.path.join(dbdir, row['dir'], row['dfile'])
+    if not path in mmaps:
+        with open(path, 'rb') as fptr:
+            mmaps[path] = mmap.mmap(fptr.fileno(), 0, access=mmap.ACCESS_READ)
+    mm = mmaps[path]
+    datatype = row['datatype']
+
+    if datatype in DATATYPES:
+        # zero-copy view of just the samples we want, converted as they are written into out
+        dtype = np.dtype(DATATYPES[datatype])
+        out[i0:i0+count] = np.frombuffer(mm, dtype=dtype, count=count, offset=row['foff'] + first * dtype.itemsize)
+
+    elif datatype in ['s3', 'i3']:
+        # 24-bit integers have no numpy dtype, so assemble them from bytes
+        b = np.frombuffer(mm, dtype=np.uint8, count=count * 3, offset=row['foff'] + first * 3).reshape(count, 3).astype(np.int32)
+        if datatype == 's3':
+            x = (b[:,0] << 16) | (b[:,1] << 8) | b[:,2]
+        else:
+            x = (b[:,2] << 16) | (b[:,1] << 8) | b[:,0]
+        out[i0:i0+count] = np.where(x >= 2**23, x - 2**24, x)
+
+    elif datatype == 'sd':
+        # miniSEED: decode just the bytes of the records that overlap the samples we want. anything they do not cover is nan
+        offsets, starts, npts = index_records(path, mm, row)
+        positions = np.round((starts - starts[0]) * row['samprate'] / 1e9).astype(int) # the sample number each record starts at
+        k = np.flatnonzero((positions < first + count) & (positions + npts > first))
+        out[i0:i0+count] = np.nan
+        if len(k) > 0:
+            st = read(io.BytesIO(mm[offsets[k[0]]:offsets[k[-1] + 1]]), format='MSEED')
+            for tr in st: # cast to float so any gaps between records can be filled with nan
+                tr.data = tr.data.astype(float)
+            st.merge(fill_value=np.nan)
+            data = st[0].data
+            j0 = max(0, first - positions[k[0]]) # the first sample we want, in data
+            d0 = max(0, positions[k[0]] - first) # and where it goes, in out[i0:i0+count]
+            n = min(len(data) - j0, count - d0)
+            out[i0+d0:i0+d0+n] = data[j0:j0+n]
+
+    else:
+        raise NotImplementedError(f"wfdisc datatype {datatype} is not supported, in {path}")
+
+def get_waveforms(network, station, location, channel, starttime, endtime, dbname=None):
+    """
+    Loads waveform data from Datascope wfdisc tables into an ObsPy Stream, without using Antelope
+
+    Parameters:
+        network, station, location, channel (str or list): as for wf2obspy.get_waveforms(). Wildcards * and ? are allowed.
+        starttime (UTCDateTime): start of the time window
+        endtime (UTCDateTime): end of the time window
+        dbname (str, optional): a database name. If None, the AEC daily waveforms databases spanning starttime to endtime are used.
+
+    Returns:
+        an ObsPy Stream with one Trace per matching net-sta-loc-chan. Each Trace spans starttime to endtime, and any samples missing from
+        the database are nan.
+    """
+    if starttime >= endtime:
+        raise ValueError(f"Invalid times. The first time ({str(starttime)}) must be before the second ({str(endtime)})")
+
+    # handles input given as a single string, translating into list format
+    def interpret_input(input):
+        if type(input) == str:
+            input = [string.strip() for string in input.split(',')]
+        return input
+
+    # translates wildcards into regular expressions
+    def replace_wildcard(input):
+        input = input.replace('*', '.*')
+        input = input.replace('?', '.')
+        return input
+
+    # join channel and loc_code to match antelope chan_loc format, handling wildcards appropriately
+    def chan_loc_regex(c, l):
+        chan = replace_wildcard(c)
+        loc = replace_wildcard(l)
+        if loc == '' or loc == '.*':
+            return chan + '.*'
+        return chan + "_" + loc
+
+    # create a list of databases spanning the full date range
+    if dbname:
+        dbnames = [dbname]
+    else:
+        dbnames = []
+        curr_day = starttime.replace(hour=0, minute=0, second=0, microsecond=0)
+        while curr_day <= endtime:
+            dbnames.append(f"/aec/db/waveforms/{curr_day.strftime('%Y_%m')}/waveforms_{curr_day.strftime('%Y_%m_%d')}")
+            curr_day += 60*60*24
+
+    net_re = re.compile('|'.join([replace_wildcard(n) for n in interpret_input(network)]))
+    sta_re = re.compile('|'.join([replace_wildcard(s) for s in interpret_input(station)]))
+    chan_re = re.compile('|'.join([chan_loc_regex(c, l) for c in interpret_input(channel) for l in interpret_input(location)]))
+
+    st = Stream()
+    stachans = [] # stachans[i] corresponds to st[i]
+    filled_to = [] # number of samples written so far. filled_to[i] corresponds to st[i]
+    mmaps = {}
+    try:
+        for db in dbnames:
+            try:
+                rows = read_wfdisc(db)
+            except Exception as e:
+                print("Problem loading the database [%s] for processing!" % db)
+                raise e
+            snet_lookup = read_snetsta(db)
+            dbdir = os.path.dirname(db)
+
+            for row in sorted(rows, key=lambda row: (row['sta'], row['chan'], row['time'])):
+
+                # like a wfdisc/snetsta join, rows without a network code are dropped
+                sta = row['sta']
+                if not sta in snet_lookup:
+                    continue
+                net = snet_lookup[sta]
+                if not (net_re.fullmatch(net) and sta_re.fullmatch(sta) and chan_re.fullmatch(row['chan'])):
+                    continue
+
+                # find which samples of this segment fall inside the requested time window
+                samprate = row['samprate']
+                first = max(0, math.ceil((starttime.timestamp - row['time']) * samprate - 1e-6))
+                last = min(row['nsamp'], math.floor((endtime.timestamp - row['time']) * samprate + 1e-6) + 1)
+                if last <= first:
+                    continue
+
+                # parse antelope chan_loc format
+                chan_split = row['chan'].split('_')
+                chan = chan_split[0]
+                loc = chan_split[1] if len(chan_split) > 1 else ''
+                stachan = (sta, chan)
+
+                # get the pre-existing trace from stream object if it exists, otherwise create a new trace
+                # whose data array is preallocated to span starttime to endtime, filled with nan
+                if stachan not in stachans:
+                    tr0 = Trace()
+                    tr0.stats.network = net
+                    tr0.stats.station = sta
+                    tr0.stats.channel = chan
+                    tr0.stats.location = loc
+                    tr0.stats.sampling_rate = samprate
+                    tr0.stats.starttime = starttime
+                    npts = math.floor((endtime - starttime) * samprate + 1e-6) + 1
+                    tr0.data = np.full(npts, np.nan)
+                    st.append(tr0)
+                    stachans.append(stachan)
+                    filled_to.append(0)
+                ind = stachans.index(stachan)
+                tr0 = st[ind]
+                segment_start = row['time'] + first / samprate
+                if segment_start < math.floor(starttime.timestamp + filled_to[ind] / samprate):
+                    raise RuntimeError(f"There are duplicate waveforms for {net} {sta} {chan} {loc} in {db}")
+
+                # write this segment into its slot of the preallocated array. anything not written stays nan
+                i0 = round((segment_start - starttime.timestamp) * samprate)
+                count = min(last - first, tr0.stats.npts - i0)
+                if count <= 0:
+                    continue
+                read_segment_into(tr0.data, i0, row, dbdir, mmaps, first, count)
+                d = tr0.data[i0:i0+count]
+                d[abs(d)>=1e+30] = np.nan # set any gaps in the data to nan
+                filled_to[ind] = max(filled_to[ind], i0 + count)
+    finally:
+        for mm in mmaps.values():
+            mm.close()
+
+    return st.sort()
@@ -13,8 +13,19 @@ rundir = os.getcwd()
 srcdir = os.path.join(rundir, 'src', 'threshold_monitor')
 sys.path.append(srcdir)
 os.chdir(srcdir)
-import wf2obspy
+try:
+    import wf2obspy
+except (ImportError, KeyError): # KeyError if $ANTELOPE is not set. only the tests that need Antelope fail without it
+    print('antelope not imported: tests that use wf2obspy will fail')
 import calib2obspy
+import wfdisc2obspy
+import hedged2obspy
+import data_ingestion
+import ground_motion
+import threshold_monitor
+import threading
+import types
+import numpy as np
 testsdir = os.path.join(rundir, 'tests')
 PF = os.path.join(srcdir, "threshold_monitor.yml")
 DI_EXE = os.path.join(srcdir, 'data_ingestion.py')
@@ -122,6 +133,973 @@ def run_calib2obspy(nslc, starttime=None, endtime=None, return_streams=False):
         return straw, stproc, stcal
     return 0 
 
+WFDISC_ROW = "%-6s %-8s %17.5f %8d %8d %8d %17.5f %8d %11.7f %16.6f %16.6f %-6s %-1s %-2s %-1s %-64s %-32s %10d %8d %-17s\n"
+def make_wfdisc_fixture(dbdir, datatype='s4', starttime=obspy.UTCDateTime(2024,8,14,23,0,0), seconds=60, samprate=100.0):
+    # writes a small Datascope database (wfdisc, snetsta and waveform files) for AK.PS01..HN? containing ramps, offset by 1000 counts per channel
+    dbname = os.path.join(dbdir, 'fixture')
+    os.makedirs(os.path.join(dbdir, 'wf'), exist_ok=True)
+    nsamp = int(seconds * samprate)
+    rows = ''
+    for i, chan in enumerate(['HNE', 'HNN', 'HNZ']):
+        data = (np.arange(nsamp) + 1000 * i).astype(np.int32)
+        dfile = f'PS01.{chan}.{datatype}'
+        if datatype == 'sd':
+            tr = obspy.Trace(data=data, header={'network':'AK', 'station':'PS01', 'channel':chan, 'sampling_rate':samprate, 'starttime':starttime})
+            tr.write(os.path.join(dbdir, 'wf', dfile), format='MSEED', reclen=512)
+        else:
+            data.astype(wfdisc2obspy.DATATYPES[datatype]).tofile(os.path.join(dbdir, 'wf', dfile))
+        rows += WFDISC_ROW % ('PS01', chan, starttime.timestamp, i+1, -1, int(starttime.strftime('%Y%j')), starttime.timestamp + (nsamp-1)/samprate, 
+                              nsamp, samprate, 1.0, 1.0, '-', 'A', datatype, '-', 'wf', dfile, 0, -1, '-')
+    with open(dbname + '.wfdisc', 'w') as fptr:
+        fptr.write(rows)
+    with open(dbname + '.snetsta', 'w') as fptr:
+        fptr.write("%-8s %-10s %-6s %-17s\n" % ('AK', 'PS01', 'PS01', '-'))
+    return dbname
+
+def make_event_fixture(dbdir, starttime=obspy.UTCDateTime(2024,8,14,23,0,0), seconds=300, samprate=100.0, gap=(200.5, 212.0)):
+    # like make_wfdisc_fixture(), but noise with an event at 100 s, and a gap in the data (so two wfdisc rows per channel)
+    dbname = os.path.join(dbdir, 'fixture')
+    os.makedirs(os.path.join(dbdir, 'wf'), exist_ok=True)
+    rng = np.random.default_rng(0)
+    nsamp = int(seconds * samprate)
+    rows = ''
+    for i, chan in enumerate(['HNE', 'HNN', 'HNZ']):
+        data = rng.normal(0, 2000, nsamp)
+        k = int(100 * samprate)
+        data[k:k+500] += 3e6 * np.sin(np.arange(500) / 5.0) * np.exp(-np.arange(500) / 150.0)
+        data = data.astype(np.int32)
+        for j, (i0, i1) in enumerate([(0, int(gap[0] * samprate)), (int(gap[1] * samprate), nsamp)]):
+            dfile = f'PS01.{chan}.{j}.s4'
+            data[i0:i1].astype(wfdisc2obspy.DATATYPES['s4']).tofile(os.path.join(dbdir, 'wf', dfile))
+            t1 = starttime + i0 / samprate
+            rows += WFDISC_ROW % ('PS01', chan, t1.timestamp, 2*i+j+1, -1, int(t1.strftime('%Y%j')), t1.timestamp + (i1-i0-1)/samprate, 
+                                  i1-i0, samprate, 1.0, 1.0, '-', 'A', 's4', '-', 'wf', dfile, 0, -1, '-')
+    with open(dbname + '.wfdisc', 'w') as fptr:
+        fptr.write(rows)
+    with open(dbname + '.snetsta', 'w') as fptr:
+        fptr.write("%-8s %-10s %-6s %-17s\n" % ('AK', 'PS01', 'PS01', '-'))
+    return dbname
+
+def run_wfdisc2obspy(datatype):
+    dbname = make_wfdisc_fixture(os.path.join(outputTop, f'wfdisc_{datatype}'), datatype=datatype)
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+
+    # a window inside the data
+    st = wfdisc2obspy.get_waveforms('AK', 'PS01', '*', 'HN?', t0+10, t0+11, dbname=dbname)
+    assert len(st)==3
+    for i, tr in enumerate(st):
+        assert tr.stats.npts == 101
+        assert (tr.data == np.arange(1000, 1101) + 1000 * i).all()
+
+    # a window starting before the data, which should be nan-filled
+    st = wfdisc2obspy.get_waveforms('AK', 'PS01', '', 'HNZ', t0-1, t0+1, dbname=dbname)
+    assert len(st)==1
+    assert np.isnan(st[0].data[0:100]).all()
+    assert (st[0].data[100:] == np.arange(2000, 2101)).all()
+
+    # and one ending after the data
+    st = wfdisc2obspy.get_waveforms('AK', 'PS01', '', 'HNZ', t0+59, t0+61, dbname=dbname)
+    assert (st[0].data[0:100] == np.arange(7900, 8000)).all()
+    assert np.isnan(st[0].data[100:]).all()
+    if datatype == 'sd': # only the records in each window were decoded, from the record index of each file
+        assert os.path.join(os.path.dirname(dbname), 'wf', 'PS01.HNZ.sd') in [key[0] for key in wfdisc2obspy.RECORD_INDEXES]
+    return 0
+
+class StandInServer(object):
+    # stands in for a Seedlink server or orbserver: returns 1-second packets for AK.PS01..HN?, each after a delay, and stalls after stall_after packets
+    def __init__(self, starttime, npackets, delay=0.0, stall_after=None):
+        self.starttime = starttime
+        self.npackets = npackets
+        self.delay = delay
+        self.stall_after = stall_after
+        self.i = 0
+        self.closed = threading.Event()
+
+    def select_stream(self, network, station, location, channel):
+        pass
+
+    def nextpacket2Stream(self, starttime=None, verbose=False):
+        if self.i >= self.npackets or (self.stall_after is not None and self.i >= self.stall_after):
+            self.closed.wait()
+            raise IOError('server closed')
+        time.sleep(self.delay)
+        st = obspy.Stream()
+        for chan in ['HNE', 'HNN', 'HNZ']:
+            tr = obspy.Trace(data=np.zeros(100), header={'network':'AK', 'station':'PS01', 'channel':chan, 'sampling_rate':100.0, \
+                                                         'starttime':self.starttime + self.i})
+            tr.stats['loadtime'] = obspy.UTCDateTime()
+            st.append(tr)
+        self.i += 1
+        return st
+
+    def nextpacket2Blocks(self, starttime_ns=None, verbose=False):
+        return data_ingestion.stream2blocks(self.nextpacket2Stream(verbose=verbose))
+
+    def close(self):
+        self.closed.set()
+
+def run_hedged2obspy(delays, stall_after=[None, None], npackets=20):
+    t0 = obspy.UTCDateTime() - npackets
+    sources = [StandInServer(t0, npackets, delay=delay, stall_after=stall) for delay, stall in zip(delays, stall_after)]
+    client = hedged2obspy.HedgedClient(sources, names=['server1', 'server2'])
+    client.select_stream('AK', 'PS01', '', 'HN?')
+    packets = [client.nextpacket2Stream() for i in range(npackets)]
+    client.close()
+    client.report()
+
+    # every trace once, and nothing missing
+    traces = [(tr.id, tr.stats.starttime.ns) for st in packets for tr in st]
+    assert len(traces) == len(set(traces)) == 3 * npackets
+    return client, packets
+
+def run_resequencer():
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    def packet(second): # a 1-second packet for AK.PS01..HNZ, with the second number as data
+        return [data_ingestion.ChannelBlock('AK.PS01..HNZ', (t0 + second).ns, 100.0, np.full(100, float(second)))]
+    resequencer = data_ingestion.Resequencer(max_hold_seconds=0.5)
+    released = []
+    def push(second):
+        blocks = resequencer.push(packet(second))
+        assert len(blocks) <= 1
+        for block in blocks:
+            released.extend(np.unique(block.data).tolist())
+
+    push(0)
+    push(2) # held, waiting for 1
+    assert released == [0]
+    push(1) # releases 1 and 2
+    push(1) # duplicate
+    push(4) # held, waiting for 3, which never arrives
+    time.sleep(0.6)
+    push(5) # 4 has now been held too long, so 4 and 5 are released
+    push(3) # too late
+    assert released == [0, 1, 2, 4, 5]
+    assert (resequencer.reorders, resequencer.duplicates, resequencer.late) == (2, 1, 1)
+    return 0
+
+def run_stall_watchdog():
+    stalls = []
+    watchdog = data_ingestion.StallWatchdog(0.5, lambda seconds, new_stall: stalls.append(new_stall), check_interval=0.1)
+    watchdog.start()
+    for i in range(10): # packets every 0.1 s, so no stall
+        time.sleep(0.1)
+        watchdog.feed()
+    assert stalls == []
+    time.sleep(1.25) # no packets: a new stall after 0.5 s, and the same stall again after 1.0 s
+    assert stalls == [True, False]
+    watchdog.feed()
+    time.sleep(0.7) # packets stop again: another new stall
+    watchdog.stop()
+    assert stalls == [True, False, True]
+    return 0
+
+def run_latency_stall_thread():
+    # stalls are reported from the StallWatchdog thread while the packet loop keeps updating (and trimming) the same latency object
+    outputdir = os.path.join(outputTop, 'latency_stall_thread')
+    os.makedirs(outputdir, exist_ok=True)
+    alarms = []
+    send_email_alarm = data_ingestion.send_email_alarm
+    data_ingestion.send_email_alarm = lambda subject, body, email_list, pngfile=None, verbose=True: alarms.append(pngfile)
+    try:
+        latencyObj = data_ingestion.latency('PS01', seconds_to_keep=1, maximum_latency=1e6, email_list=['nobody'], outputdir=outputdir, alarm_timeout=0)
+        server = StandInServer(obspy.UTCDateTime() - 1e5, 1000000) # late packets, but under maximum_latency: only stalls alarm
+        latencyObj.update(server.nextpacket2Blocks())
+        errors = []
+        def stalls():
+            try:
+                for i in range(10):
+                    latencyObj.stall(NSLC1, 2.0 + i, new_stall=(i==0))
+                    time.sleep(0.01) # each stall alarm has a distinct timestamp
+            except Exception as e:
+                errors.append(e)
+        watchdog = threading.Thread(target=stalls)
+        watchdog.start()
+        while watchdog.is_alive():
+            latencyObj.update(server.nextpacket2Blocks())
+        watchdog.join()
+
+        # a slow disk holds up writing the latency file, but not a stall alarm from the watchdog thread
+        append_to_csvfile = data_ingestion.append_to_csvfile
+        def slow_append(csvfile, row, timeout=0.3):
+            time.sleep(1.0)
+            append_to_csvfile(csvfile, row, timeout=timeout)
+        data_ingestion.append_to_csvfile = slow_append
+        try:
+            packets = threading.Thread(target=latencyObj.update, args=(server.nextpacket2Blocks(),))
+            packets.start()
+            time.sleep(0.1)
+            tic = time.time()
+            latencyObj.stall(NSLC1, 20.0, new_stall=False)
+            assert time.time() - tic < 0.9
+            packets.join()
+        finally:
+            data_ingestion.append_to_csvfile = append_to_csvfile
+    finally:
+        data_ingestion.send_email_alarm = send_email_alarm
+    assert errors == [], errors
+    assert len(alarms) == 11 and all(os.path.isfile(pngfile) for pngfile in alarms)
+    assert len({len(latencyObj.rownum), len(latencyObj.seed_id), len(latencyObj.time), len(latencyObj.min_latency), len(latencyObj.duration)}) == 1
+    assert latencyObj.stalls == 1 and latencyObj.longest_stall == 20.0
+    return 0
+
+class ReplayServer(StandInServer):
+    # like StandInServer, but returns packets at once, each stamped as loaded latencies[i] seconds after it ended, for a SimulatedClock. 
+    # packets numbered in missing are never sent
+    def __init__(self, starttime, latencies, missing=[]):
+        super().__init__(starttime, len(latencies))
+        self.latencies = latencies
+        self.missing = missing
+
+    def nextpacket2Stream(self, starttime=None, verbose=False):
+        while self.i in self.missing and self.i < self.npackets - 1:
+            self.i += 1
+        i = self.i
+        st = super().nextpacket2Stream(starttime=starttime, verbose=verbose)
+        for tr in st:
+            tr.stats['loadtime'] = tr.stats.endtime + self.latencies[i]
+        return st
+
+def run_simulated_clock():
+    # the stall watchdog, driven by a SimulatedClock rather than waiting
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    clock = data_ingestion.SimulatedClock(t0)
+    stalls = []
+    watchdog = data_ingestion.StallWatchdog(5.0, lambda seconds, new_stall: stalls.append(new_stall), clock=clock)
+    clock.sleep(4.0)
+    watchdog.check()
+    assert stalls == []
+    clock.sleep(2.0)
+    watchdog.check()
+    clock.sleep(5.0)
+    watchdog.check()
+    assert stalls == [True, False]
+
+    # 5 minutes of realtime packets, replayed as fast as they can be processed. Latency is 1 s, then climbs by 1 s per packet from
+    # 2 s to 181 s, then drops back to 1 s. So it passes maximum_latency (10 s) at packet 69, and alarms are sent there and then
+    # every latency_alarm_timeout (60 s) by the packet clock, which runs 2 s per packet while latency climbs: packets 100, 131 ... 224
+    latencies = [1.0] * 60 + [2.0 + i for i in range(180)] + [1.0] * 60
+    class ReplayClient(data_ingestion.RealTimeDataClient):
+        def create_client(self, datasource):
+            return ReplayServer(self.starttime, latencies)
+    outputdir = os.path.join(outputTop, 'simulated_clock')
+    os.makedirs(outputdir, exist_ok=True)
+    params = get_params()
+    params.update({'nslc':NSLC3, 'api':'replay', 'mode':'realtime', 'starttime':t0, 'endtime':t0 + len(latencies) - 1, 'outputdir':outputdir, \
+                   'simulated_clock':True, 'latency_on':True, 'maximum_latency':10, 'latency_alarm_timeout':60, 'catchup_latency':0, \
+                   'stall_seconds':0, 'verbose':0, 'benchmark':False})
+    tic = time.time()
+    client = ReplayClient(params) # the run ends with the first packet that ends after endtime, i.e. the last one
+    client.run()
+    client.close()
+    print(f'{len(latencies)} seconds of packets replayed in {time.time() - tic:.1f} seconds')
+    assert client.npackets == len(latencies)
+    alarms = sorted(glob.glob(os.path.join(outputdir, 'latency_alarm_PS01_*.png')))
+    expected = [(t0 + i + 0.99 + latencies[i]).strftime('%Y%m%d%H%M%S') for i in [69, 100, 131, 162, 193, 224]] # alarm time = loadtime
+    assert [os.path.basename(f)[-18:-4] for f in alarms] == expected
+    return 0
+
+def run_watch_threshold_monitor():
+    # latency and threshold CSV files whose last rows end at t0 + 100, watched every minute for 14 minutes by a SimulatedClock that
+    # starts then. Their modification times are set to 1970, to check that staleness comes from the rows, not the files. Latency 
+    # passes maximum_latency (600 s) 660 s later, and is still climbing 120 s after that, past latency_alarm_timeout (60 s)
+    import watch_threshold_monitor
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    outputdir = os.path.join(outputTop, 'watch_threshold_monitor')
+    os.makedirs(outputdir, exist_ok=True)
+    latencyfile = os.path.join(outputdir, 'latency_PS01.csv')
+    thresholdfile = os.path.join(outputdir, 'threshold_history_PS01.csv')
+    with open(latencyfile, 'w') as fptr:
+        fptr.write('rownum,seed_id,time,starttime,endtime,latency,duration\n')
+        fptr.write(f'0,{NSLC1},{t0 + 101},{t0 + 99},{t0 + 100},1.0,0.01\n')
+    with open(thresholdfile, 'w') as fptr:
+        fptr.write('rownum,seed_id,starttime,endtime,peaktime,value,status\n')
+        for c in 'ZNE':
+            fptr.write(f'0,AK.PS01..HN{c},{t0 + 99},{t0 + 100},{t0 + 99.5},0.001,OFF\n')
+    for f in [latencyfile, thresholdfile]:
+        os.utime(f, (0, 0))
+    params = {'outputdir':outputdir, 'max_iterations':14, 'refresh_interval':60.0, 'maximum_latency':600.0, 'latency_alarm_timeout':60.0, 'verbose':0}
+    alarmtimes = watch_threshold_monitor.watch(params, data_ingestion.SimulatedClock(t0 + 100))
+    assert alarmtimes == [t0 + 760, t0 + 880]
+    return 0
+
+def replay_params(t0, npackets, outputdir, **kwargs):
+    # parameters for a RealTimeDataClient fed by a ReplayServer, from t0 for npackets 1-second packets
+    os.makedirs(outputdir, exist_ok=True)
+    params = get_params()
+    params.update({'nslc':NSLC3, 'api':'replay', 'starttime':t0, 'endtime':t0 + npackets - 1, 'outputdir':outputdir, 'latency_on':False, \
+                   'catchup_latency':0, 'stall_seconds':0, 'checkpoint_seconds':0, 'backfill_gaps':False, 'verbose':0, 'benchmark':False})
+    params.update(kwargs)
+    return params
+
+def run_packet_gaps(mode):
+    # 120 1-second packets, with packets 50-52 and 117 missing. every packet that arrives is analyzed on its own, except in realtime 
+    # mode, where the resequencer holds the packets after a gap for max_hold_seconds (by packet time, with a SimulatedClock) before 
+    # releasing them together, and releases whatever it still holds at endtime
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    npackets = 120
+    missing = [50, 51, 52, 117]
+    class GapClient(data_ingestion.RealTimeDataClient):
+        def create_client(self, datasource):
+            return ReplayServer(self.starttime, [1.0] * npackets, missing=missing)
+        def analyze(self):
+            self.analyzed.append({block.seed_id: (block.start_ns, block.npts) for block in self.currentPacket})
+    outputdir = os.path.join(outputTop, f'packet_gaps_{mode}')
+    params = replay_params(t0, npackets, outputdir, mode=mode, simulated_clock=(mode == 'realtime'), max_hold_seconds=2.0)
+    client = GapClient(params)
+    client.analyzed = []
+    client.run()
+    client.close()
+    assert (client.resequencer is None) == (mode == 'archive')
+    assert all([len(packet) == 3 for packet in client.analyzed])
+    npts = [packet[NSLC3.replace('?', 'Z')][1] for packet in client.analyzed]
+    assert sum(npts) == 100 * (npackets - len(missing)) # nothing lost, nothing repeated
+    assert client.gaps[NSLC3.replace('?', 'Z')]['gaps'] == 2
+    if mode == 'archive':
+        assert npts == [100] * (npackets - len(missing))
+    else: # packets 53-55 come out together once packet 55 arrives, and 118-119 at endtime
+        assert npts.count(100) == npackets - len(missing) - 5
+        assert sorted([n for n in npts if n != 100]) == [200, 300]
+    return 0
+
+def run_packet_gaps_chunks():
+    # archive mode in 20-second chunks, over noise with an event and a gap from 200.5 s to 212 s, which spans the chunk boundary at 
+    # 210 s. The gap is found in the data of the chunks, once for each channel, and logged, just as in the packet loop
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    dbname = make_event_fixture(os.path.join(outputTop, 'wfdisc_event'), starttime=t0)
+    outputdir = os.path.join(outputTop, 'packet_gaps_chunks')
+    os.makedirs(outputdir, exist_ok=True)
+    params = get_params()
+    params.update({'nslc':NSLC3, 'api':'datascope2obspy', 'datasource':dbname, 'mode':'archive', 'starttime':t0 + 10, 'endtime':t0 + 250, \
+                   'archive_chunk_seconds':20, 'outputdir':outputdir, 'latency_on':False, 'verbose':0, 'benchmark':False, 'checkpoint_seconds':0})
+    client = data_ingestion.RealTimeDataClient(params)
+    client.run()
+    client.close()
+    for seed_id in [NSLC3.replace('?', chan[-1]) for chan in ['HNE', 'HNN', 'HNZ']]:
+        assert client.gaps[seed_id]['gaps'] == 1
+        assert round(client.gaps[seed_id]['missing_seconds'], 2) == 11.5
+    gapsdf = pd.read_csv(os.path.join(outputdir, 'gaps_PS01.csv'))
+    assert len(gapsdf) == 3
+    assert all([obspy.UTCDateTime(tstr) == t0 + 200.5 for tstr in gapsdf['gapstart']])
+    assert all([obspy.UTCDateTime(tstr) == t0 + 211.99 for tstr in gapsdf['gapend']])
+    return 0
+
+def run_checkpoint_resume():
+    # realtime mode with a simulated clock: run for 30 1-second packets, each with a SeedLink-style sequence number, then restart. The 
+    # restart resumes after the last packet, from its sequence number, with the buffer it had, so the first packet is filtered with 
+    # it rather than on its own. A restart more than max_checkpoint_age after the checkpoint starts afresh instead
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    class SequencedServer(ReplayServer):
+        def __init__(self, starttime, latencies, seqnum):
+            super().__init__(starttime, latencies)
+            self.seqnum = seqnum
+        def nextpacket2Stream(self, starttime=None, verbose=False):
+            st = super().nextpacket2Stream(starttime=starttime, verbose=verbose)
+            self.seqnum += 1
+            for tr in st:
+                tr.stats['seqnum'] = self.seqnum
+            return st
+    class CheckpointClient(data_ingestion.RealTimeDataClient):
+        def create_client(self, datasource): # like SlinkClient, carry on after the sequence number of the last packet, if resuming
+            self.seqnum = self.resumed_state['seqnum'] if self.resumed_state else 999
+            starttime = self.starttime + 0.01 if self.resumed_state else self.starttime # the sample after the last packet
+            return SequencedServer(starttime, [1.0] * 10, self.seqnum)
+        def process_detached_packet(self, update_now):
+            self.detached.append(data_ingestion.to_utc(self.currentPacket[0].start_ns) - t0)
+            return super().process_detached_packet(update_now)
+    outputdir = os.path.join(outputTop, 'checkpoint_resume')
+    checkpointfile = os.path.join(outputdir, 'checkpoint_PS01.pkl')
+    runs = []
+    for starttime, npackets in [(t0, 10), (t0, 20), (t0 + 3600, 10)]: # the first run, its restart, and a much later one
+        params = replay_params(starttime, npackets, outputdir, mode='realtime', simulated_clock=True, checkpoint_seconds=5, \
+                               max_checkpoint_age=3000)
+        client = CheckpointClient(params)
+        client.detached = []
+        client.run()
+        client.close()
+        runs.append(client)
+        assert os.path.isfile(checkpointfile)
+
+    first, restart, later = runs
+    assert first.resumed_state is None and first.seqnum == 999
+    assert first.nextpacketstarttime == (t0 + 9.99).ns
+    assert first.detached == [0] # only the first packet, which starts the buffer
+    assert restart.resumed_state['nextpacketstarttime'] == t0 + 9.99
+    assert restart.resumed_state['seqnum'] == 1009
+    assert restart.starttime == t0 + 9.99 and restart.seqnum == 1009
+    assert restart.resumed_state['buffer'][0].end_ns == (t0 + 9.99).ns
+    assert restart.detached == [] # the restored buffer carries on from packet 10
+    assert restart.nextpacketstarttime == (t0 + 19.99).ns
+    assert restart.missing_records == {'AK.PS01': 0} # none missed across the restart
+    assert later.resumed_state is None # the checkpoint from the restart is 3580 s old
+    assert later.starttime == t0 + 3600 and later.seqnum == 999
+    assert later.detached == [3600]
+    return 0
+
+def run_catch_up():
+    # 40 1-second packets, analyzed in 3-second windows. Packet 20 arrives 40 s late, and the 9 after it queue up behind it, so 
+    # packets 20-29 are more than catchup_latency (30 s) behind, and are caught up in batches of 5 packets, as whole windows from 20,
+    # 23 and 26. Packet 30 is not behind, so the second left over, from 29, is analyzed before packet 30 is
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    latencies = [1.0] * 20 + [40.0 - i for i in range(10)] + [1.0] * 10
+    class CatchUpClient(data_ingestion.RealTimeDataClient):
+        def create_client(self, datasource):
+            return ReplayServer(self.starttime, latencies)
+        def analyze(self):
+            self.analyzed.append([data_ingestion.to_utc(block.start_ns) for block in self.currentPacket if block.seed_id == NSLC3.replace('?', 'Z')][0] - t0)
+    outputdir = os.path.join(outputTop, 'catch_up')
+    params = replay_params(t0, len(latencies), outputdir, mode='realtime', simulated_clock=True, secondsPerPacket=3.0, \
+                           catchup_latency=30, catchup_batch_seconds=4)
+    client = CatchUpClient(params)
+    client.analyzed = []
+    client.run()
+    client.close()
+    assert client.catchup_remainder is None
+    assert [round(t, 2) for t in client.analyzed] == list(range(20)) + [20, 23, 26, 29] + list(range(30, 40))
+    return 0
+
+def run_backfill():
+    # 120 1-second packets, with packets 50-52 and 80-89 missing, and SeedLink-style sequence numbers that wrap around at 2**24 after 
+    # packet 59. Both gaps are found, and both are seen as missing records. With backfill on, the first gap is fetched from the server
+    # and analyzed as 1-second packets, in time order, before packet 53 is. The second is longer than max_backfill_seconds, so is not
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    npackets = 120
+    missing = [50, 51, 52] + list(range(80, 90))
+    class BackfillServer(ReplayServer):
+        def nextpacket2Stream(self, starttime=None, verbose=False):
+            st = super().nextpacket2Stream(starttime=starttime, verbose=verbose)
+            for tr in st:
+                tr.stats['seqnum'] = (2**24 - 60 + self.i - 1) % 2**24
+            return st
+        def get_waveforms(self, starttime, endtime):
+            self.fetched.append((starttime - t0, endtime - t0))
+            st = obspy.Stream()
+            for chan in ['HNE', 'HNN', 'HNZ']:
+                st.append(obspy.Trace(data=np.ones(int(round((endtime - starttime) * 100)) + 1), header={'network':'AK', 'station':'PS01', \
+                                      'channel':chan, 'sampling_rate':100.0, 'starttime':starttime}))
+            return st
+    class BackfillClient(data_ingestion.RealTimeDataClient):
+        def create_client(self, datasource):
+            server = BackfillServer(self.starttime, [1.0] * npackets, missing=missing)
+            server.fetched = []
+            return server
+        def analyze(self):
+            self.analyzed.append([data_ingestion.to_utc(block.start_ns) for block in self.currentPacket if block.seed_id == NSLC3.replace('?', 'Z')][0] - t0)
+    outputdir = os.path.join(outputTop, 'backfill')
+    params = replay_params(t0, npackets, outputdir, mode='archive', backfill_gaps=True, max_backfill_seconds=5)
+    client = BackfillClient(params)
+    client.analyzed = []
+    client.run()
+    client.close()
+
+    for seed_id in [NSLC3.replace('?', chan[-1]) for chan in ['HNE', 'HNN', 'HNZ']]:
+        assert client.gaps[seed_id]['gaps'] == 2
+        assert round(client.gaps[seed_id]['missing_seconds'], 2) == 13.0
+        assert round(client.gaps[seed_id]['backfilled_seconds'], 2) == 3.0
+    gapsdf = pd.read_csv(os.path.join(outputdir, 'gaps_PS01.csv'))
+    assert len(gapsdf) == 6
+    assert client.missing_records == {'AK.PS01': 13} # across the wrap-around too
+    assert [(round(start, 2), round(end, 2)) for start, end in client.client.fetched] == [(50.0, 52.99)]
+    analyzed = [round(t, 2) for t in client.analyzed]
+    assert analyzed == [t for t in range(npackets) if not t in missing[3:]] # the backfilled packets in their place, in time order
+    return 0
+
+def run_archive_chunks(**kwargs):
+    # archive mode, packet by packet and in 60-second chunks, over noise with an event and a gap in it. Each chunk processes every
+    # packet with the buffer in front of it, as the packet loop does, so the threshold histories should be the same
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    dbname = make_event_fixture(os.path.join(outputTop, 'wfdisc_event'), starttime=t0)
+    histories = {}
+    for chunk_seconds in [0, 60]:
+        outputdir = os.path.join(outputTop, '_'.join(['archive_chunks', str(chunk_seconds)] + [f'{key}_{value}' for key, value in kwargs.items()]))
+        os.makedirs(outputdir, exist_ok=True)
+        params = get_params()
+        params.update({'nslc':NSLC3, 'api':'datascope2obspy', 'datasource':dbname, 'mode':'archive', 'starttime':t0 + 10, 'endtime':t0 + 250, \
+                       'archive_chunk_seconds':chunk_seconds, 'metrics':['PGV'], 'outputdir':outputdir, 'latency_on':False, 'verbose':0, 
+                       'benchmark':False, 'checkpoint_seconds':0})
+        params.update(kwargs)
+        datahandler = threshold_monitor.MyDataClient(params)
+        datahandler.run()
+        datahandler.close()
+        histories[chunk_seconds] = {os.path.basename(csvfile): pd.read_csv(csvfile) for csvfile in glob.glob(os.path.join(glob.escape(outputdir), 'threshold_history_*.csv'))}
+    assert sorted(histories[0]) == sorted(histories[60]) == ['threshold_history_PS01.csv', 'threshold_history_PS01_PGV.csv']
+    for csvfile, df in histories[0].items():
+        df60 = histories[60][csvfile]
+        assert len(df) == len(df60) == df['seed_id'].nunique() * (240 - 10) # 10 packets are in the gap
+        for column in ['seed_id', 'starttime', 'endtime', 'peaktime', 'status']:
+            assert (df[column] == df60[column]).all()
+        assert np.allclose(df['value'], df60['value'], rtol=1e-6, atol=0)
+    assert set(histories[0]['threshold_history_PS01.csv']['status']) > {'OFF'} # the event is above a threshold
+    return 0
+
+def run_time_shards():
+    # an archive rerun over noise with an event and a gap, split into 2 time shards of 140 s. The second shard starts early by the 
+    # overlap: the 40-s filter buffer (2 / 0.05 Hz) plus the 60-s threshold_alarm_timeout. Merged, the shards give the same threshold 
+    # history as the whole run, with no packet missing or repeated
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    dbname = make_event_fixture(os.path.join(outputTop, 'wfdisc_event'), starttime=t0)
+    histories = {}
+    for name in ['whole', 'sharded']:
+        outputdir = os.path.join(outputTop, f'time_shards_{name}')
+        os.makedirs(outputdir, exist_ok=True)
+        params = get_params()
+        params.update({'nslc':NSLC3, 'api':'datascope2obspy', 'datasource':dbname, 'mode':'archive', 'starttime':t0 + 10, 'endtime':t0 + 290, \
+                       'outputdir':outputdir, 'latency_on':False, 'verbose':0, 'benchmark':False, 'checkpoint_seconds':0})
+        if name == 'whole':
+            datahandler = threshold_monitor.run_parallel(params)
+        else:
+            params['backfill_shard_seconds'] = 140
+            shard_list = threshold_monitor.parse_time_shards([params])
+            assert [(shard['starttime'] - t0, shard['shard_starttime'] - t0, shard['alarms_from'] - t0, shard['endtime'] - t0) for shard in shard_list] \
+                == [(10, 10, 10, 150), (50, 150, 150, 290)]
+            assert len(set([shard['outputdir'] for shard in shard_list])) == 2
+            datahandlers = threshold_monitor.merge_time_shards([threshold_monitor.run_parallel(shard) for shard in shard_list], outputdir)
+            assert len(datahandlers) == 1
+            datahandler = datahandlers[0]
+            assert datahandler.outputdir == outputdir
+            assert glob.glob(os.path.join(outputdir, 'threshold_alarm_*.png')) # the event alarm, moved from the first shard
+        histories[name] = pd.read_csv(datahandler.thresholdHistoryObject.csvfile)
+    whole, sharded = histories['whole'], histories['sharded']
+    assert len(whole) == whole['seed_id'].nunique() * (280 - 10) # 10 packets are in the gap
+    assert not sharded.duplicated(['seed_id', 'starttime']).any()
+    for column in ['rownum', 'seed_id', 'starttime', 'endtime', 'peaktime', 'status']:
+        assert (whole[column] == sharded[column]).all()
+    assert np.allclose(whole['value'], sharded['value'], rtol=1e-6, atol=0)
+    return 0
+
+def run_archive_readahead():
+    # archive mode in 30-second chunks from a synthetic Datascope database. With read-ahead, each chunk after the first is read in the
+    # background while the chunk before is being processed. Without, each chunk is read in turn. Either way the same packets are analyzed
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    dbname = make_event_fixture(os.path.join(outputTop, 'wfdisc_event'), starttime=t0)
+    analyzed = {}
+    for readahead_packets in [60, 0]:
+        log = []
+        class ReadaheadClient(data_ingestion.RealTimeDataClient):
+            def create_client(self, datasource):
+                client = super().create_client(datasource)
+                get_waveforms = client.get_waveforms
+                def logged_get_waveforms(starttime, endtime):
+                    log.append(('read', endtime, threading.current_thread() is threading.main_thread()))
+                    return get_waveforms(starttime, endtime)
+                client.get_waveforms = logged_get_waveforms
+                return client
+            def process_chunk(self, blocks, chunkstarttime, chunkendtime):
+                if readahead_packets > 0 and chunkendtime < self.endtime: # give the read of the next chunk a chance to start
+                    deadline = time.time() + 10.0
+                    while ('read', min([chunkendtime + 30, self.endtime]), False) not in log and time.time() < deadline:
+                        time.sleep(0.01)
+                log.append(('process', chunkendtime))
+                return super().process_chunk(blocks, chunkstarttime, chunkendtime)
+            def analyze(self):
+                self.analyzed.append({block.seed_id: (block.start_ns, block.data.copy()) for block in self.currentPacket})
+        outputdir = os.path.join(outputTop, f'archive_readahead_{readahead_packets}')
+        os.makedirs(outputdir, exist_ok=True)
+        params = get_params()
+        params.update({'nslc':NSLC3, 'api':'datascope2obspy', 'datasource':dbname, 'mode':'archive', 'starttime':t0 + 10, 'endtime':t0 + 130, \
+                       'archive_chunk_seconds':30, 'readahead_packets':readahead_packets, 'outputdir':outputdir, 'latency_on':False, 
+                       'verbose':0, 'benchmark':False, 'checkpoint_seconds':0})
+        client = ReadaheadClient(params)
+        client.analyzed = []
+        client.run()
+        client.close()
+        chunkends = [t0 + 40, t0 + 70, t0 + 100, t0 + 130]
+        assert [entry[1] for entry in log if entry[0] == 'read'] == chunkends
+        assert [entry[1] for entry in log if entry[0] == 'process'] == chunkends
+        if readahead_packets > 0: # read in the background, and the next chunk is read before the current one has been processed
+            assert not any([entry[2] for entry in log if entry[0] == 'read'])
+            for chunkend in chunkends[0:-1]:
+                assert log.index(('read', chunkend + 30, False)) < log.index(('process', chunkend))
+        else:
+            assert all([entry[2] for entry in log if entry[0] == 'read'])
+        analyzed[readahead_packets] = client.analyzed
+    assert len(analyzed[60]) == len(analyzed[0]) == 120
+    for packet60, packet0 in zip(analyzed[60], analyzed[0]):
+        assert packet60.keys() == packet0.keys()
+        for seed_id in packet60:
+            assert packet60[seed_id][0] == packet0[seed_id][0]
+            assert np.array_equal(packet60[seed_id][1], packet0[seed_id][1])
+    return 0
+
+def flaky_shard(param_list, results, shard_index):
+    # stands in for threshold_monitor.run_station_shard in a worker process. the worker for shard 0 dies the first time it is 
+    # started, and the worker for shard 1 finishes without returning its results
+    marker = os.path.join(param_list[0]['outputdir'], f'started_{shard_index}')
+    if shard_index == 0 and not os.path.isfile(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+    if shard_index == 1:
+        return
+    results.put((shard_index, [types.SimpleNamespace(station=params['nslc'].split('.')[1], restarts=0) for params in param_list]))
+
+def run_station_shards():
+    # stations weighted by the total sampling rate of their channels in a StationXML file: PS02 (3 x 200 Hz), PS01 (3 x 100 Hz), 
+    # PS03 (3 x 50 Hz) and PS04 (1 x 100 Hz). PS05 is not in it, so has a weight of 1. Each station, heaviest first, goes to the 
+    # least loaded of 2 shards
+    from obspy.core.inventory import Inventory, Network, Station, Channel
+    outputdir = os.path.join(outputTop, 'station_shards')
+    os.makedirs(outputdir, exist_ok=True)
+    xmlfile = os.path.join(outputdir, 'stations.xml')
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    stations = []
+    for sta, chans, rate in [('PS01', 'ENZ', 100.0), ('PS02', 'ENZ', 200.0), ('PS03', 'ENZ', 50.0), ('PS04', 'Z', 100.0)]:
+        channels = [Channel(code=f'HN{c}', location_code='', latitude=0.0, longitude=0.0, elevation=0.0, depth=0.0, sample_rate=rate, \
+                            start_date=t0 - 86400) for c in chans]
+        stations.append(Station(code=sta, latitude=0.0, longitude=0.0, elevation=0.0, channels=channels, start_date=t0 - 86400))
+    Inventory(networks=[Network(code='AK', stations=stations)], source='test').write(xmlfile, format='STATIONXML')
+    inventory = obspy.read_inventory(xmlfile)
+    param_list = [{'nslc':f'AK.{sta}..HN?', 'starttime':t0, 'xmlfile':xmlfile} for sta in ['PS01', 'PS02', 'PS03', 'PS04', 'PS05']]
+
+    assert [threshold_monitor.station_weight(params, inventory) for params in param_list] == [300.0, 600.0, 150.0, 100.0, 1.0]
+    assert threshold_monitor.station_weight(param_list[0]) == 1.0 # no inventory
+    assert threshold_monitor.station_weight(dict(param_list[1], starttime=t0 - 2 * 86400), inventory) == 1.0 # before the channels start
+
+    before = param_list[1].copy()
+    stas = lambda shards: [[params['nslc'].split('.')[1] for params in shard] for shard in shards]
+    assert stas(threshold_monitor.assign_station_shards(param_list, 2)) == [['PS02'], ['PS01', 'PS03', 'PS04', 'PS05']]
+    assert stas(threshold_monitor.assign_station_shards(param_list, 3)) == [['PS02'], ['PS01'], ['PS03', 'PS04', 'PS05']]
+    assert stas(threshold_monitor.assign_station_shards(param_list, 10)) == [['PS02'], ['PS01'], ['PS03'], ['PS04'], ['PS05']] # one per station at most
+    assert stas(threshold_monitor.assign_station_shards(param_list, 0)) == [['PS02', 'PS01', 'PS03', 'PS04', 'PS05']] # at least one
+    assert param_list[1] == before # params are shared out, not changed
+
+    # without an inventory, every station counts the same, so they are dealt out in turn
+    no_inventory = [dict(params, xmlfile=os.path.join(outputdir, 'missing.xml')) for params in param_list]
+    assert stas(threshold_monitor.assign_station_shards(no_inventory, 2)) == [['PS01', 'PS03', 'PS05'], ['PS02', 'PS04']]
+    return 0
+
+def run_station_supervisor():
+    outputdir = os.path.join(outputTop, 'station_supervisor')
+    os.makedirs(outputdir, exist_ok=True)
+    for marker in glob.glob(os.path.join(outputdir, 'started_*')):
+        os.remove(marker)
+    starttime = obspy.UTCDateTime() - 60
+    station_shards = [[{'nslc':f'AK.{sta}..HN?', 'starttime':starttime, 'endtime':starttime + 3600, 'outputdir':outputdir}] for sta in ['PS01', 'PS02']]
+    tic = time.time()
+    datahandlers = threshold_monitor.supervise_station_shards(station_shards, max_backoff=4.0, worker=flaky_shard)
+    seconds = time.time() - tic
+    assert [(datahandler.station, datahandler.restarts) for datahandler in datahandlers] == [('PS01', 1)]
+    assert station_shards[0][0]['starttime'] > starttime # the dead worker was restarted from now
+    assert station_shards[1][0]['starttime'] == starttime
+    assert 1.0 <= seconds < 10.0 # after a 1-second backoff, and without waiting for results that never come
+
+    # supervise_station with a stand-in station that, on each start, fails in its constructor ('init'), fails before its first packet 
+    # ('none'), fails after some packets ('some') or finishes ('done'), and a SimulatedClock, so the backoff does not wait
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    class StandInStation:
+        outcomes = []
+        starttimes = []
+        def __init__(self, params):
+            StandInStation.starttimes.append(params['starttime'])
+            self.outcome = StandInStation.outcomes.pop(0)
+            self.station = params['nslc'].split('.')[1]
+            self.npackets = 0
+            if self.outcome == 'init':
+                raise KeyError(self.station)
+        def run(self):
+            if self.outcome == 'some':
+                self.npackets = 5
+            if self.outcome != 'done':
+                raise IOError('disk full')
+        def close(self):
+            pass
+    def supervise(outcomes, **kwargs):
+        StandInStation.outcomes = list(outcomes)
+        StandInStation.starttimes = []
+        params = {'nslc':NSLC3, 'starttime':t0, 'endtime':t0 + 3600, 'simulated_clock':True, 'max_restart_backoff':60.0}
+        params.update(kwargs)
+        try:
+            return threshold_monitor.supervise_station(params).restarts
+        except threshold_monitor.StationFailedError as e:
+            return f'gave up after {e.restarts}'
+    mydataclient = threshold_monitor.MyDataClient
+    threshold_monitor.MyDataClient = StandInStation
+    tic = time.time()
+    try:
+        assert supervise(['done']) == 0
+        assert supervise(['some', 'none', 'init', 'done'], max_restarts=2) == 3
+        assert StandInStation.starttimes == [t0, t0 + 1, t0 + 3, t0 + 7] # each restarted from now by the clock, after 1, 2, 4 seconds
+        assert supervise(['init']) == 'gave up after 0' # most likely a configuration problem, so not restarted
+        assert supervise(['none']) == 'gave up after 0'
+        assert supervise(['some', 'none', 'init', 'done'], max_restarts=1) == 'gave up after 2'
+        assert supervise(['some', 'none', 'some', 'none', 'init', 'some', 'done'], max_restarts=2) == 6 # counts failures in a row
+        assert supervise(['some'] * 5, endtime=t0 + 10) == 4 # endtime passed while waiting for the 5th start
+        assert supervise(['some', 'init'], endtime=t0 + 2) == 2 # the first one, since the second never got as far as running
+    finally:
+        threshold_monitor.MyDataClient = mydataclient
+    assert time.time() - tic < 1.0
+    return 0
+
+def run_quiet_gate():
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    rng = np.random.default_rng(0)
+    data = 1000.0 + 10.0 * rng.standard_normal(6000) # counts, with a DC offset
+    data[4500:4510] += 2000.0 # a spike 45 s in
+    tr = obspy.Trace(data=data, header={'network':'AK', 'station':'PS01', 'channel':'HNZ', 'sampling_rate':100.0, 'starttime':t0})
+    gains = {tr.id: 1.0e5}
+    gate = data_ingestion.QuietGate(sta_seconds=1.0, lta_seconds=10.0, trigger_ratio=2.5)
+    def packet(second):
+        return data_ingestion.stream2blocks(obspy.Stream([tr.slice(t0 + second, t0 + second + 0.99)]))
+    quiet = [gate.update(packet(second), gains, quiet_level=0.01) is not None for second in range(60)]
+    assert not any(quiet[0:10]) # LTA warming up
+    assert all(quiet[10:45]) # background noise
+    assert not quiet[45] # the spike triggers the full path
+    # the gate needs a quiet_level, as the STA/LTA alone would let a slow rise through (see run_quiet_gate_ramp())
+    try:
+        gate.update(packet(45), gains, quiet_level=None)
+        assert False, 'no quiet_level accepted'
+    except ValueError:
+        pass
+    # the most a filter can amplify a peak by is at least 1 (a Butterworth filter passes its passband at 1), but not much more
+    peak_gain = data_ingestion.filter_peak_gain(100.0, {'type':'highpass', 'freq':[0.05], 'corners':4, 'zerophase':False})
+    assert data_ingestion.filter_peak_gain(100.0, None) == 1.0 and 1.0 < peak_gain < 5.0
+    # a gap starts the warm-up again, as does a packet whose gain-corrected peak reaches quiet_level
+    assert gate.update(packet(50), gains, quiet_level=0.01) is None
+    assert gate.update(packet(51), gains, quiet_level=0.01) is None
+    gate = data_ingestion.QuietGate(sta_seconds=1.0, lta_seconds=10.0, trigger_ratio=2.5)
+    for second in range(20):
+        quiet_data = gate.update(packet(second), gains, quiet_level=1.0e-4)
+    assert quiet_data is None
+
+    # threshold_monitor.py sets quiet_level from the PGA thresholds, and PGA<window> thresholds if lower. Thresholds on any other 
+    # metric turn the quiet gate off, as they cannot be checked against the raw counts. A metric with no thresholds does not. Nor can 
+    # the instrument response correction, so remove_instrument_response turns it off too
+    dbname = make_wfdisc_fixture(os.path.join(outputTop, 'wfdisc_s4'))
+    outputdir = os.path.join(outputTop, 'quiet_gate')
+    os.makedirs(outputdir, exist_ok=True)
+    for metric_thresholds, quiet_level, remove_response in [({}, 0.5 * 0.02, False), ({'PGA5.0': {'LOW': 0.01}}, 0.5 * 0.01, False), \
+                                                            ({'PGV': {'LOW': 0.05}}, None, False), ({}, None, True)]:
+        params = get_params()
+        params.update({'nslc':NSLC3, 'api':'datascope2obspy', 'datasource':dbname, 'mode':'archive', 'starttime':t0, 'endtime':t0 + 10, \
+                       'outputdir':outputdir, 'latency_on':False, 'verbose':0, 'benchmark':False, 'quiet_gate':True, \
+                       'thresholds':{'PS01': {'LOW': 0.02, 'MEDIUM': 0.15, 'HIGH': 0.25}}, 'metrics':['PGA5.0', 'PGV', 'PSA1.0'], \
+                       'metric_thresholds':{'PS01': metric_thresholds}, 'pga_component':'max', 'remove_instrument_response':remove_response})
+        datahandler = threshold_monitor.MyDataClient(params)
+        datahandler.close()
+        assert (datahandler.quietGate is None) == (quiet_level is None)
+        if quiet_level:
+            assert np.isclose(datahandler.quiet_level, quiet_level * ground_motion.G) # in m/s^2
+    return 0
+
+def run_quiet_gate_ramp():
+    # a 2 Hz sine whose amplitude grows by 4% a second, from 0.002 m/s^2 to past the LOW threshold (0.02 g) 115 s in. It grows too 
+    # slowly to trigger the STA/LTA, so only quiet_level keeps it off the quiet path, well before it crosses the threshold, which 
+    # must raise an alarm
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    npackets = 160
+    inventory = obspy.read_inventory(os.path.join(srcdir, 'pipeline_stations.xml'))
+    gains = {seed_id: inventory.get_response(seed_id, t0).instrument_sensitivity.value for seed_id in [NSLC3.replace('?', c) for c in 'ENZ']}
+    def acceleration(t):
+        return 0.002 * np.exp(0.04 * t) * np.sin(2 * np.pi * 2.0 * t)
+    class RampServer(ReplayServer):
+        def nextpacket2Stream(self, starttime=None, verbose=False):
+            st = super().nextpacket2Stream(starttime=starttime, verbose=verbose)
+            for tr in st:
+                tr.data = acceleration(tr.times() + (tr.stats.starttime - t0)) * gains[tr.id] # counts
+            return st
+    class RampClient(threshold_monitor.MyDataClient):
+        def create_client(self, datasource):
+            return RampServer(self.starttime, [1.0] * npackets)
+        def process_quiet_packet(self, quiet_data):
+            self.quiet_packets.append(data_ingestion.to_utc(self.currentPacket[0].start_ns) - t0)
+            return super().process_quiet_packet(quiet_data)
+        def send_alarm(self, seed_id, starttime, endtime, peaktime, value, status, thresholdDetections, metric='PGA'):
+            self.alarms.append((data_ingestion.to_utc(peaktime) - t0, status))
+    outputdir = os.path.join(outputTop, 'quiet_gate_ramp')
+    params = replay_params(t0, npackets, outputdir, mode='archive', quiet_gate=True, lta_seconds=10.0, pga_component='max', \
+                           thresholds={'PS01': {'LOW': 0.02, 'MEDIUM': 0.15, 'HIGH': 0.25}})
+    client = RampClient(params)
+    client.quiet_packets = []
+    client.alarms = []
+    client.run()
+    client.close()
+    crossing = np.log(0.02 * ground_motion.G / 0.002) / 0.04
+    assert len(client.quiet_packets) > 20 and max(client.quiet_packets) < crossing - 30 # the quiet path was taken, but not near the crossing
+    assert client.alarms and client.alarms[0][1] == 'LOW' and abs(client.alarms[0][0] - crossing) < 1.0
+
+    # the STA/LTA on its own would have let every packet through, once warmed up
+    gate = data_ingestion.QuietGate(sta_seconds=1.0, lta_seconds=10.0, trigger_ratio=2.5)
+    server = RampServer(t0, [1.0] * npackets)
+    quiet = [gate.update(server.nextpacket2Blocks(), gains, quiet_level=np.inf) is not None for i in range(npackets)]
+    assert all(quiet[15:])
+    return 0
+
+def run_incremental_detrend():
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    rng = np.random.default_rng(0)
+    data = 500.0 + 0.3 * np.arange(3000) + 20.0 * rng.standard_normal(3000) # counts, with an offset and a trend
+    tr = obspy.Trace(data=data, header={'network':'AK', 'station':'PS01', 'channel':'HNZ', 'sampling_rate':100.0, 'starttime':t0})
+    def packet(first, last): # samples first to last, inclusive
+        return data_ingestion.stream2blocks(obspy.Stream([tr.slice(t0 + first/100, t0 + last/100)]))
+    buffer = data_ingestion.Buffer(packet(0, 99), None, bufferSecs=10.0)
+    # packets that follow on, overlap by a sample, leave a gap (filled by interpolation), and a batch of several seconds at once
+    for first, last in [(100, 199), (199, 299), (350, 449), (450, 999), (1000, 1099), (1100, 2999)]:
+        buffer.append(packet(first, last))
+        buffer.trim2seconds()
+        buffer.filter() # no filterdef, so this just detrends
+        expected = buffer.blocks['AK.PS01..HNZ'].copy().to_trace().detrend('linear')
+        assert np.allclose(buffer.tmp['AK.PS01..HNZ'].data, expected.data, rtol=0, atol=1e-9 * np.abs(data).max())
+        assert buffer.sums['AK.PS01..HNZ']['n'] == buffer.blocks['AK.PS01..HNZ'].npts
+    # the running sums agree with sums worked out from scratch
+    sums = dict(buffer.sums['AK.PS01..HNZ'])
+    buffer.resync()
+    resynced = buffer.sums['AK.PS01..HNZ']
+    assert np.isclose(sums['sx'], resynced['sx']) and np.isclose(sums['stx'] - sums['first'] * sums['sx'], resynced['stx'])
+    return 0
+
+def run_channel_blocks():
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 2000, 3000)
+    tr = obspy.Trace(data=data, header={'network':'AK', 'station':'PS01', 'channel':'HNZ', 'sampling_rate':100.0, 'starttime':t0})
+    def packet(first, last): # samples first to last, inclusive
+        return obspy.Stream([tr.slice(t0 + first/100, t0 + last/100).copy()])
+    buffer = data_ingestion.Buffer(data_ingestion.stream2blocks(packet(500, 599)), None, bufferSecs=10.0)
+    expected = packet(500, 599)
+    # follows on, overlaps, leaves a gap, lies within the buffer, comes before it (with a gap), and spans all of it
+    for first, last in [(600, 699), (650, 799), (850, 949), (700, 720), (300, 449), (200, 1100), (1101, 2999)]:
+        st = packet(first, last)
+        st[0].data += 1.0 # so overlapping samples differ, and we can tell which are kept
+        buffer.append(data_ingestion.stream2blocks(st))
+        buffer.trim2seconds()
+        expected = (expected + st).merge(method=1, fill_value='interpolate', interpolation_samples=0)
+        expected.trim(starttime=expected[0].stats.endtime - 10.0)
+        block = buffer.blocks['AK.PS01..HNZ']
+        assert block.start_ns == expected[0].stats.starttime.ns
+        assert np.array_equal(block.data, expected[0].data)
+    # the packet comes back out of the tmp buffer, as a list of ChannelBlocks
+    buffer.filter()
+    blocks = buffer.trim2packet(data_ingestion.stream2blocks(packet(2900, 2999)))
+    assert blocks[0].seed_id == 'AK.PS01..HNZ' and blocks[0].start_ns == (t0 + 29.0).ns and blocks[0].npts == 100
+    assert np.allclose(blocks[0].data, buffer.blocks['AK.PS01..HNZ'].copy().to_trace().detrend('linear').data[-100:])
+    return 0
+
+def run_float32():
+    # a quiet background with a strong burst, as counts, through the buffer in double and in single precision
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 2000, 12000)
+    data[6000:6500] += 3e6 * np.sin(np.arange(500) / 5.0) * np.exp(-np.arange(500) / 150.0)
+    data = data.astype(np.int32)
+    filterdef = {'type':'highpass', 'freq':[0.05], 'corners':4, 'zerophase':False}
+    pga = {}
+    for dtype in [np.float64, np.float32]:
+        def packet(second, nseconds=1):
+            return [data_ingestion.ChannelBlock('AK.PS01..HNZ', (t0 + second).ns, 100.0, data[second*100:(second+nseconds)*100].astype(dtype))]
+        buffer = data_ingestion.Buffer(packet(0, 40), filterdef, bufferSecs=40.0, cache=data_ingestion.ProcessingCache())
+        pga[dtype] = []
+        for second in range(40, 120):
+            blocks = packet(second)
+            buffer.append(blocks)
+            buffer.filter()
+            for block in buffer.tmp.values():
+                block.data /= 1.0e5 # gain
+            blocks = buffer.trim2packet(blocks)
+            assert blocks[0].data.dtype == dtype
+            pga[dtype].append(np.abs(blocks[0].data).max())
+            buffer.trim2seconds()
+    # single precision PGA is well within the precision thresholds are given to (0.01 g)
+    pga64, pga32 = np.array(pga[np.float64]), np.array(pga[np.float32])
+    assert np.max(np.abs(pga32 - pga64) / pga64) < 1e-5
+    return 0
+
+def run_processing_cache():
+    # ObsPy's example inventory and waveforms, BW.RJOB..EH?, which have full responses
+    st = obspy.read()
+    inventory = obspy.read_inventory()
+    cache = data_ingestion.ProcessingCache(maxsize=4)
+    cache.set_inventory(inventory)
+    for filterdef in [{'type':'highpass', 'freq':[0.5], 'corners':2, 'zerophase':True}, \
+                      {'type':'bandpass', 'freq':[0.5, 10.0], 'corners':4, 'zerophase':False}]:
+        for i in range(2): # the second time round, the filter design comes from the cache
+            expected = st.copy()
+            data_ingestion.filter_Stream(expected, filterdef)
+            filtered = st.copy()
+            data_ingestion.filter_Stream(filtered, filterdef, cache=cache)
+            for tr0, tr1 in zip(expected, filtered):
+                assert np.allclose(tr0.data, tr1.data, rtol=1e-10, atol=0)
+    for i in range(2):
+        expected = st.copy().remove_response(inventory=inventory, output='ACC', pre_filt=[0.01, 0.02, 20.0, 40.0])
+        removed = st.copy()
+        removed.attach_response(inventory)
+        cache.remove_response(removed, output='ACC', pre_filt=[0.01, 0.02, 20.0, 40.0])
+        for tr0, tr1 in zip(expected, removed):
+            assert np.allclose(tr0.data, tr1.data, rtol=1e-10, atol=0)
+    # 2 filter designs and 3 spectra were needed, but only the 4 most recently used are kept, so the first filter design has gone
+    assert cache.misses == 5 and len(cache.entries) == 4 and not [key for key in cache.entries if key[0] == 'sos' and key[2] == 'highpass']
+    # the FFT length is the one Trace.remove_response() uses: at least 2 * npts, and without large prime factors
+    assert [data_ingestion.response_nfft(npts) for npts in [3000, 3001, 1800028, 1800029, 1800031]] == [6000, 6004, 3600056, 4194304, 3600082]
+    return 0
+
+def run_ground_motion_metrics():
+    # 1 m/s^2 sine at 1 Hz, 100 samples per second, for 60 s
+    t = np.arange(6000) / 100.0
+    tr = obspy.Trace(data=np.sin(2 * np.pi * t), header={'network':'AK', 'station':'PS01', 'channel':'HNZ', 'sampling_rate':100.0})
+    metrics = ['PGV', 'PSA1.0', 'CAV', 'ARIAS']
+
+    # the whole minute as one chunk of 1-second windows, and as 1-second packets that each start with the last sample of the 
+    # packet before, must give the same values
+    chunk = ground_motion.GroundMotionMetrics(metrics, cumulative_seconds=10.0).update(data_ingestion.stream2blocks(obspy.Stream([tr])), window_seconds=1.0)
+    packets = ground_motion.GroundMotionMetrics(metrics, cumulative_seconds=10.0)
+    for second in range(60):
+        packetstart = tr.stats.starttime + max([second - tr.stats.delta, 0])
+        metric_dicts = packets.update(data_ingestion.stream2blocks(obspy.Stream([tr.slice(packetstart, tr.stats.starttime + second + 1.0 - tr.stats.delta)])))
+        for metric in metrics:
+            assert np.isclose(metric_dicts[metric][0][tr.id]['value'], chunk[metric][second][tr.id]['value'])
+
+    last = {metric: chunk[metric][-1][tr.id]['value'] for metric in metrics}
+    assert np.isclose(last['PGV'], 1 / (2 * np.pi), rtol=0.01) # velocity amplitude of a sine is acceleration amplitude / 2 pi f
+    assert np.isclose(last['PSA1.0'], 1 / (2 * 0.05), rtol=0.02) # at resonance, the oscillator amplifies 1 / (2 x damping) times
+    assert np.isclose(last['CAV'], 10 * 2 / np.pi, rtol=0.01) # 10 s of mean |sin| = 2 / pi
+    assert np.isclose(last['ARIAS'], np.pi / (2 * ground_motion.G) * 10 * 0.5, rtol=0.01) # 10 s of mean sin^2 = 0.5
+    return 0
+
+def run_combined_peaks():
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    def trace(channel, data, offset=0):
+        return obspy.Trace(data=np.array(data, dtype=float), header={'network':'AK', 'station':'PS01', 'channel':channel, \
+                                                                     'sampling_rate':100.0, 'starttime':t0 + offset * 0.01})
+    # HNE starts a sample later than HNN and HNZ, so samples must be aligned by time. E=3 and N=4 at the same time gives 5 horizontally
+    st = data_ingestion.stream2blocks(obspy.Stream([trace('HNE', [0, 3, 1, 0], offset=1), trace('HNN', [0, 1, 4, -2, 0]), \
+                                                    trace('HNZ', [0, 0, 12, 0, 0])]))
+    peaks = ground_motion.combined_peaks(st, 'vector_sum')[0]['AK.PS01..HNH']
+    assert np.isclose(peaks['value'], 5.0) and peaks['peaktime'] == (t0 + 0.02).ns
+    assert peaks['starttime'] == (t0 + 0.01).ns and peaks['endtime'] == (t0 + 0.04).ns
+    assert np.isclose(ground_motion.combined_peaks(st, 'vector_sum_3d')[0]['AK.PS01..HN3']['value'], 13.0)
+    peaks = ground_motion.combined_peaks(st, 'geometric_mean')[0]['AK.PS01..HNG']
+    assert np.isclose(peaks['value'], np.sqrt(3.0 * 4.0)) and peaks['peaktime'] == (t0 + 0.02).ns
+    # the geometric mean is taken sample by sample too, not of the two channel peaks (which would be sqrt(5 x 4) here)
+    st = data_ingestion.stream2blocks(obspy.Stream([trace('HNE', [0, 5, 1, 0], offset=1), trace('HNN', [0, 1, 1, -4, 0])]))
+    peaks = ground_motion.combined_peaks(st, 'geometric_mean')[0]['AK.PS01..HNG']
+    assert np.isclose(peaks['value'], np.sqrt(5.0 * 1.0)) and peaks['peaktime'] == (t0 + 0.02).ns
+    return 0
+
+def run_running_max():
+    t0 = obspy.UTCDateTime(2024,8,14,23,0,0)
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal(3000)
+    tr = obspy.Trace(data=data, header={'network':'AK', 'station':'PS01', 'channel':'HNZ', 'sampling_rate':100.0, 'starttime':t0})
+    # however the samples are split into packets, each value must be the brute-force maximum over every 5 s (500 sample) window 
+    # ending in that packet
+    for packet_seconds in [0.37, 1.0, 7.0]:
+        metricsObj = ground_motion.GroundMotionMetrics(['PGA5.0'])
+        i0 = 0
+        while i0 < len(data):
+            i1 = min(len(data), int(round(i0 + packet_seconds * 100)))
+            packet = data_ingestion.stream2blocks(obspy.Stream([tr.slice(t0 + i0/100, t0 + (i1-1)/100)]))
+            for values in metricsObj.update(packet, window_seconds=1.0)['PGA5.0']:
+                v = values['AK.PS01..HNZ']
+                first, last = (v['starttime'] - t0.ns) // 10**7, (v['endtime'] - t0.ns) // 10**7 # sample numbers
+                assert np.isclose(v['value'], np.abs(data[max(0, first-499):last+1]).max()), packet_seconds
+                assert np.isclose(abs(data[(v['peaktime'] - t0.ns) // 10**7]), v['value'])
+            i0 = i1
+    # samples older than the window drop out, and only a few candidates are kept
+    running_max = ground_motion.RunningMax(5.0)
+    value, peak_ns = running_max.update(data, t0.ns, 10**7)
+    assert value == np.abs(data).max() and peak_ns == t0.ns + np.abs(data).argmax() * 10**7
+    assert len(running_max.candidates) < 50
+    value, peak_ns = running_max.update(np.zeros(1), t0.ns + 3000 * 10**7, 10**7)
+    assert value == np.abs(data[2501:3000]).max()
+    return 0
+
 def join_times(df, pretime, posttime):
     run_dict={}
     for index, row in df.iterrows():
@@ -214,6 +1192,102 @@ def test_inventory():
 def test_calib2obspy_1channel():
     assert run_calib2obspy(NSLC1)==0
 
+def test_wfdisc2obspy_s4():
+    assert run_wfdisc2obspy('s4')==0
+
+def test_wfdisc2obspy_i2():
+    assert run_wfdisc2obspy('i2')==0
+
+def test_wfdisc2obspy_miniseed():
+    assert run_wfdisc2obspy('sd')==0
+
+def test_hedged2obspy_first_arrival():
+    client, packets = run_hedged2obspy([0.0, 0.05])
+    assert all([tr.stats.source == 'server1' for st in packets for tr in st])
+    assert client.source_stats['server1']['first'] == 60
+
+def test_hedged2obspy_stalled_server():
+    client, packets = run_hedged2obspy([0.0, 0.02], stall_after=[5, None])
+    assert all([tr.stats.source == 'server2' for st in packets[5:] for tr in st])
+
+def test_resequencer():
+    assert run_resequencer()==0
+
+def test_packet_gaps_archive():
+    assert run_packet_gaps('archive')==0
+
+def test_packet_gaps_chunks():
+    assert run_packet_gaps_chunks()==0
+
+def test_packet_gaps_realtime():
+    assert run_packet_gaps('realtime')==0
+
+def test_checkpoint_resume():
+    assert run_checkpoint_resume()==0
+
+def test_catch_up():
+    assert run_catch_up()==0
+
+def test_backfill():
+    assert run_backfill()==0
+
+def test_archive_chunks():
+    assert run_archive_chunks()==0
+
+def test_archive_chunks_vector_sum():
+    assert run_archive_chunks(pga_component='vector_sum')==0
+
+def test_time_shards():
+    assert run_time_shards()==0
+
+def test_archive_readahead():
+    assert run_archive_readahead()==0
+
+def test_stall_watchdog():
+    assert run_stall_watchdog()==0
+
+def test_latency_stall_thread():
+    assert run_latency_stall_thread()==0
+
+def test_station_shards():
+    assert run_station_shards()==0
+
+def test_station_supervisor():
+    assert run_station_supervisor()==0
+
+def test_simulated_clock():
+    assert run_simulated_clock()==0
+
+def test_watch_threshold_monitor():
+    assert run_watch_threshold_monitor()==0
+
+def test_ground_motion_metrics():
+    assert run_ground_motion_metrics()==0
+
+def test_quiet_gate():
+    assert run_quiet_gate()==0
+
+def test_quiet_gate_ramp():
+    assert run_quiet_gate_ramp()==0
+
+def test_incremental_detrend():
+    assert run_incremental_detrend()==0
+
+def test_channel_blocks():
+    assert run_channel_blocks()==0
+
+def test_float32():
+    assert run_float32()==0
+
+def test_processing_cache():
+    assert run_processing_cache()==0
+
+def test_combined_peaks():
+    assert run_combined_peaks()==0
+
+def test_running_max():
+    assert run_running_max()==0
+
 def test_iris_vs_aec_calibrations():
 
     def compare_streams(st1, st2, outfile, stime, etime):